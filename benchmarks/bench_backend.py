@@ -0,0 +1,96 @@
+"""Measures push_and_classify throughput with several processes sharing a backend.
+
+The memory backend is also run capped at --max-offenders, to show what evicting costs.
+
+Usage: python benchmarks/bench_backend.py [--pushes 20000] [--senders 10000] [--processes 1 2 4]
+                                          [--max-offenders 5000]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import multiprocessing
+import random
+import tempfile
+import time
+
+from synapse_anti_ping.backend import MemoryBackend, OffenderBackend, SqliteBackend
+from synapse_anti_ping.config import Limits
+from synapse_anti_ping.offender import Offence, OffenceList
+
+START_MS = 1_600_000_000_000
+LIMITS = Limits()
+
+
+def run(backend: OffenderBackend, seed: int, pushes: int, senders: int) -> float:
+    rng = random.Random(seed)
+    now_ms = START_MS
+
+    start = time.perf_counter()
+    for _ in range(pushes):
+        now_ms += rng.randrange(0, 5)
+        offence = Offence(expiration_ms=now_ms + 24_000, weight=2)
+        backend.push_and_classify(f'@user{rng.randrange(senders)}:example.com',
+                                  offence,
+                                  now_ms=now_ms,
+                                  limits=LIMITS,
+                                  history_size=20)
+    return time.perf_counter() - start
+
+
+def worker(path: str, seed: int, pushes: int, senders: int, barrier: Any, results: Any) -> None:
+    backend = SqliteBackend(path, timeout_seconds=60)
+    barrier.wait()
+    results.put(run(backend, seed, pushes, senders))
+    backend.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pushes', type=int, default=20_000, help='per process')
+    parser.add_argument('--senders', type=int, default=10_000)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--max-offenders', type=int, default=5000)
+    args = parser.parse_args()
+
+    elapsed = run(MemoryBackend(OffenceList), 0, args.pushes, args.senders)
+    print(f'memory, 1 process: {args.pushes / elapsed:,.0f} pushes/s')
+
+    capped = MemoryBackend(OffenceList, max_offenders=args.max_offenders)
+    elapsed = run(capped, 0, args.pushes, args.senders)
+    print(f'memory capped at {args.max_offenders:,}, 1 process: {args.pushes / elapsed:,.0f} '
+          f'pushes/s, {sum(capped.evicted.values()):,} evicted')
+
+    for processes in args.processes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'offenders.db')
+            # Create the schema up front, so the workers only measure pushes.
+            SqliteBackend(path).close()
+
+            barrier = multiprocessing.Barrier(processes + 1)
+            results: Any = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(target=worker,
+                                        args=(path, seed, args.pushes, args.senders, barrier,
+                                              results)) for seed in range(processes)
+            ]
+            for process in workers:
+                process.start()
+
+            barrier.wait()
+            start = time.perf_counter()
+            durations = [results.get() for _ in workers]
+            wall = time.perf_counter() - start
+            for process in workers:
+                process.join()
+
+        total = args.pushes * processes
+        print(f'sqlite, {processes} processes: {total / wall:,.0f} pushes/s total, '
+              f'slowest process {max(durations):.2f}s')
+
+
+if __name__ == '__main__':
+    main()
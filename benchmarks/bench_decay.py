@@ -0,0 +1,201 @@
+"""Shows where decaying scores (storage: decay) decide differently from the offence lists.
+
+Each scenario is one sender's messages, checked with the default offence rules by two memory
+backends, one per engine; every message where their SPAM / BAN decisions differ is counted. A
+random population of senders is compared the same way, followed by the throughput of each.
+Messages are checked a random delay of up to --jitter-ms after they were sent, like events
+reaching the spam checker.
+
+Usage: python benchmarks/bench_decay.py [--senders 2000] [--seed 0] [--jitter-ms 500] [--verbose]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import collections
+import random
+import time
+
+from synapse_anti_ping.backend import MemoryBackend
+from synapse_anti_ping.config import Config
+from synapse_anti_ping.decisions import DecisionTable
+from synapse_anti_ping.offender import (BaseOffenceList, DecayingScore, Offence, OffenceList,
+                                        OffenceListClassifier)
+
+START_MS = 1_600_000_000_000
+SPAM = OffenceListClassifier.SPAM
+BAN = OffenceListClassifier.BAN
+
+CONFIG = {
+    'mjolnir': {
+        'room': '!mjolnir:example.com',
+        'banlist': 'bans'
+    },
+    'log': {
+        'room': '!log:example.com'
+    },
+    'user': {
+        'user': 'antiping',
+        'password': 'password',
+    },
+}
+
+# (milliseconds since the start, msgtype, mentions)
+Message = Tuple[int, str, Optional[int]]
+
+ENGINES: Dict[str, Callable[[int], BaseOffenceList]] = {
+    'lists': OffenceList,
+    'decay': DecayingScore,
+}
+
+
+def every(interval_ms: int,
+          count: int,
+          msgtype: str = 'm.text',
+          mentions: Optional[int] = None,
+          start_ms: int = 0) -> List[Message]:
+    return [(start_ms + i * interval_ms, msgtype, mentions) for i in range(count)]
+
+
+def bursts(size: int, gap_ms: int, count: int) -> List[Message]:
+    messages: List[Message] = []
+    for burst in range(count):
+        messages += every(300, size, start_ms=burst * gap_ms)
+    return messages
+
+
+SCENARIOS: Dict[str, List[Message]] = {
+    'burst of 15 texts, 0.2s apart': every(200, 15),
+    'text every 2s for 3 minutes': every(2000, 90),
+    'text every 3s for 3 minutes': every(3000, 60),
+    'image every 4s for 2 minutes': every(4000, 30, 'm.image'),
+    'mass mention every 10s': every(10_000, 12, mentions=4),
+    'bursts of 8 texts every 30s': bursts(8, 30_000, 6),
+    'bursts of 8 texts every 60s': bursts(8, 60_000, 6),
+}
+
+
+def classify(engine: Callable[[int], BaseOffenceList], decisions: DecisionTable,
+             senders: Mapping[str, List[Message]],
+             jitter_ms: int) -> Dict[str, List[OffenceListClassifier]]:
+    backend = MemoryBackend(engine)
+    # The same delays for each engine.
+    rng = random.Random(0)
+    stream = sorted(((time_ms, sender, msgtype, mentions) for sender, messages in senders.items()
+                     for time_ms, msgtype, mentions in messages),
+                    key=lambda message: message[:2])
+
+    results: Dict[str, List[OffenceListClassifier]] = collections.defaultdict(list)
+    for time_ms, sender, msgtype, mentions in stream:
+        sent_ms = START_MS + time_ms
+        rule = decisions.rule_for(msgtype, mentions)
+        assert rule is not None
+        classifier, _ = backend.push_and_classify(sender,
+                                                  Offence(expiration_ms=sent_ms + rule.duration_ms,
+                                                          weight=rule.weight),
+                                                  now_ms=sent_ms + rng.randint(0, jitter_ms),
+                                                  limits=decisions.limits,
+                                                  history_size=decisions.history_size,
+                                                  duration_ms=rule.duration_ms)
+        results[sender].append(classifier)
+    return results
+
+
+def first(classifiers: List[OffenceListClassifier], at_least: OffenceListClassifier) -> str:
+    for i, classifier in enumerate(classifiers):
+        if classifier.value >= at_least.value:
+            return f'#{i + 1}'
+    return '-'
+
+
+def compare_scenarios(decisions: DecisionTable, jitter_ms: int, verbose: bool) -> None:
+    results = {
+        name: classify(engine, decisions, SCENARIOS, jitter_ms)
+        for name, engine in ENGINES.items()
+    }
+
+    print(f'{"scenario":<32} {"msgs":>5}  first spam (lists/decay)  first ban  differing')
+    for scenario, messages in SCENARIOS.items():
+        lists, decay = results['lists'][scenario], results['decay'][scenario]
+        differing = sum(1 for a, b in zip(lists, decay) if a != b)
+        spam = f'{first(lists, SPAM)}/{first(decay, SPAM)}'
+        ban = f'{first(lists, BAN)}/{first(decay, BAN)}'
+        print(f'{scenario:<32} {len(messages):>5}  {spam:>24}  {ban:>9}  {differing:>9}')
+
+        if verbose:
+            for engine, classifiers in (('lists', lists), ('decay', decay)):
+                print(f'  {engine}: ' + ''.join(c.name[0] for c in classifiers))
+
+
+def random_population(rng: random.Random, count: int) -> Dict[str, List[Message]]:
+    """Senders sending bursts of messages at random rates, some of them with media or mentions."""
+    senders = {}
+    for i in range(count):
+        messages: List[Message] = []
+        time_ms = rng.randrange(0, 60_000)
+        interval_ms = int(rng.expovariate(1 / 5000)) + 100
+        for _ in range(rng.randrange(1, 60)):
+            msgtype = 'm.image' if rng.random() < 0.1 else 'm.text'
+            mentions = None
+            if msgtype == 'm.text' and rng.random() < 0.1:
+                mentions = rng.choice([1, 1, 1, 4])
+            messages.append((time_ms, msgtype, mentions))
+            time_ms += int(rng.expovariate(1 / interval_ms))
+        senders[f'@user{i}:example.com'] = messages
+    return senders
+
+
+def compare_population(decisions: DecisionTable, rng: random.Random, count: int,
+                       jitter_ms: int) -> None:
+    senders = random_population(rng, count)
+    results = {
+        name: classify(engine, decisions, senders, jitter_ms)
+        for name, engine in ENGINES.items()
+    }
+
+    # (lists, decay) -> messages
+    matrix: Counter[Tuple[OffenceListClassifier, OffenceListClassifier]] = collections.Counter()
+    senders_differing = 0
+    for sender in senders:
+        pairs = list(zip(results['lists'][sender], results['decay'][sender]))
+        matrix.update(pairs)
+        senders_differing += any(a != b for a, b in pairs)
+
+    total = sum(matrix.values())
+    print(f'\n{count:,} random senders, {total:,} messages; rows are lists, columns decay:')
+    print(f'{"":>6}' + ''.join(f'{c.name:>9}' for c in OffenceListClassifier))
+    for row in OffenceListClassifier:
+        print(f'{row.name:>6}' + ''.join(f'{matrix[row, column]:>9,}'
+                                         for column in OffenceListClassifier))
+    agreed = sum(matrix[c, c] for c in OffenceListClassifier)
+    print(f'agreement: {agreed / total:.2%} of messages; '
+          f'{senders_differing:,} senders had at least one differing message')
+
+    for name, engine in ENGINES.items():
+        start = time.perf_counter()
+        classify(engine, decisions, senders, jitter_ms)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {total / elapsed:,.0f} messages/s (including sorting the stream)')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--senders', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jitter-ms',
+                        type=int,
+                        default=500,
+                        help='longest delay between sending and checking a message')
+    parser.add_argument('--verbose', action='store_true', help='print every decision')
+    args = parser.parse_args()
+
+    decisions = DecisionTable(Config.from_data(CONFIG))
+    compare_scenarios(decisions, args.jitter_ms, args.verbose)
+    compare_population(decisions, random.Random(args.seed), args.senders, args.jitter_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Compares BoundedHeap against the old RoundRobinList-backed heap.
+
+The old heap needed the pure-Python heapq, so it is rebuilt here on top of a private copy of the
+heapq module rather than by disabling _heapq for the whole process.
+
+Usage: python benchmarks/bench_heap.py [--cap N] [--ops N]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import heapq
+import importlib.util
+import random
+import timeit
+
+from synapse_anti_ping.bounded_heap import BoundedHeap
+from synapse_anti_ping.round_robin_list import RoundRobinList
+
+
+def _load_pure_heapq() -> Any:
+    spec = importlib.util.spec_from_file_location('_pure_heapq', heapq.__file__)
+    module = importlib.util.module_from_spec(spec)
+
+    saved = sys.modules.get('_heapq')
+    sys.modules['_heapq'] = None  # type: ignore
+    try:
+        spec.loader.exec_module(module)  # type: ignore
+    finally:
+        if saved is not None:
+            sys.modules['_heapq'] = saved
+        else:
+            del sys.modules['_heapq']
+
+    return module
+
+
+_pure_heapq = _load_pure_heapq()
+
+
+class LegacyRoundRobinHeap:
+    def __init__(self, *, cap: int) -> None:
+        self._storage: RoundRobinList[int] = RoundRobinList(cap=cap)
+
+    def push(self, item: int) -> None:
+        _pure_heapq.heappush(self._storage, item)
+
+    def pop(self) -> int:
+        return cast(int, _pure_heapq.heappop(self._storage))
+
+    def __len__(self) -> int:
+        return len(self._storage)
+
+
+def bench_push_pop(factory: Callable[[], Any], items: List[int]) -> None:
+    heap = factory()
+    for item in items:
+        heap.push(item)
+        if len(heap) > 1:
+            heap.pop()
+
+
+def bench_fill_drain(factory: Callable[[], Any], items: List[int], cap: int) -> None:
+    for start in range(0, len(items), cap):
+        heap = factory()
+        for item in items[start:start + cap]:
+            heap.push(item)
+        while len(heap):
+            heap.pop()
+
+
+def bench_evict(factory: Callable[[], Any], items: List[int]) -> None:
+    heap = factory()
+    for item in items:
+        heap.push(item)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cap', type=int, default=20)
+    parser.add_argument('--ops', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    items = [rng.randrange(1 << 40) for _ in range(args.ops)]
+    # Mostly increasing, like offence expirations.
+    increasing = sorted(items)
+
+    factories: Dict[str, Callable[[], Any]] = {
+        'legacy': lambda: LegacyRoundRobinHeap(cap=args.cap),
+        'bounded': lambda: BoundedHeap(cap=args.cap),
+    }
+
+    cases: Dict[str, Callable[[Callable[[], Any]], None]] = {
+        'push/pop': lambda f: bench_push_pop(f, items),
+        'fill/drain': lambda f: bench_fill_drain(f, items, args.cap),
+        'evict': lambda f: bench_evict(f, increasing),
+    }
+
+    print(f'cap={args.cap} ops={args.ops}')
+    for case, run in cases.items():
+        results = {}
+        for name, factory in factories.items():
+            best = min(timeit.repeat(lambda: run(factory), number=1, repeat=args.repeat))
+            results[name] = best
+            print(f'{case:>12} {name:>8}: {best / args.ops * 1e9:8.1f} ns/op')
+
+        print(f'{case:>12} speedup: {results["legacy"] / results["bounded"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
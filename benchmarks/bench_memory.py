@@ -0,0 +1,66 @@
+"""Reports the memory cost of each tracked sender for the different offence storage modes.
+
+Sender IDs are allocated before measuring, so the numbers only cover the offender records, their
+offences, and the table slot for them.
+
+Usage: python benchmarks/bench_memory.py [--senders 10000,100000,1000000] [--offences N]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import collections
+import gc
+import time
+import tracemalloc
+
+from synapse_anti_ping.offender import OFFENCE_LIST_TYPES, Offence, Offender
+
+
+def measure(storage: str, senders: List[str], offences_per_sender: int, cap: int) -> int:
+    offence_list_type = OFFENCE_LIST_TYPES[storage]
+    now_ms = int(time.time() * 1000)
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    offenders: DefaultDict[str, Offender] = collections.defaultdict(
+        lambda: Offender(offence_list_type(cap)))
+    for sender in senders:
+        data = offenders[sender]
+        for i in range(offences_per_sender):
+            data.offences.push(Offence(expiration_ms=now_ms + i * 1000, weight=2))
+            # As the backend does after every push; decaying scores fold offences in here.
+            data.offences.clear_expired(now_ms)
+
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del offenders
+    gc.collect()
+
+    return after - before
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--senders', default='10000,100000,1000000')
+    parser.add_argument('--offences', type=int, default=3, help='offences per sender')
+    parser.add_argument('--history-size', type=int, default=20)
+    parser.add_argument('--storage', default=','.join(OFFENCE_LIST_TYPES))
+    args = parser.parse_args()
+
+    for count in map(int, args.senders.split(',')):
+        senders = [f'@user{i}:example.com' for i in range(count)]
+        for storage in args.storage.split(','):
+            used = measure(storage, senders, args.offences, args.history_size)
+            print(f'{count:>8} senders {storage:>8}: {used / count:8.1f} bytes/offender'
+                  f' ({used / 1024 / 1024:.1f} MiB)')
+
+
+if __name__ == '__main__':
+    main()
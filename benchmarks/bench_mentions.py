@@ -0,0 +1,75 @@
+"""Measures mention counting throughput on large synthetic message bodies.
+
+Usage: python benchmarks/bench_mentions.py [--size BYTES] [--repeat N]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import timeit
+
+from synapse_anti_ping.mentions import get_mention_count, get_mention_count_with_html_parser
+
+MENTION = '<a href="https://matrix.to/#/@user{}:instance.chat">user{}</a> '
+
+
+def repeat_to_size(pieces: Callable[[int], str], size: int) -> str:
+    parts = []
+    total = 0
+    i = 0
+    while total < size:
+        part = pieces(i)
+        parts.append(part)
+        total += len(part)
+        i += 1
+
+    return ''.join(parts)[:size]
+
+
+def make_bodies(size: int) -> Dict[str, str]:
+    return {
+        'plain text':
+            'spam ' * (size // 5),
+        'formatting':
+            repeat_to_size(lambda i: f'<p><b>spam</b> <i>{i}</i> <code>x</code></p>', size),
+        'links':
+            repeat_to_size(lambda i: f'<a href="https://example.com/{i}">link {i}</a> ', size),
+        'one mention':
+            MENTION.format(0, 0) + 'spam ' * (size // 5),
+        'mention flood':
+            repeat_to_size(lambda i: MENTION.format(i, i), size),
+        'unclosed tags':
+            repeat_to_size(lambda i: f'<b title="{i}" <i ', size),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=60000)
+    parser.add_argument('--limit', type=int, default=4, help='mass mention upgrade_at')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    counters: Dict[str, Callable[[str], int]] = {
+        'HTMLParser': lambda body: get_mention_count_with_html_parser(body, limit=args.limit),
+        'scanner': lambda body: get_mention_count(body, limit=args.limit),
+    }
+
+    for name, body in make_bodies(args.size).items():
+        results = {}
+        for counter_name, counter in counters.items():
+            number = 10
+            best = min(timeit.repeat(lambda: counter(body), number=number,
+                                     repeat=args.repeat)) / number
+            results[counter_name] = best
+            print(f'{name:>14} {counter_name:>10}: {best * 1e6:10.1f} us'
+                  f' ({len(body) / best / 1024 / 1024:8.1f} MiB/s)')
+
+        print(f'{name:>14}    speedup: {results["HTMLParser"] / results["scanner"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Compares member exclusion lookups as the pattern list grows.
+
+The lists mix literal user IDs, prefix globs (bridge puppets) and suffix globs (whole servers),
+plus a handful of complex globs, like a real members.exclude list.
+
+Usage: python benchmarks/bench_patterns.py [--sizes 10,100,1000,10000,50000]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import random
+import time
+import timeit
+
+from synapse_anti_ping.pattern_matcher import PatternMatcher
+from synapse_anti_ping.utils import compile_pattern_alternatives
+
+
+def make_patterns(count: int, rng: random.Random) -> List[str]:
+    patterns = ['@mod?:example.com', '@[ab]dmin*:example.com']
+    while len(patterns) < count:
+        kind = rng.random()
+        i = len(patterns)
+        if kind < 0.8:
+            patterns.append(f'@moderator{i}:example.com')
+        elif kind < 0.9:
+            patterns.append(f'@bridge{i}_*')
+        else:
+            patterns.append(f'*:server{i}.example.com')
+
+    return patterns[:count]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,100,1000,10000,50000')
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+
+    print(f'{"patterns":>8} {"matcher":>10} {"regex":>10} {"build (matcher/regex)":>24}')
+    for size in map(int, args.sizes.split(',')):
+        patterns = make_patterns(size, rng)
+
+        start = time.perf_counter()
+        matcher = PatternMatcher(patterns)
+        matcher_build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        regex = compile_pattern_alternatives(patterns)
+        regex_build = time.perf_counter() - start
+
+        # Mostly ordinary users that don't match anything, as with real traffic.
+        keys = [f'@user{rng.randrange(1 << 30)}:example.com' for _ in range(args.lookups)]
+        keys[::10] = [rng.choice(patterns).replace('*', 'x').replace('?', 'x') for _ in keys[::10]]
+
+        matcher_time = min(
+            timeit.repeat(lambda: [matcher.matches(key) for key in keys], number=1, repeat=3))
+        regex_time = min(
+            timeit.repeat(lambda: [regex.match(key) for key in keys], number=1, repeat=3))
+
+        print(f'{size:>8} {matcher_time / len(keys) * 1e6:>8.2f}us'
+              f' {regex_time / len(keys) * 1e6:>8.2f}us'
+              f' {matcher_build * 1000:>11.1f}ms/{regex_build * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""Replays synthetic event streams through AntiSpam.check_event_for_spam.
+
+Each scenario runs in its own process so that peak RSS is measured per scenario, and the results
+are printed as JSON so they can be compared between releases:
+
+    python benchmarks/bench_replay.py > results.json
+    python benchmarks/bench_replay.py --scenario mention_raid --scale 0.1
+
+Time is virtual: event timestamps and offence expiry follow a VirtualClock, and GC ticks are run
+by the harness every gc_interval_minutes of virtual time, so a day of traffic replays as fast as
+the module can process it.
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import array
+import concurrent.futures
+import itertools
+import json
+import math
+import random
+import resource
+import subprocess
+import time
+import types
+
+from synapse_anti_ping.antispam import AntiSpam
+from synapse_anti_ping.clock import VirtualClock
+from synapse_anti_ping.config import Config
+from synapse_anti_ping.matrix import LogNotice, Matrix
+
+SERVER_NAME = 'example.com'
+START_MS = 1_600_000_000_000
+
+# (delay since the previous event in ms, event)
+Stream = Iterator[Tuple[int, Dict[str, Any]]]
+
+
+class NullMatrix:
+    """Stands in for Matrix, recording how many messages would have been sent."""
+    def __init__(self) -> None:
+        self.sent = 0
+
+    def send_message(self, message: str, **kwargs: Any) -> 'concurrent.futures.Future[None]':
+        self.sent += 1
+        future: 'concurrent.futures.Future[None]' = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def send_log_notice(self, notice: LogNotice) -> None:
+        self.sent += 1
+
+    def call_soon(self, callback: Callable[..., None], *args: Any) -> None:
+        # Only used to queue bans on Matrix's loop, which doesn't exist here.
+        pass
+
+
+def make_config() -> Config:
+    return Config.from_data({
+        'mjolnir': {
+            'room': f'!mjolnir:{SERVER_NAME}',
+            'banlist': 'bans'
+        },
+        'log': {
+            'room': f'!log:{SERVER_NAME}'
+        },
+        'user': {
+            'user': 'antiping',
+            'password': 'unused',
+            'homeserver': 'http://localhost:8008',
+        },
+        'members': {
+            'exclude': [f'@mjolnir:{SERVER_NAME}', f'@moderator*:{SERVER_NAME}']
+        },
+    })
+
+
+def make_api() -> Any:
+    return types.SimpleNamespace(hs=types.SimpleNamespace(config=types.SimpleNamespace(
+        server_name=SERVER_NAME, public_baseurl='http://localhost:8008')))
+
+
+def mentions_body(count: int, rng: random.Random) -> str:
+    return ' '.join(f'<a href="https://matrix.to/#/@user{rng.randrange(100000)}:{SERVER_NAME}">'
+                    f'user</a>' for _ in range(count))
+
+
+def make_event(sender: str, room: str, ts: int, content: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'type': 'm.room.message',
+        'room_id': room,
+        'sender': sender,
+        'origin_server_ts': ts,
+        'content': content,
+    }
+
+
+def text_content(rng: random.Random) -> Dict[str, Any]:
+    roll = rng.random()
+    if roll < 0.85:
+        return {'msgtype': 'm.text', 'body': 'hello there ' * rng.randrange(1, 10)}
+    elif roll < 0.93:
+        return {
+            'msgtype': 'm.text',
+            'body': 'user: hi',
+            'format': 'org.matrix.custom.html',
+            'formatted_body': mentions_body(1, rng) + ': hi',
+        }
+    elif roll < 0.98:
+        return {'msgtype': 'm.image', 'body': 'image.png', 'url': 'mxc://example.com/abc'}
+    else:
+        return {
+            'msgtype': 'm.text',
+            'body': 'see link',
+            'format': 'org.matrix.custom.html',
+            'formatted_body': '<p>see <a href="https://example.com/page">this</a></p>',
+        }
+
+
+def background(rng: random.Random, *, senders: int, rooms: int, mean_gap_ms: float) -> Stream:
+    while True:
+        sender = f'@user{rng.randrange(senders)}:{SERVER_NAME}'
+        room = f'!room{rng.randrange(rooms)}:{SERVER_NAME}'
+        yield int(rng.expovariate(1 / mean_gap_ms)), make_event(sender, room, 0, text_content(rng))
+
+
+def interleave(rng: random.Random, count: int, streams: List[Tuple[float, Stream]]) -> Stream:
+    """Takes count events from the streams, picking each stream with the given probability."""
+    weights = [weight for weight, _ in streams]
+    for _ in range(count):
+        _, stream = rng.choices(streams, weights)[0]
+        yield next(stream)
+
+
+def normal_day(rng: random.Random, scale: float) -> Stream:
+    events = int(200_000 * scale)
+    # Spread over a day.
+    return itertools.islice(
+        background(rng, senders=5000, rooms=200, mean_gap_ms=86_400_000 / events), events)
+
+
+def mention_raid(rng: random.Random, scale: float) -> Stream:
+    def raiders() -> Stream:
+        while True:
+            sender = f'@raider{rng.randrange(500)}:{SERVER_NAME}'
+            room = f'!room{rng.randrange(5)}:{SERVER_NAME}'
+            yield int(rng.expovariate(1 / 10)), make_event(
+                sender, room, 0, {
+                    'msgtype': 'm.text',
+                    'body': 'ping',
+                    'format': 'org.matrix.custom.html',
+                    'formatted_body': mentions_body(rng.randrange(5, 40), rng),
+                })
+
+    return interleave(rng, int(50_000 * scale),
+                      [(0.7, background(rng, senders=5000, rooms=200, mean_gap_ms=20)),
+                       (0.3, raiders())])
+
+
+def media_flood(rng: random.Random, scale: float) -> Stream:
+    def flooders() -> Stream:
+        while True:
+            sender = f'@flooder{rng.randrange(300)}:{SERVER_NAME}'
+            room = f'!room{rng.randrange(5)}:{SERVER_NAME}'
+            yield int(rng.expovariate(1 / 5)), make_event(sender, room, 0, {
+                'msgtype': 'm.image',
+                'body': 'image.png',
+                'url': 'mxc://example.com/abc'
+            })
+
+    return interleave(rng, int(50_000 * scale),
+                      [(0.5, background(rng, senders=5000, rooms=200, mean_gap_ms=10)),
+                       (0.5, flooders())])
+
+
+def botnet(rng: random.Random, scale: float) -> Stream:
+    # Every event comes from a different account, over about half an hour.
+    senders = int(1_000_000 * scale)
+    for i in range(senders):
+        sender = f'@bot{i}:{SERVER_NAME}'
+        room = f'!room{rng.randrange(200)}:{SERVER_NAME}'
+        yield int(rng.expovariate(1 / (1_800_000 / senders))), make_event(
+            sender, room, 0, {
+                'msgtype': 'm.text',
+                'body': 'buy now'
+            })
+
+
+SCENARIOS: Dict[str, Callable[[random.Random, float], Stream]] = {
+    'normal_day': normal_day,
+    'mention_raid': mention_raid,
+    'media_flood': media_flood,
+    'botnet': botnet,
+}
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_scenario(name: str, scale: float, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    clock = VirtualClock(START_MS)
+    matrix = NullMatrix()
+
+    antispam = AntiSpam(make_config(), make_api(), clock=clock, matrix=cast(Matrix, matrix))
+    # GC is driven by the virtual clock instead of the reactor.
+    antispam.gc_task.stop()
+    gc_interval_ms = antispam.config.offences.gc_interval_minutes * 60 * 1000
+    next_gc_ms = START_MS + gc_interval_ms
+
+    latencies = array.array('d')
+    gc_durations = array.array('d')
+    gc_swept = 0
+    flagged = 0
+    peak_offenders = 0
+
+    wall_start = time.perf_counter()
+    for delay_ms, event in SCENARIOS[name](rng, scale):
+        clock.advance(delay_ms)
+        event['origin_server_ts'] = clock.now_ms()
+
+        while clock.now_ms() >= next_gc_ms:
+            antispam._gc_callback()
+            assert antispam.last_gc is not None
+            gc_durations.append(antispam.last_gc.duration_seconds)
+            gc_swept += antispam.last_gc.swept
+            next_gc_ms += gc_interval_ms
+
+        start = time.perf_counter()
+        if antispam.check_event_for_spam(event):
+            flagged += 1
+        latencies.append(time.perf_counter() - start)
+
+        peak_offenders = max(peak_offenders, len(antispam.backend))
+    wall = time.perf_counter() - wall_start
+
+    sorted_latencies = sorted(latencies)
+    sorted_gc = sorted(gc_durations)
+
+    return {
+        'scenario': name,
+        'scale': scale,
+        'events': len(latencies),
+        'events_per_second': len(latencies) / math.fsum(latencies) if latencies else 0.0,
+        'wall_seconds': wall,
+        'latency_us': {
+            'p50': percentile(sorted_latencies, 0.5) * 1e6,
+            'p99': percentile(sorted_latencies, 0.99) * 1e6,
+            'max': (sorted_latencies[-1] if sorted_latencies else 0.0) * 1e6,
+        },
+        'gc': {
+            'ticks': len(gc_durations),
+            'swept': gc_swept,
+            'p50_ms': percentile(sorted_gc, 0.5) * 1e3,
+            'max_ms': (sorted_gc[-1] if sorted_gc else 0.0) * 1e3,
+        },
+        'flagged_events': flagged,
+        'messages_sent': matrix.sent,
+        'peak_offenders': peak_offenders,
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=list(SCENARIOS), action='append')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the event counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+
+    if args.in_process:
+        results = [run_scenario(name, args.scale, args.seed) for name in scenarios]
+    else:
+        results = []
+        for name in scenarios:
+            output = subprocess.run([
+                sys.executable, __file__, '--in-process', '--scenario', name, '--scale',
+                str(args.scale), '--seed',
+                str(args.seed)
+            ],
+                                    check=True,
+                                    stdout=subprocess.PIPE).stdout
+            results.extend(json.loads(output))
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Measures saving and loading offender snapshots.
+
+Saving is split like AntiSpam.save_snapshot does it: gathering on the reactor, a batch at a time
+(the longest batch is how long the reactor stalls), then writing the file from a thread.
+
+Usage: python benchmarks/bench_snapshot.py [--offenders 1000000] [--offences 3]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import random
+import tempfile
+import time
+
+from synapse_anti_ping.offender import Offence, OffenderState
+from synapse_anti_ping.backend import COLLECT_BATCH
+from synapse_anti_ping.snapshot import Snapshot, SnapshotEntry, SnapshotWriter
+
+NOW_MS = 1_600_000_000_000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--offenders', type=int, default=1_000_000)
+    parser.add_argument('--offences', type=int, default=3, help='per offender')
+    parser.add_argument('--expired',
+                        type=float,
+                        default=0.5,
+                        help='fraction of offenders that have expired by load time')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    states = list(OffenderState)
+
+    entries: List[SnapshotEntry] = []
+    for i in range(args.offenders):
+        # Load happens a minute after saving.
+        base = NOW_MS + (0 if rng.random() < args.expired else 60_000)
+        offences = [
+            Offence(expiration_ms=base + rng.randrange(1, 30_000), weight=rng.randrange(1, 10))
+            for _ in range(args.offences)
+        ]
+        entries.append((f'@user{i}:example.com', rng.choice(states), offences))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'snapshot')
+
+        writer = SnapshotWriter(now_ms=NOW_MS)
+        gather = longest_batch = 0.0
+        for batch in range(0, len(entries), COLLECT_BATCH):
+            start = time.perf_counter()
+            for entry in entries[batch:batch + COLLECT_BATCH]:
+                writer.add(*entry)
+            elapsed = time.perf_counter() - start
+            gather += elapsed
+            longest_batch = max(longest_batch, elapsed)
+
+        start = time.perf_counter()
+        count = writer.write(path)
+        write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        snapshot = Snapshot(path, now_ms=NOW_MS + 60_000)
+        load = time.perf_counter() - start
+        indexed = len(snapshot)
+
+        start = time.perf_counter()
+        for name, _, _ in entries[:100_000]:
+            snapshot.pop(name)
+        pop = (time.perf_counter() - start) / min(len(entries), 100_000)
+
+        print(f'{count} offenders, {os.path.getsize(path) / 1024 / 1024:.1f} MiB')
+        print(f'gather: {gather * 1000:.0f}ms, longest batch of {COLLECT_BATCH} '
+              f'{longest_batch * 1000:.1f}ms')
+        print(f'write: {write * 1000:.0f}ms')
+        print(f'load:   {load * 1000:.0f}ms ({indexed} unexpired)')
+        print(f'pop:    {pop * 1e6:.2f}us per offender')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Measures how long importing the module and constructing AntiSpam take.
+
+Each import is timed in a fresh interpreter. Construction uses the default Matrix, which isn't
+started here since the reactor never runs.
+
+Usage: python benchmarks/bench_startup.py [--runs 10]
+"""
+
+from typing import *
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import argparse
+import statistics
+import subprocess
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import synapse_anti_ping
+print(time.perf_counter() - start)
+'''
+
+CONFIG = {
+    'mjolnir': {
+        'room': '!mjolnir:example.com',
+        'banlist': 'bans'
+    },
+    'log': {
+        'room': '!log:example.com'
+    },
+    'user': {
+        'user': 'antiping',
+        'password': 'password',
+    },
+}
+
+
+class NullModuleApi:
+    server_name = 'example.com'
+    public_baseurl = 'https://example.com/'
+
+    def register_spam_checker_callbacks(self, **callbacks: Any) -> None:
+        pass
+
+
+def time_import() -> float:
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT],
+                            cwd=ROOT,
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return float(output)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    imports = [time_import() for _ in range(args.runs)]
+    print(f'import:            {statistics.median(imports) * 1000:.1f}ms (median)')
+
+    from synapse_anti_ping import AntiSpam
+    # Synapse has always loaded Twisted by the time it constructs modules.
+    import twisted.internet.reactor, twisted.internet.task  # type: ignore
+
+    start = time.perf_counter()
+    config = AntiSpam.parse_config(CONFIG)
+    print(f'first parse:       {(time.perf_counter() - start) * 1000:.2f}ms')
+
+    parses = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        AntiSpam.parse_config(CONFIG)
+        parses.append(time.perf_counter() - start)
+    print(f'parse:             {statistics.median(parses) * 1000:.2f}ms (median)')
+
+    constructions = []
+    for _ in range(args.runs):
+        config = AntiSpam.parse_config(CONFIG)
+        start = time.perf_counter()
+        antispam = AntiSpam(config, cast(Any, NullModuleApi()))
+        constructions.append(time.perf_counter() - start)
+        antispam.gc_task.stop()
+    print(f'construct:         {statistics.median(constructions) * 1000:.2f}ms (median), '
+          f'first {constructions[0] * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
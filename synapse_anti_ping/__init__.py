@@ -1 +1 @@
-from .antispam import AntiSpam  # type: ignore
+from .antispam import AntiSpam, AntiSpamModule  # type: ignore
@@ -2,155 +2,524 @@
 from typing import *
 from typing import cast
 
-from datetime import datetime, timedelta, timezone
-from twisted.internet import task  # type: ignore
+from dataclasses import dataclass
 
 if TYPE_CHECKING:
-    from .spam_checker_api import SpamCheckerApi
+    from .spam_checker_api import EventBase, ModuleApi, SpamCheckerApi
 
-import collections
+import functools
 import logging
-
-from .config import Config, OffenceConfig
-from .matrix import Matrix, Mjolnir
+import time
+
+from .backend import MemoryBackend, OffenderBackend, SqliteBackend
+from .clock import Clock, SystemClock
+from .config import Config
+from .decisions import DecisionTable
+from .lru_cache import LruCache
+from .pattern_matcher import PatternMatcher
+from .sketch import WindowedCountMinSketch
+from .snapshot import Snapshot, SnapshotFormatError, SnapshotWriter
+from .matrix import LogNotice, Matrix, Mjolnir, reactor_event_loop
 from .mentions import get_mention_count
-from .offender import Offender, OffenderState, Offence, OffenceList, OffenceListClassifier
+from .metrics import EVENT_BUCKETS, Metrics
+from .send_scheduler import Priority
+from .tracer import SlowEvent, SlowEventTracer, format_slow_events
+from .offender import (OffenderState, Offence, OffenceListClassifier, OFFENCE_LIST_TYPES,
+                       MAX_COMPACT_WEIGHT)
 from .utils import *
 
 logger = logging.getLogger('synapse_anti_ping.antispam')
 
+# Commands are sent to Mjolnir's moderation room, e.g. '!antiping slow'.
+COMMAND_PREFIX = '!antiping'
+
+# Config settings that reload_config can't change.
+STARTUP_SETTINGS = ('user', 'log', 'mjolnir', 'ratelimit', 'spool', 'offences.storage',
+                    'offences.gc_interval_minutes', 'backend', 'sketch', 'snapshot')
+
+
+@dataclass
+class GcStats:
+    # Offenders whose earliest offence had expired and were revisited.
+    swept: int
+    # Offenders dropped because all their offences expired.
+    removed: int
+    duration_seconds: float
+
 
 class AntiSpam:
-    def __init__(self, config: Config, api: 'SpamCheckerApi'):
+    """The spam checker, as listed under spam_checker in Synapse's config.
+
+    Synapse calls the legacy spam checker methods itself, so nothing is registered here; see
+    AntiSpamModule for the modules list. The bot's messages are sent from the reactor's own loop
+    when Synapse runs on the asyncio reactor, and from a private thread otherwise.
+    """
+    def __init__(self,
+                 config: Config,
+                 api: Union['SpamCheckerApi', 'ModuleApi'],
+                 *,
+                 clock: Optional[Clock] = None,
+                 matrix: Optional[Matrix] = None):
+        # Imported here, since the reactor can only be imported once the right one is installed,
+        # and there's no point in paying for Twisted before Synapse has loaded it anyway.
+        from twisted.internet import reactor, task, threads  # type: ignore
+
         self.api = api
         self.config = config
+        self.clock = clock if clock is not None else SystemClock()
+
+        # Newer Synapse versions give legacy spam checkers a ModuleApi too, so this only decides
+        # where the server's details are read from.
+        if hasattr(api, 'server_name'):
+            module_api = cast('ModuleApi', api)
+            self.server_name = module_api.server_name
+            public_baseurl = module_api.public_baseurl
+        else:
+            spam_checker_api = cast('SpamCheckerApi', api)
+            self.server_name = spam_checker_api.hs.config.server_name
+            public_baseurl = spam_checker_api.hs.config.public_baseurl
 
         if self.config.user.homeserver is None:
-            self.config.user.homeserver = self.api.hs.config.public_baseurl
+            self.config.user.homeserver = public_baseurl
+
+        self.metrics = Metrics()
 
-        self.matrix = Matrix(self.config)
-        self.matrix.start()
+        if matrix is None:
+            matrix = Matrix(self.config, loop=reactor_event_loop(), metrics=self.metrics)
+            # Logging in waits until Synapse has finished starting up.
+            reactor.callWhenRunning(matrix.start)
+        self.matrix = matrix
 
         self.mjolnir = Mjolnir(self.config, self.matrix)
 
-        self.offenders: DefaultDict[str, Offender] = collections.defaultdict(
-            lambda: Offender(OffenceList(cap=config.offences.history_size)))
+        self.last_gc: Optional[GcStats] = None
+
+        # What snapshots wait on; tests swap these for ones that finish straight away, since they
+        # don't run the reactor.
+        self._cooperate = task.cooperate
+        self._defer_to_thread = threads.deferToThread
+        # The Deferred of the snapshot being saved, if any.
+        self._saving: Any = None
+        self.tracer: Optional[SlowEventTracer] = None
+
+        self._storage = config.offences.storage
+        self._apply_config(config)
+
+        offence_list_type = OFFENCE_LIST_TYPES[config.offences.storage]
+
+        self._snapshot_path = config.snapshot.path
+        self.backend: OffenderBackend
+        if config.backend.type == 'sqlite':
+            if config.backend.path is None:
+                raise ValueError('backend.path must be set to use the sqlite backend')
+            if self._snapshot_path is not None:
+                logger.warning('Ignoring snapshot.path, the sqlite backend is already saved to '
+                               'disk')
+                self._snapshot_path = None
+            if config.offences.storage != 'heap':
+                logger.warning(f'Ignoring offences.storage: {config.offences.storage}, the sqlite '
+                               'backend keeps every offence as a row')
+            if config.sketch.enabled:
+                logger.warning('Ignoring sketch.enabled, it only applies to the memory backend')
+            if config.backend.max_offenders is not None:
+                logger.warning('Ignoring backend.max_offenders, it only applies to the memory '
+                               'backend')
+
+            self.backend = SqliteBackend(config.backend.path)
+        else:
+            snapshot = None
+            if self._snapshot_path is not None:
+                snapshot = self._load_snapshot(self._snapshot_path)
+
+            admission = None
+            if config.sketch.enabled:
+                admission = WindowedCountMinSketch(width=config.sketch.width,
+                                                   depth=config.sketch.depth,
+                                                   window_ms=self._sketch_window_ms(config))
+
+            self.backend = MemoryBackend(offence_list_type,
+                                         snapshot=snapshot,
+                                         admission=admission,
+                                         promote_at=config.sketch.promote_at,
+                                         max_offenders=config.backend.max_offenders)
+
+        self._init_metrics()
 
         self.gc_task = task.LoopingCall(self._gc_callback)
         self.gc_task.start(self.config.offences.gc_interval_minutes * 60)
 
-        self.include_rooms = compile_pattern_alternatives(config.rooms.include)
-        self.exclude_rooms = compile_pattern_alternatives(config.rooms.exclude)
-        self.exclude_members = compile_pattern_alternatives(config.members.exclude)
+        if self._snapshot_path is not None:
+            self.snapshot_task = task.LoopingCall(self.save_snapshot)
+            self.snapshot_task.start(self.config.snapshot.interval_minutes * 60, now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.save_snapshot)
+
+    @staticmethod
+    def _sketch_window_ms(config: Config) -> int:
+        # The shortest lived offence, so that a sender's estimate doesn't build up from offences
+        # that have long expired.
+        offences = config.offences
+        durations = [
+            int(offence_config.expires_minutes * 60 * 1000)
+            for offence_config in (offences.text_spam, offences.media_spam, offences.mentions,
+                                   offences.mass_mentions) if offence_config.enabled
+        ]
+        return max(1, min(durations, default=60 * 1000))
+
+    def _init_metrics(self) -> None:
+        metrics = self.metrics
+
+        stage_doc = 'Time spent checking messages, by stage'
+        self._filter_seconds = metrics.histogram('check_seconds',
+                                                 stage_doc,
+                                                 EVENT_BUCKETS,
+                                                 stage='filter')
+        self._mentions_seconds = metrics.histogram('check_seconds',
+                                                   stage_doc,
+                                                   EVENT_BUCKETS,
+                                                   stage='mentions')
+        self._classify_seconds = metrics.histogram('check_seconds',
+                                                   stage_doc,
+                                                   EVENT_BUCKETS,
+                                                   stage='classify')
+        self._total_seconds = metrics.histogram('check_seconds',
+                                                stage_doc,
+                                                EVENT_BUCKETS,
+                                                stage='total')
+
+        outcome_doc = 'Messages checked, by outcome'
+        self._outcome_counters = {
+            classifier: metrics.counter('messages_total',
+                                        outcome_doc,
+                                        outcome=classifier.name.lower())
+            for classifier in OffenceListClassifier
+        }
+        # Not in a moderated room, or from an exempt sender.
+        self._ignored_counter = metrics.counter('messages_total', outcome_doc, outcome='ignored')
+
+        metrics.gauge('offenders', 'Senders with unexpired offences', lambda: len(self.backend))
+        metrics.gauge('offences', 'Unexpired offences held across every sender',
+                      self.backend.offence_count)
+
+        backend = self.backend
+        if isinstance(backend, MemoryBackend) and backend.max_offenders is not None:
+            for state in OffenderState:
+                metrics.counter_from('offenders_evicted_total',
+                                     'Senders dropped to stay under backend.max_offenders',
+                                     functools.partial(backend.evicted.__getitem__, state),
+                                     state=state.name.lower())
+
+        self._gc_seconds = metrics.histogram('gc_seconds', 'Time spent clearing expired offences')
+        self._gc_swept = metrics.counter('gc_swept_total',
+                                         'Senders revisited because an offence expired')
+        self._gc_removed = metrics.counter('gc_removed_total',
+                                           'Senders dropped because all their offences expired')
+
+        if metrics.register():
+            logger.info('Registered metrics with Synapse')
+
+    def _load_snapshot(self, path: str) -> Optional[Snapshot]:
+        start = time.perf_counter()
+        try:
+            snapshot = Snapshot(path, now_ms=self.clock.now_ms())
+        except FileNotFoundError:
+            return None
+        except SnapshotFormatError as ex:
+            logger.error(f'Ignoring snapshot: {ex}')
+            return None
+
+        logger.info(f'Loaded {len(snapshot)} offenders from {path} '
+                    f'in {(time.perf_counter() - start) * 1000:.1f}ms')
+        return snapshot
+
+    def save_snapshot(self) -> Any:
+        """Saves every offender with unexpired offences to the configured snapshot path, returning
+        a Deferred that fires once it's written.
+
+        Offenders are gathered a batch at a time between other work on the reactor, then the file
+        is written from a thread. That thread also reloads the offenders still waiting in the
+        previous snapshot from the new file, so the old mapping can be closed and expired ones
+        are dropped. If a save is already underway, its Deferred is returned instead.
+        """
+        assert self._snapshot_path is not None and isinstance(self.backend, MemoryBackend)
+        if self._saving is not None:
+            return self._saving
+
+        start = time.perf_counter()
+        backend = self.backend
+        path = self._snapshot_path
+        writer = SnapshotWriter(now_ms=self.clock.now_ms())
+
+        def write(_: Any) -> Any:
+            # Offenders only ever leave the snapshot, so all of these were just gathered.
+            pending = backend.snapshot.names() if backend.snapshot is not None else None
+            return self._defer_to_thread(self._write_snapshot, writer, path, pending)
+
+        def saved(result: Tuple[int, Optional[Snapshot]]) -> None:
+            count, reloaded = result
+            backend.replace_snapshot(reloaded)
+            logger.info(f'Saved {count} offenders to {path} '
+                        f'in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+        def failed(failure: Any) -> None:
+            logger.error(f'Failed to save a snapshot to {path}',
+                         exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
+        def done(_: Any) -> None:
+            self._saving = None
+
+        saving = self._cooperate(backend.collect(writer)).whenDone()
+        saving.addCallback(write)
+        saving.addCallback(saved)
+        saving.addErrback(failed)
+        # Set before done is added, in case everything above has already finished.
+        self._saving = saving
+        saving.addBoth(done)
+        return saving
+
+    @staticmethod
+    def _write_snapshot(writer: SnapshotWriter, path: str,
+                        pending: Optional[Set[str]]) -> Tuple[int, Optional[Snapshot]]:
+        count = writer.write(path)
+        reloaded = Snapshot(path, now_ms=writer.now_ms, only=pending) if pending else None
+        return count, reloaded
+
+    def _check_weights(self, config: Config) -> None:
+        if self._storage != 'compact':
+            return
+
+        for offence_config in (config.offences.text_spam, config.offences.media_spam,
+                               config.offences.mentions, config.offences.mass_mentions):
+            if offence_config.weight > MAX_COMPACT_WEIGHT:
+                raise ValueError(f'Offence weights must be at most {MAX_COMPACT_WEIGHT} '
+                                 'with compact storage')
+
+    def _apply_config(self, config: Config) -> None:
+        self._check_weights(config)
+        self.config = config
+
+        tracing = config.tracing
+        if tracing.slow_event_ms is None:
+            self.tracer = None
+        elif self.tracer is None or self.tracer.cap != tracing.buffer_size:
+            self.tracer = SlowEventTracer(threshold_seconds=tracing.slow_event_ms / 1000,
+                                          cap=tracing.buffer_size)
+        else:
+            # Keep what's been traced so far.
+            self.tracer.threshold_seconds = tracing.slow_event_ms / 1000
+
+        self.decisions = DecisionTable(config)
+
+        self.include_rooms = PatternMatcher(config.rooms.include)
+        self.exclude_rooms = PatternMatcher(config.rooms.exclude)
+        self.exclude_members = PatternMatcher(config.members.exclude)
+
+        self._server_suffix = f':{self.server_name}'
+        self._full_user = f'@{config.user.user}{self._server_suffix}'
+
+        # Whether a room is moderated / a sender is exempt only depends on the config, and the
+        # same rooms and senders show up over and over.
+        self.room_decisions: LruCache[str, bool] = LruCache(cap=config.rooms.cache_size)
+        self.sender_decisions: LruCache[str, bool] = LruCache(cap=config.members.cache_size)
+
+    def reload_config(self, config: Config) -> None:
+        """Switches to a new config, dropping any decisions made under the old one.
+
+        Room and member filters and offence rules take effect immediately. If the new offence
+        weights can't be stored with the offence storage in use, ValueError is raised and the old
+        config is kept. The settings in STARTUP_SETTINGS are only read at startup, so changes to
+        them are logged and replaced with the values in use.
+        """
+        if config.user.homeserver is None:
+            config.user.homeserver = self.config.user.homeserver
+
+        for path in STARTUP_SETTINGS:
+            *parents, name = path.split('.')
+            old_parent, new_parent = self.config, config
+            for parent in parents:
+                old_parent, new_parent = getattr(old_parent, parent), getattr(new_parent, parent)
+
+            old_value = getattr(old_parent, name)
+            if getattr(new_parent, name) != old_value:
+                logger.warning(f'Ignoring the change to {path}, it only applies after a restart')
+                setattr(new_parent, name, old_value)
+
+        self._apply_config(config)
 
     def _gc_callback(self) -> None:
-        to_remove: Set[str] = set()
+        start = time.perf_counter()
 
-        for offender, data in self.offenders.items():
-            data.offences.clear_expired()
-            if data.offences:
-                if self._classify_offences(data.offences) == OffenceListClassifier.OKAY:
-                    data.state = OffenderState.OKAY
-            else:
-                to_remove.add(offender)
+        swept, removed = self.backend.gc(now_ms=self.clock.now_ms(),
+                                         limits=self.config.offences.limits)
 
-        for offender in to_remove:
-            del self.offenders[offender]
+        self.last_gc = GcStats(swept=swept,
+                               removed=removed,
+                               duration_seconds=time.perf_counter() - start)
+        self._gc_seconds.observe(self.last_gc.duration_seconds)
+        self._gc_swept.inc(swept)
+        self._gc_removed.inc(removed)
+        if swept:
+            logger.info(f'GC swept {swept} offenders, removed {removed} '
+                        f'in {self.last_gc.duration_seconds * 1000:.1f}ms')
 
     @property
     def full_user(self) -> str:
-        return f'@{self.config.user.user}:{self.api.hs.config.server_name}'
+        return self._full_user
 
     @staticmethod
     def parse_config(data: Dict[str, Any]) -> Config:
         return Config.from_data(data)
 
-    def _make_offence(self, origin: datetime, config: OffenceConfig) -> Offence:
-        return Offence(weight=config.weight,
-                       expiration=origin + timedelta(minutes=config.expires_minutes))
-
-    def _classify_offences(self, offences: OffenceList) -> OffenceListClassifier:
-        return offences.classify(spam_limit=self.config.offences.limits.spam,
-                                 ban_limit=self.config.offences.limits.ban)
+    def _is_room_moderated(self, room_id: str) -> bool:
+        return (room_id.endswith(self._server_suffix) and self.include_rooms.matches(room_id)
+                and not self.exclude_rooms.matches(room_id) and room_id != self.config.log.room
+                and room_id != self.config.mjolnir.room)
+
+    def _is_sender_exempt(self, sender: str) -> bool:
+        return self.exclude_members.matches(sender) or sender == self._full_user
+
+    def _record_ignored(self, event: Dict[str, Any], start: float) -> None:
+        elapsed = time.perf_counter() - start
+        self._filter_seconds.observe(elapsed)
+        self._total_seconds.observe(elapsed)
+        self._ignored_counter.inc()
+
+        if self.tracer is not None and elapsed >= self.tracer.threshold_seconds:
+            self._trace(event, 'ignored', None, elapsed, 0, 0)
+
+    def _trace(self, event: Dict[str, Any], outcome: str, mentions: Optional[int],
+               filter_seconds: float, mentions_seconds: float, classify_seconds: float) -> None:
+        assert self.tracer is not None
+
+        content = event.get('content', {})
+        body_size = sum(
+            len(value) for value in (content.get('body'), content.get('formatted_body'))
+            if isinstance(value, str))
+
+        self.tracer.record(
+            SlowEvent(event_id=optional_safe_cast(str, event.get('event_id')),
+                      room=safe_cast(str, event['room_id']),
+                      msgtype=optional_safe_cast(str, content.get('msgtype')),
+                      body_size=body_size,
+                      mentions=mentions,
+                      outcome=outcome,
+                      filter_seconds=filter_seconds,
+                      mentions_seconds=mentions_seconds,
+                      classify_seconds=classify_seconds,
+                      total_seconds=filter_seconds + mentions_seconds + classify_seconds))
+
+    def _handle_command(self, event: Dict[str, Any]) -> None:
+        if event.get('sender') == self._full_user:
+            return
+
+        body = optional_safe_cast(str, event.get('content', {}).get('body'))
+        if body is None or body.split() != [COMMAND_PREFIX, 'slow']:
+            return
+
+        if self.tracer is None:
+            text = 'Slow event tracing is disabled, set tracing.slow_event_ms to enable it.'
+            formatted = ''
+        else:
+            text, formatted = format_slow_events(self.tracer)
+
+        self.matrix.send_message(text,
+                                 room=self.config.mjolnir.room,
+                                 formatted=formatted,
+                                 notice=True,
+                                 priority=Priority.LOG)
 
     def check_event_for_spam(self, event: Dict[str, Any]) -> bool:
         event_type = optional_safe_cast(str, event.get('type'))
-        if event_type != 'm.room.message':
+        if event_type == 'm.room.member':
+            if (event.get('state_key') == self._full_user
+                    and event['content'].get('membership') in ('leave', 'ban')):
+                self.matrix.forget_room(safe_cast(str, event['room_id']))
             return False
+        elif event_type != 'm.room.message':
+            return False
+
+        start = time.perf_counter()
+        # Read once, so a reload part way through doesn't mix two configs.
+        decisions = self.decisions
 
         room_id = safe_cast(str, event['room_id'])
-        if (not room_id.endswith(f':{self.api.hs.config.server_name}')
-                or self.include_rooms.match(room_id) is None
-                or self.exclude_rooms.match(room_id) is not None or room_id == self.config.log.room
-                or room_id == self.config.mjolnir.room):
+        moderated = self.room_decisions.get(room_id)
+        if moderated is None:
+            moderated = self._is_room_moderated(room_id)
+            self.room_decisions.put(room_id, moderated)
+        if not moderated:
+            if room_id == self.config.mjolnir.room:
+                self._handle_command(event)
+
+            self._record_ignored(event, start)
             return False
 
         sender = safe_cast(str, event['sender'])
-        if (self.exclude_members.match(sender) is not None or sender == self.full_user):
+        exempt = self.sender_decisions.get(sender)
+        if exempt is None:
+            exempt = self._is_sender_exempt(sender)
+            self.sender_decisions.put(sender, exempt)
+        if exempt:
+            self._record_ignored(event, start)
             return False
 
-        ms = safe_cast(int, event['origin_server_ts'])
-        timestamp = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+        filtered = time.perf_counter()
+        self._filter_seconds.observe(filtered - start)
 
-        offence: Optional[Offence] = None
+        timestamp = safe_cast(int, event['origin_server_ts'])
+
+        mentions: Optional[int] = None
         content_type = safe_cast(str, event['content']['msgtype'])
 
-        if content_type == 'm.text':
+        if content_type == 'm.text' and decisions.mention_limit:
             formatted_body = optional_safe_cast(str, event['content'].get('formatted_body'))
-
             if formatted_body is not None:
-                if self.config.offences.mentions.enabled or self.config.offences.mass_mentions.enabled:
-                    mentions = get_mention_count(
-                        formatted_body,
-                        limit=self.config.offences.mass_mentions.upgrade_at
-                        if self.config.offences.mass_mentions.enabled else 1)
-                    if (self.config.offences.mass_mentions.enabled
-                            and mentions == self.config.offences.mass_mentions.upgrade_at):
-                        offence = self._make_offence(timestamp, self.config.offences.mass_mentions)
-                    elif self.config.offences.mentions.enabled and mentions:
-                        offence = self._make_offence(timestamp, self.config.offences.mentions)
-
-        if offence is None:
-            if content_type in ('m.image', 'm.audio', 'm.video'):
-                offence_config = self.config.offences.media_spam
-            else:
-                offence_config = self.config.offences.text_spam
-
-            if offence_config.enabled:
-                offence = self._make_offence(timestamp, offence_config)
-
-        if offence is not None:
-            data = self.offenders[sender]
-            data.offences.push(offence)
-            data.offences.clear_expired()
-
-            classifier = self._classify_offences(data.offences)
+                mentions = get_mention_count(formatted_body,
+                                             limit=decisions.mention_limit,
+                                             max_length=decisions.mention_scan_length)
+
+        parsed = time.perf_counter()
+        self._mentions_seconds.observe(parsed - filtered)
+
+        rule = decisions.rule_for(content_type, mentions)
+
+        classifier = OffenceListClassifier.OKAY
+        if rule is not None:
+            classifier, previous = self.backend.push_and_classify(
+                sender,
+                Offence(expiration_ms=timestamp + rule.duration_ms, weight=rule.weight),
+                now_ms=self.clock.now_ms(),
+                limits=decisions.limits,
+                history_size=decisions.history_size,
+                duration_ms=rule.duration_ms)
+
             if classifier == OffenceListClassifier.BAN:
-                if data.state < OffenderState.BANNED:
+                if previous < OffenderState.BANNED:
                     logger.info(f'Ban on {sender} room {room_id}')
-                    self.matrix.send_message(f'{sender} was banned for spam in {room_id}',
-                                             room=self.config.log.room,
-                                             notice=True)
+                    self.matrix.send_log_notice(LogNotice(sender, 'was banned for spam', room_id))
                     self.mjolnir.ban(sender)
-                    data.state = OffenderState.BANNED
-                return True
             elif classifier == OffenceListClassifier.SPAM:
-                if data.state < OffenderState.ALERTED:
+                if previous < OffenderState.ALERTED:
                     logger.info(f'Spam on {sender} from {room_id}')
-                    self.matrix.send_message(f'{sender} was submitting spam in {room_id}',
-                                             room=self.config.log.room,
-                                             notice=True)
+                    self.matrix.send_log_notice(LogNotice(sender, 'was submitting spam', room_id))
 
-                    alert = f'{sender} {self.config.offences.spam_alert}'
+                    alert = f'{sender} {decisions.spam_alert}'
                     formatted = (f'<a href="https://matrix.to/#/{sender}">{sender}</a>'
-                                 f' {self.config.offences.spam_alert}')
+                                 f' {decisions.spam_alert}')
                     self.matrix.send_message(alert, room=room_id, formatted=formatted)
-                    data.state = OffenderState.ALERTED
-                return True
-            else:
-                data.state = OffenderState.OKAY
 
-        return False
+        end = time.perf_counter()
+        self._classify_seconds.observe(end - parsed)
+        self._total_seconds.observe(end - start)
+        self._outcome_counters[classifier].inc()
+
+        if self.tracer is not None and end - start >= self.tracer.threshold_seconds:
+            self._trace(event, classifier.name.lower(), mentions, filtered - start,
+                        parsed - filtered, end - parsed)
+
+        return classifier != OffenceListClassifier.OKAY
+
+    async def _check_event_for_spam_async(self, event: 'EventBase') -> bool:
+        return self.check_event_for_spam(event.get_dict())
 
     def user_may_invite(self, inviter_user_id: str, invitee_user_id: str, room_id: str) -> bool:
         return True
@@ -166,3 +535,20 @@ class AntiSpam:
 
     def user_may_publish_room(self, user_id: str, room_id: str) -> bool:
         return True
+
+
+class AntiSpamModule(AntiSpam):
+    """The spam checker, as listed under modules in Synapse's config.
+
+    check_event_for_spam is registered as an async module callback. This must not be used under
+    spam_checker, where Synapse calls check_event_for_spam itself and every event would be
+    counted twice.
+    """
+    def __init__(self,
+                 config: Config,
+                 api: 'ModuleApi',
+                 *,
+                 clock: Optional[Clock] = None,
+                 matrix: Optional[Matrix] = None):
+        super().__init__(config, api, clock=clock, matrix=matrix)
+        api.register_spam_checker_callbacks(check_event_for_spam=self._check_event_for_spam_async)
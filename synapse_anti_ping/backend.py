@@ -0,0 +1,435 @@
+from typing import *
+
+import abc
+import collections
+import contextlib
+import itertools
+import sqlite3
+
+from .config import Limits
+from .expiry_index import ExpiryIndex
+from .offender import (BaseOffenceList, Offence, OffenceListClassifier, Offender, OffenderState,
+                       OffenderTable, classify_weight)
+from .sketch import WindowedCountMinSketch
+from .snapshot import Snapshot, SnapshotEntry, SnapshotWriter
+
+# How many of the longest idle offenders are compared when evicting one.
+EVICTION_SAMPLE = 5
+# How many offenders MemoryBackend.collect adds to a snapshot between yields.
+COLLECT_BATCH = 1000
+
+
+def next_state(state: OffenderState, classifier: OffenceListClassifier) -> OffenderState:
+    if classifier == OffenceListClassifier.BAN:
+        return OffenderState.BANNED
+    elif classifier == OffenceListClassifier.SPAM:
+        return OffenderState.ALERTED if state < OffenderState.ALERTED else state
+    else:
+        return OffenderState.OKAY
+
+
+class OffenderBackend(abc.ABC):
+    """Where offenders' offences and states are kept.
+
+    push_and_classify must be atomic: when several processes share a backend, exactly one of them
+    sees an offender's state move up to ALERTED or BANNED, so only that one acts on it.
+    """
+    @abc.abstractmethod
+    def push_and_classify(
+            self,
+            sender: str,
+            offence: Offence,
+            *,
+            now_ms: int,
+            limits: Limits,
+            history_size: int,
+            duration_ms: Optional[int] = None) -> Tuple[OffenceListClassifier, OffenderState]:
+        """Adds an offence and clears expired ones, returning the sender's new classification
+        along with the state it had beforehand. The state is updated to match the
+        classification. duration_ms is how long the offence lasts from when it was committed,
+        which decaying scores need."""
+        ...
+
+    @abc.abstractmethod
+    def gc(self, *, now_ms: int, limits: Limits) -> Tuple[int, int]:
+        """Clears expired offences, returning how many offenders were revisited and how many
+        were removed because none were left."""
+        ...
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    def offence_count(self) -> int:
+        """Returns how many offences are held across every offender."""
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(OffenderBackend):
+    """Keeps offenders in this process, optionally seeded lazily from a snapshot.
+
+    Given an admission sketch, senders that aren't tracked yet only have their weight estimated
+    by the sketch, and are tracked exactly once the estimate reaches ``promote_at`` times the spam
+    limit. The estimate they had is carried over as a single offence, so promotion doesn't give
+    them a clean slate.
+
+    Given ``max_offenders``, tracking a new sender past that many evicts another one. OKAY
+    offenders go first, then ALERTED, then BANNED; within each, the lowest weight among the few
+    that have gone longest without sending anything.
+    """
+    def __init__(self,
+                 offence_list_type: Callable[[int], BaseOffenceList],
+                 *,
+                 snapshot: Optional[Snapshot] = None,
+                 admission: Optional[WindowedCountMinSketch] = None,
+                 promote_at: float = 0.5,
+                 max_offenders: Optional[int] = None) -> None:
+        if max_offenders is not None and max_offenders <= 0:
+            raise ValueError(f'Offender cap must be positive, not {max_offenders}')
+
+        self._offence_list_type = offence_list_type
+        self.admission = admission
+        self._promote_at = promote_at
+        # Senders moved from the sketch to exact tracking.
+        self.promoted = 0
+
+        self.max_offenders = max_offenders
+        # Only kept with a cap: offenders in each state, least recently pushed to first.
+        self._eviction_order: Dict[OffenderState, 'collections.OrderedDict[str, None]'] = {
+            state: collections.OrderedDict()
+            for state in OffenderState
+        }
+        self.evicted: Dict[OffenderState, int] = {state: 0 for state in OffenderState}
+        # Set on every push, so offenders created by it use the current history size.
+        self._history_size = 0
+
+        self.offenders = OffenderTable(self._new_offender)
+        # Kept up to date on every change, so it's cheap to read.
+        self._offence_count = 0
+        self.expiry_index: ExpiryIndex[str] = ExpiryIndex()
+        # Offenders from the last snapshot that haven't sent anything since.
+        self.snapshot = snapshot
+
+    def _new_offender(self, sender: str) -> Offender:
+        offender = Offender(self._offence_list_type(self._history_size))
+
+        if self.snapshot is not None:
+            saved = self.snapshot.pop(sender)
+            if saved is not None:
+                offender.state, offences = saved
+                for offence in offences:
+                    offender.offences.push(offence)
+                self._offence_count += len(offender.offences)
+
+        return offender
+
+    def push_and_classify(
+            self,
+            sender: str,
+            offence: Offence,
+            *,
+            now_ms: int,
+            limits: Limits,
+            history_size: int,
+            duration_ms: Optional[int] = None) -> Tuple[OffenceListClassifier, OffenderState]:
+        self._history_size = history_size
+
+        seed = None
+        if (self.admission is not None and sender not in self.offenders
+                and (self.snapshot is None or sender not in self.snapshot)):
+            if offence.expired(now_ms):
+                return OffenceListClassifier.OKAY, OffenderState.OKAY
+
+            estimate = int(self.admission.add(sender, offence.weight, now_ms))
+            if estimate < limits.spam * self._promote_at:
+                return OffenceListClassifier.OKAY, OffenderState.OKAY
+
+            self.promoted += 1
+            if estimate > offence.weight:
+                seed = Offence(expiration_ms=offence.expiration_ms,
+                               weight=estimate - offence.weight)
+
+        data = self.offenders[sender]
+        held = len(data.offences)
+        if seed is not None:
+            data.offences.push(seed, duration_ms)
+        data.offences.push(offence, duration_ms)
+        data.offences.clear_expired(now_ms)
+        self._offence_count += len(data.offences) - held
+
+        if not data.offences:
+            # Only possible if the event was already older than its offence's duration.
+            del self.offenders[sender]
+            self.expiry_index.remove(sender)
+            if self.max_offenders is not None:
+                self._eviction_order[data.state].pop(sender, None)
+            return OffenceListClassifier.OKAY, data.state
+
+        self.expiry_index.schedule(sender, data.offences.oldest.expiration_ms)
+
+        classifier = data.offences.classify(spam_limit=limits.spam, ban_limit=limits.ban)
+        previous = data.state
+        data.state = next_state(previous, classifier)
+
+        if self.max_offenders is not None:
+            self._touch(sender, previous, data.state)
+            if len(self.offenders) > self.max_offenders:
+                self._evict(sender)
+
+        return classifier, previous
+
+    def _touch(self, sender: str, previous: OffenderState, state: OffenderState) -> None:
+        if previous != state:
+            self._eviction_order[previous].pop(sender, None)
+        order = self._eviction_order[state]
+        order[sender] = None
+        order.move_to_end(sender)
+
+    def _evict(self, keep: str) -> None:
+        for state in OffenderState:
+            order = self._eviction_order[state]
+            victim = None
+            victim_weight = 0
+            for sender in itertools.islice(order, EVICTION_SAMPLE):
+                if sender == keep:
+                    continue
+                weight = self.offenders[sender].offences.total_weight
+                if victim is None or weight < victim_weight:
+                    victim, victim_weight = sender, weight
+
+            if victim is not None:
+                del order[victim]
+                data = self.offenders.pop(victim)
+                self.expiry_index.remove(victim)
+                self._offence_count -= len(data.offences)
+                self.evicted[state] += 1
+                return
+
+    def gc(self, *, now_ms: int, limits: Limits) -> Tuple[int, int]:
+        expired = self.expiry_index.pop_expired(now_ms)
+        removed = 0
+
+        for offender in expired:
+            data = self.offenders.get(offender)
+            if data is None:
+                continue
+
+            held = len(data.offences)
+            data.offences.clear_expired(now_ms)
+            self._offence_count += len(data.offences) - held
+            if data.offences:
+                if (data.offences.classify(spam_limit=limits.spam,
+                                           ban_limit=limits.ban) == OffenceListClassifier.OKAY):
+                    if self.max_offenders is not None and data.state != OffenderState.OKAY:
+                        self._touch(offender, data.state, OffenderState.OKAY)
+                    data.state = OffenderState.OKAY
+                self.expiry_index.schedule(offender, data.offences.oldest.expiration_ms)
+            else:
+                del self.offenders[offender]
+                if self.max_offenders is not None:
+                    self._eviction_order[data.state].pop(offender, None)
+                removed += 1
+
+        return len(expired), removed
+
+    def entries(self) -> Iterator[SnapshotEntry]:
+        """Yields every offender, including ones still waiting in the snapshot."""
+        for sender, data in self.offenders.items():
+            yield sender, data.state, data.offences
+        if self.snapshot is not None:
+            yield from self.snapshot.entries()
+
+    def collect(self, writer: SnapshotWriter) -> Iterator[None]:
+        """Adds every offender to the writer like entries, yielding after each batch so that
+        other work can run in between.
+
+        Only names are copied up front; offenders gone by the time their batch comes up are
+        skipped. Ones still waiting in the snapshot come first, so one that sends something
+        part way through is added again with its current offences, and that later copy is the
+        one a snapshot reads back.
+        """
+        if self.snapshot is not None:
+            yield from self._collect(writer, self.snapshot.names(), self.snapshot.get)
+        yield from self._collect(writer, list(self.offenders), self._get_entry)
+
+    @staticmethod
+    def _collect(
+            writer: SnapshotWriter, names: Iterable[str],
+            get: Callable[[str], Optional[Tuple[OffenderState,
+                                                Iterable[Offence]]]]) -> Iterator[None]:
+        for i, name in enumerate(names, 1):
+            entry = get(name)
+            if entry is not None:
+                writer.add(name, *entry)
+            if i % COLLECT_BATCH == 0:
+                yield
+
+    def _get_entry(self, sender: str) -> Optional[Tuple[OffenderState, Iterable[Offence]]]:
+        data = self.offenders.get(sender)
+        return None if data is None else (data.state, data.offences)
+
+    def replace_snapshot(self, snapshot: Optional[Snapshot]) -> None:
+        """Closes the current snapshot, swapping in a newer one holding the offenders that were
+        still waiting in it; any popped since that was saved are dropped from it."""
+        if self.snapshot is not None:
+            if snapshot is not None:
+                snapshot.retain(self.snapshot)
+            self.snapshot.close()
+
+        if snapshot is not None and not snapshot:
+            snapshot.close()
+            snapshot = None
+        self.snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self.offenders)
+
+    def offence_count(self) -> int:
+        return self._offence_count
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS offences (
+    sender TEXT NOT NULL,
+    expiration_ms INTEGER NOT NULL,
+    weight INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS offences_sender ON offences (sender, expiration_ms);
+CREATE INDEX IF NOT EXISTS offences_expiration ON offences (expiration_ms);
+
+-- Offenders without a row here are OKAY.
+CREATE TABLE IF NOT EXISTS offenders (
+    sender TEXT PRIMARY KEY,
+    state INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- A single row, kept up to date by every write so that reading it doesn't scan offences.
+CREATE TABLE IF NOT EXISTS counts (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    offenders INTEGER NOT NULL,
+    offences INTEGER NOT NULL
+);
+'''
+
+
+class SqliteBackend(OffenderBackend):
+    """Keeps offenders in a SQLite database, which every worker process on the host can share.
+
+    The database is opened in WAL mode, and each push holds the write lock for the whole
+    read-modify-write, so concurrent workers never both see the same state change.
+
+    Every call blocks the calling thread, which in Synapse is the reactor's: a push waits up to
+    ``timeout_seconds`` for another worker's write lock, then for its own commit. The offender
+    and offence counts are kept in the database as it's written, and read back at the end of each
+    push and GC, so they may be read from any thread (e.g. for metrics) without touching the
+    connection, which only the thread that opened it may use.
+    """
+    def __init__(self, path: str, *, timeout_seconds: float = 5) -> None:
+        # Transactions are managed by hand, since pushes need BEGIN IMMEDIATE.
+        self._db = sqlite3.connect(path, timeout=timeout_seconds, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Losing the last few offences on power loss is fine, an fsync per message isn't.
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction() as db:
+            for statement in _SCHEMA.split(';'):
+                db.execute(statement)
+            if db.execute('SELECT 1 FROM counts').fetchone() is None:
+                # Created just now, or by a version that didn't keep counts.
+                db.execute(
+                    'INSERT INTO counts SELECT 0, COUNT(DISTINCT sender), COUNT(*) FROM offences')
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, rather than failing to upgrade a read lock
+        # when another process got there first.
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+            # (offenders, offences), including every other worker's writes so far.
+            self._counts: Tuple[int, int] = self._db.execute(
+                'SELECT offenders, offences FROM counts').fetchone()
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        else:
+            self._db.execute('COMMIT')
+
+    def push_and_classify(
+            self,
+            sender: str,
+            offence: Offence,
+            *,
+            now_ms: int,
+            limits: Limits,
+            history_size: int,
+            duration_ms: Optional[int] = None) -> Tuple[OffenceListClassifier, OffenderState]:
+        with self._transaction() as db:
+            db.execute('INSERT INTO offences VALUES (?, ?, ?)',
+                       (sender, offence.expiration_ms, offence.weight))
+            deleted = db.execute('DELETE FROM offences WHERE sender = ? AND expiration_ms < ?',
+                                 (sender, now_ms)).rowcount
+            # Like the in-memory lists, a full history drops the offences closest to expiring.
+            deleted += db.execute(
+                '''DELETE FROM offences WHERE rowid IN (
+                       SELECT rowid FROM offences WHERE sender = ?
+                       ORDER BY expiration_ms DESC LIMIT -1 OFFSET ?)''',
+                (sender, history_size)).rowcount
+
+            count, weight = db.execute(
+                'SELECT COUNT(*), TOTAL(weight) FROM offences WHERE sender = ?',
+                (sender, )).fetchone()
+            held = count - 1 + deleted
+            db.execute('UPDATE counts SET offenders = offenders + ?, offences = offences + ?',
+                       (bool(count) - bool(held), count - held))
+            row = db.execute('SELECT state FROM offenders WHERE sender = ?', (sender, )).fetchone()
+            previous = OffenderState(row[0]) if row is not None else OffenderState.OKAY
+
+            if not count:
+                db.execute('DELETE FROM offenders WHERE sender = ?', (sender, ))
+                return OffenceListClassifier.OKAY, previous
+
+            classifier = classify_weight(int(weight), spam_limit=limits.spam, ban_limit=limits.ban)
+            state = next_state(previous, classifier)
+            if state != previous:
+                db.execute('INSERT OR REPLACE INTO offenders VALUES (?, ?)', (sender, state.value))
+
+        return classifier, previous
+
+    def gc(self, *, now_ms: int, limits: Limits) -> Tuple[int, int]:
+        with self._transaction() as db:
+            # Only looks at expired offences, and at the unexpired ones of their senders.
+            swept, removed = db.execute(
+                '''SELECT COUNT(*), SUM(NOT EXISTS (
+                       SELECT 1 FROM offences AS kept
+                       WHERE kept.sender = expired.sender AND kept.expiration_ms >= ?))
+                   FROM (SELECT DISTINCT sender FROM offences WHERE expiration_ms < ?)
+                       AS expired''', (now_ms, now_ms)).fetchone()
+            if not swept:
+                return 0, 0
+
+            deleted = db.execute('DELETE FROM offences WHERE expiration_ms < ?',
+                                 (now_ms, )).rowcount
+            db.execute('UPDATE counts SET offenders = offenders - ?, offences = offences - ?',
+                       (removed, deleted))
+
+            # Weights only drop through expiry, so anyone left below the spam limit has calmed
+            # down, and anyone with nothing left is gone.
+            db.execute(
+                '''DELETE FROM offenders WHERE (
+                       SELECT TOTAL(weight) FROM offences WHERE offences.sender = offenders.sender
+                   ) < ?''', (limits.spam, ))
+
+        return swept, removed
+
+    def __len__(self) -> int:
+        return self._counts[0]
+
+    def offence_count(self) -> int:
+        return self._counts[1]
+
+    def close(self) -> None:
+        self._db.close()
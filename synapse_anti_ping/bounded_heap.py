@@ -0,0 +1,55 @@
+from typing import *
+
+import heapq
+
+_T = TypeVar('_T')
+
+
+class BoundedHeap(Generic[_T]):
+    """A min-heap that holds at most ``cap`` items.
+
+    The storage is a plain list, so the C ``heapq`` functions can be used directly, and it only
+    grows as items are pushed. Once the heap is full, pushing evicts the smallest item (which may
+    be the pushed item itself), so the heap always keeps the ``cap`` largest items it has seen.
+    """
+    def __init__(self, *, cap: int) -> None:
+        if cap <= 0:
+            raise ValueError(f'Heap capacity must be positive, not {cap}')
+
+        self._cap = cap
+        self._storage: List[_T] = []
+
+    def push(self, item: _T) -> Optional[_T]:
+        """Push an item, returning the item that was evicted to make room for it, if any."""
+        if len(self._storage) < self._cap:
+            heapq.heappush(self._storage, item)
+            return None
+
+        return heapq.heappushpop(self._storage, item)
+
+    def pop(self) -> _T:
+        if not self._storage:
+            raise IndexError('pop from empty heap')
+
+        return heapq.heappop(self._storage)
+
+    @property
+    def top(self) -> _T:
+        return self._storage[0]
+
+    @property
+    def full(self) -> bool:
+        return len(self._storage) == self._cap
+
+    @property
+    def cap(self) -> int:
+        return self._cap
+
+    def __len__(self) -> int:
+        return len(self._storage)
+
+    def __iter__(self) -> Iterator[_T]:
+        yield from iter(self._storage)
+
+    def __bool__(self) -> bool:
+        return bool(self._storage)
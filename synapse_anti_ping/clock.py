@@ -0,0 +1,31 @@
+from typing import *
+
+import abc
+import time
+
+
+class Clock(abc.ABC):
+    """The source of the current time for the offence pipeline, in epoch milliseconds."""
+    @abc.abstractmethod
+    def now_ms(self) -> int:
+        ...
+
+
+class SystemClock(Clock):
+    def now_ms(self) -> int:
+        return int(time.time() * 1000)
+
+
+class VirtualClock(Clock):
+    """A clock that only moves when told to, for replaying events and for tests."""
+    def __init__(self, now_ms: int = 0) -> None:
+        self._now_ms = now_ms
+
+    def now_ms(self) -> int:
+        return self._now_ms
+
+    def set(self, now_ms: int) -> None:
+        self._now_ms = now_ms
+
+    def advance(self, ms: int) -> None:
+        self._now_ms += ms
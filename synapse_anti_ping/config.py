@@ -3,6 +3,8 @@ from typing import *
 from dataclasses import dataclass
 
 import dataclasses
+import functools
+import marshmallow
 import marshmallow.validate
 import marshmallow_dataclass
 
@@ -12,11 +14,21 @@ class MjolnirConfig:
     room: str
     banlist: str
     prefix: str = '!mjolnir'
+    dedup_minutes: float = dataclasses.field(
+        default=60, metadata={'validate': marshmallow.validate.Range(min=0)})
+    batch_size: int = dataclasses.field(default=20,
+                                        metadata={'validate': marshmallow.validate.Range(min=1)})
+    flush_seconds: float = dataclasses.field(
+        default=1, metadata={'validate': marshmallow.validate.Range(min=0)})
 
 
 @dataclass
 class LogConfig:
     room: str
+    digest_seconds: float = dataclasses.field(
+        default=5, metadata={'validate': marshmallow.validate.Range(min=0)})
+    digest_size: int = dataclasses.field(default=50,
+                                         metadata={'validate': marshmallow.validate.Range(min=1)})
 
 
 @dataclass
@@ -28,6 +40,83 @@ class UserConfig:
     homeserver: Optional[str] = None
 
 
+@dataclass
+class RateLimitConfig:
+    # Applies to everything antiping sends. Disabled unless set, since antiping's user should be
+    # exempt from Synapse's rate limits.
+    per_second: Optional[float] = dataclasses.field(
+        default=None, metadata={'validate': marshmallow.validate.Range(min=0, min_inclusive=False)})
+    burst: int = dataclasses.field(default=10,
+                                   metadata={'validate': marshmallow.validate.Range(min=1)})
+    # Applies to each room separately. Disabled unless set.
+    room_per_second: Optional[float] = dataclasses.field(
+        default=None, metadata={'validate': marshmallow.validate.Range(min=0, min_inclusive=False)})
+    room_burst: int = dataclasses.field(default=10,
+                                        metadata={'validate': marshmallow.validate.Range(min=1)})
+    backoff_seconds: float = dataclasses.field(
+        default=1, metadata={'validate': marshmallow.validate.Range(min=0)})
+    max_backoff_seconds: float = dataclasses.field(
+        default=60, metadata={'validate': marshmallow.validate.Range(min=0)})
+    max_retries: int = dataclasses.field(default=5,
+                                         metadata={'validate': marshmallow.validate.Range(min=0)})
+    max_in_flight: int = dataclasses.field(default=4,
+                                           metadata={'validate': marshmallow.validate.Range(min=1)})
+    max_queued: int = dataclasses.field(default=1000,
+                                        metadata={'validate': marshmallow.validate.Range(min=1)})
+
+
+@dataclass
+class SpoolConfig:
+    # Disabled unless set.
+    path: Optional[str] = None
+    sync_seconds: float = dataclasses.field(
+        default=0.2, metadata={'validate': marshmallow.validate.Range(min=0)})
+    compact_at: int = dataclasses.field(default=1000,
+                                        metadata={'validate': marshmallow.validate.Range(min=1)})
+
+
+@dataclass
+class SnapshotConfig:
+    # Disabled unless set.
+    path: Optional[str] = None
+    interval_minutes: float = dataclasses.field(
+        default=5, metadata={'validate': marshmallow.validate.Range(min=0, min_inclusive=False)})
+
+
+@dataclass
+class SketchConfig:
+    enabled: bool = False
+    # Counters per row; memory use is 8 bytes * width * depth.
+    width: int = dataclasses.field(default=1 << 20,
+                                   metadata={'validate': marshmallow.validate.Range(min=1)})
+    depth: int = dataclasses.field(default=4,
+                                   metadata={'validate': marshmallow.validate.Range(min=1)})
+    # Fraction of the spam limit a sender's estimate must reach before it's tracked exactly.
+    promote_at: float = dataclasses.field(
+        default=0.5, metadata={'validate': marshmallow.validate.Range(min=0, max=1)})
+
+
+@dataclass
+class TracingConfig:
+    # Disabled unless set.
+    slow_event_ms: Optional[float] = dataclasses.field(
+        default=None, metadata={'validate': marshmallow.validate.Range(min=0)})
+    buffer_size: int = dataclasses.field(default=100,
+                                         metadata={'validate': marshmallow.validate.Range(min=1)})
+
+
+@dataclass
+class BackendConfig:
+    # 'memory' keeps offenders in each process; 'sqlite' shares them between worker processes.
+    type: str = dataclasses.field(
+        default='memory', metadata={'validate': marshmallow.validate.OneOf(['memory', 'sqlite'])})
+    # The database file for the sqlite backend.
+    path: Optional[str] = None
+    # The most senders the memory backend tracks at once. Unlimited unless set.
+    max_offenders: Optional[int] = dataclasses.field(
+        default=None, metadata={'validate': marshmallow.validate.Range(min=1)})
+
+
 @dataclass
 class BanConfig:
     redactions: int
@@ -37,7 +126,7 @@ class BanConfig:
 @dataclass
 class OffenceConfig:
     enabled: bool
-    weight: int
+    weight: int = dataclasses.field(metadata={'validate': marshmallow.validate.Range(min=0)})
     expires_minutes: float
 
 
@@ -54,15 +143,22 @@ class Limits:
 
 @dataclass
 class OffencesConfig:
-    text_spam: OffenceConfig = OffenceConfig(enabled=True, weight=2, expires_minutes=0.4)
-    media_spam: OffenceConfig = OffenceConfig(enabled=True, weight=4, expires_minutes=0.5)
-    mentions: OffenceConfig = OffenceConfig(enabled=True, weight=4, expires_minutes=0.5)
-    mass_mentions: MassMentionsConfig = MassMentionsConfig(enabled=True,
-                                                           weight=10,
-                                                           expires_minutes=1)
+    text_spam: OffenceConfig = dataclasses.field(
+        default_factory=lambda: OffenceConfig(enabled=True, weight=2, expires_minutes=0.4))
+    media_spam: OffenceConfig = dataclasses.field(
+        default_factory=lambda: OffenceConfig(enabled=True, weight=4, expires_minutes=0.5))
+    mentions: OffenceConfig = dataclasses.field(
+        default_factory=lambda: OffenceConfig(enabled=True, weight=4, expires_minutes=0.5))
+    mass_mentions: MassMentionsConfig = dataclasses.field(
+        default_factory=lambda: MassMentionsConfig(enabled=True, weight=10, expires_minutes=1))
     spam_alert: str = 'Stop spamming.'
-    limits: Limits = Limits()
+    mention_scan_length: int = dataclasses.field(
+        default=65536, metadata={'validate': marshmallow.validate.Range(min=1)})
+    limits: Limits = dataclasses.field(default_factory=Limits)
     history_size: int = 20
+    storage: str = dataclasses.field(
+        default='heap',
+        metadata={'validate': marshmallow.validate.OneOf(['heap', 'compact', 'decay'])})
     gc_interval_minutes: int = 5
 
 
@@ -70,11 +166,15 @@ class OffencesConfig:
 class RoomsConfig:
     exclude: List[str] = dataclasses.field(default_factory=lambda: [])
     include: List[str] = dataclasses.field(default_factory=lambda: ['*'])
+    cache_size: int = dataclasses.field(default=10000,
+                                        metadata={'validate': marshmallow.validate.Range(min=1)})
 
 
 @dataclass
 class MembersConfig:
     exclude: List[str] = dataclasses.field(default_factory=lambda: [])
+    cache_size: int = dataclasses.field(default=100000,
+                                        metadata={'validate': marshmallow.validate.Range(min=1)})
 
 
 @dataclass
@@ -83,12 +183,25 @@ class Config:
     log: LogConfig
     user: UserConfig
 
-    rooms: RoomsConfig = RoomsConfig()
-    members: MembersConfig = MembersConfig()
+    # Nested defaults are built per config, so changing one config never changes another.
+    rooms: RoomsConfig = dataclasses.field(default_factory=RoomsConfig)
+    members: MembersConfig = dataclasses.field(default_factory=MembersConfig)
+
+    offences: OffencesConfig = dataclasses.field(default_factory=OffencesConfig)
 
-    offences: OffencesConfig = OffencesConfig()
+    ratelimit: RateLimitConfig = dataclasses.field(default_factory=RateLimitConfig)
+    spool: SpoolConfig = dataclasses.field(default_factory=SpoolConfig)
+    snapshot: SnapshotConfig = dataclasses.field(default_factory=SnapshotConfig)
+    backend: BackendConfig = dataclasses.field(default_factory=BackendConfig)
+    tracing: TracingConfig = dataclasses.field(default_factory=TracingConfig)
+    sketch: SketchConfig = dataclasses.field(default_factory=SketchConfig)
 
     @staticmethod
     def from_data(data: Mapping[str, Any]) -> 'Config':
-        ConfigSchema = marshmallow_dataclass.class_schema(Config)
-        return ConfigSchema().load(data)  # type: ignore
+        return _config_schema().load(data)  # type: ignore
+
+
+@functools.lru_cache(maxsize=None)
+def _config_schema() -> marshmallow.Schema:
+    # Building the schema is much slower than loading with it, and it never changes.
+    return marshmallow_dataclass.class_schema(Config)()
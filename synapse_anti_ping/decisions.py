@@ -0,0 +1,78 @@
+from typing import *
+
+from .config import Config, Limits, OffenceConfig
+
+MEDIA_MSGTYPES = ('m.image', 'm.audio', 'm.video')
+
+
+class OffenceRule:
+    """The offence a message gets: its weight, and how long until it expires."""
+    __slots__ = ('weight', 'duration_ms')
+
+    def __init__(self, *, weight: int, duration_ms: int) -> None:
+        self.weight = weight
+        self.duration_ms = duration_ms
+
+    @staticmethod
+    def compile(config: OffenceConfig) -> Optional['OffenceRule']:
+        if not config.enabled:
+            return None
+
+        return OffenceRule(weight=config.weight,
+                           duration_ms=int(config.expires_minutes * 60 * 1000))
+
+
+class DecisionTable:
+    """Everything checking a message needs from the config, worked out ahead of time.
+
+    A table is never changed once compiled, so a new config is applied by swapping in a whole new
+    table, and a check that read the old one carries on with it consistently.
+    """
+    __slots__ = ('mention_limit', 'mention_scan_length', 'mention_rules', 'msgtype_rules',
+                 'text_rule', 'limits', 'history_size', 'spam_alert')
+
+    def __init__(self, config: Config) -> None:
+        offences = config.offences
+
+        mentions = OffenceRule.compile(offences.mentions)
+        mass_mentions = OffenceRule.compile(offences.mass_mentions)
+
+        # Mentions are counted up to mention_limit, which is where mass mentions start. If mass
+        # mentions are disabled, only whether there are any matters.
+        if mass_mentions is not None:
+            self.mention_limit = offences.mass_mentions.upgrade_at
+        elif mentions is not None:
+            self.mention_limit = 1
+        else:
+            # Mentions aren't counted at all.
+            self.mention_limit = 0
+        self.mention_scan_length = offences.mention_scan_length
+
+        # Indexed by the mention count; None falls back to the message type's rule.
+        mention_rules: List[Optional[OffenceRule]] = [None]
+        mention_rules += [mentions] * self.mention_limit
+        if mass_mentions is not None:
+            mention_rules[-1] = mass_mentions
+        self.mention_rules: Tuple[Optional[OffenceRule], ...] = tuple(mention_rules)
+
+        self.text_rule = OffenceRule.compile(offences.text_spam)
+        media = OffenceRule.compile(offences.media_spam)
+        # Anything not in here uses text_rule.
+        self.msgtype_rules: Dict[str, Optional[OffenceRule]] = {
+            msgtype: media
+            for msgtype in MEDIA_MSGTYPES
+        }
+
+        self.limits: Limits = offences.limits
+        self.history_size = offences.history_size
+        self.spam_alert = offences.spam_alert
+
+    def rule_for(self, msgtype: str, mentions: Optional[int]) -> Optional[OffenceRule]:
+        """Returns the offence for a message of the given type, with the given number of
+        mentions if they were counted."""
+        if mentions is not None:
+            rule = self.mention_rules[mentions]
+            if rule is not None:
+                return rule
+
+        return self.msgtype_rules.get(msgtype, self.text_rule)
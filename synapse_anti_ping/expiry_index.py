@@ -0,0 +1,80 @@
+from typing import *
+
+import heapq
+
+_K = TypeVar('_K')
+
+
+class ExpiryIndex(Generic[_K]):
+    """Tracks when each key next needs attention, grouped into fixed-width time buckets.
+
+    Each key lives in exactly one bucket, chosen from the expiration it was last scheduled with.
+    ``pop_expired`` only visits buckets whose whole range has passed, so the cost of a sweep is
+    proportional to the number of keys that actually expired rather than the number of keys
+    tracked. Keys may be reported up to one bucket width late.
+    """
+    def __init__(self, *, resolution_ms: int = 1000) -> None:
+        if resolution_ms <= 0:
+            raise ValueError(f'Resolution must be positive, not {resolution_ms}')
+
+        self._resolution_ms = resolution_ms
+        self._buckets: Dict[int, Set[_K]] = {}
+        # May contain stale or duplicate bucket numbers, which are skipped when popped.
+        self._bucket_heap: List[int] = []
+        self._scheduled: Dict[_K, int] = {}
+
+    def _bucket_for(self, expiration_ms: int) -> int:
+        # Bucket N holds expirations in [(N - 1) * resolution, N * resolution), so it is fully
+        # expired once the time reaches N * resolution.
+        return expiration_ms // self._resolution_ms + 1
+
+    def _discard(self, key: _K, bucket: int) -> None:
+        keys = self._buckets[bucket]
+        keys.discard(key)
+        if not keys:
+            del self._buckets[bucket]
+
+    def schedule(self, key: _K, expiration_ms: int) -> None:
+        bucket = self._bucket_for(expiration_ms)
+        current = self._scheduled.get(key)
+        if current == bucket:
+            return
+
+        if current is not None:
+            self._discard(key, current)
+
+        self._scheduled[key] = bucket
+
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = set()
+            heapq.heappush(self._bucket_heap, bucket)
+
+        keys.add(key)
+
+    def remove(self, key: _K) -> None:
+        bucket = self._scheduled.pop(key, None)
+        if bucket is not None:
+            self._discard(key, bucket)
+
+    def pop_expired(self, now_ms: int) -> List[_K]:
+        """Remove and return every key whose scheduled expiration is before ``now_ms``."""
+        expired: List[_K] = []
+
+        while self._bucket_heap and self._bucket_heap[0] * self._resolution_ms <= now_ms:
+            bucket = heapq.heappop(self._bucket_heap)
+            keys = self._buckets.pop(bucket, None)
+            if keys is None:
+                continue
+
+            for key in keys:
+                del self._scheduled[key]
+            expired.extend(keys)
+
+        return expired
+
+    def __contains__(self, key: _K) -> bool:
+        return key in self._scheduled
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
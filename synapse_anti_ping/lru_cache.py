@@ -0,0 +1,54 @@
+from typing import *
+
+import collections
+
+_K = TypeVar('_K')
+_V = TypeVar('_V')
+
+
+class LruCache(Generic[_K, _V]):
+    """A mapping that holds at most ``cap`` entries, dropping the least recently used first."""
+    def __init__(self, *, cap: int) -> None:
+        if cap <= 0:
+            raise ValueError(f'Cache capacity must be positive, not {cap}')
+
+        self._cap = cap
+        self._data: 'collections.OrderedDict[_K, _V]' = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: _K) -> Optional[_V]:
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+
+        return value
+
+    def put(self, key: _K, value: _V) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self._cap:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def cap(self) -> int:
+        return self._cap
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: _K) -> bool:
+        return key in self._data
@@ -1,34 +1,204 @@
 from typing import *
 
+from dataclasses import dataclass
+
 import asyncio
+import collections
 import concurrent.futures
-import contextlib
+import dataclasses
+import functools
+import html
 import logging
+import random
 import threading
+import time
 
-import nio
+if TYPE_CHECKING:
+    import nio
 
 from .config import Config
+from .metrics import Metrics
+from .send_scheduler import Priority, PriorityStats, SendDropped, SendScheduler
+from .spool import Spool
+from .token_bucket import TokenBucket
 
 logger = logging.getLogger('synapse_anti_ping.Matrix')
 
+# concurrent.futures.Future when running on the private thread, asyncio.Future on the reactor.
+SendFuture = Union['concurrent.futures.Future[None]', 'asyncio.Future[None]']
+
+
+def reactor_event_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """Returns the asyncio loop driving Twisted's reactor, if it's the asyncio reactor."""
+    from twisted.internet import reactor  # type: ignore
+    return cast(Optional[asyncio.AbstractEventLoop], getattr(reactor, '_asyncioEventloop', None))
+
+
+class SendFailed(Exception):
+    """Raised once a message has failed more than ratelimit.max_retries times."""
+
+
+def backoff_delay(attempt: int, *, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+@dataclass(frozen=True)
+class LogNotice:
+    user: str
+    # e.g. 'was banned for spam'
+    action: str
+    room: str
+
+    @property
+    def message(self) -> str:
+        return f'{self.user} {self.action} in {self.room}'
+
+
+def format_log_digest(notices: List[LogNotice]) -> Tuple[str, str]:
+    """Returns the plain text and HTML bodies of a digest message for the notices."""
+    header = f'{len(notices)} notices merged:'
+    text = '\n'.join([header] + [notice.message for notice in notices])
+
+    rows = ''.join(f'<tr><td>{html.escape(notice.user)}</td><td>{html.escape(notice.action)}</td>'
+                   f'<td>{html.escape(notice.room)}</td></tr>' for notice in notices)
+    formatted = (f'<p>{header}</p><table><tr><th>User</th><th>Action</th><th>Room</th></tr>'
+                 f'{rows}</table>')
+
+    return text, formatted
+
 
 class Matrix:
-    def __init__(self, config: Config) -> None:
-        self._loop = asyncio.get_event_loop()
+    """Sends messages as antiping's user.
+
+    Given the loop Synapse's reactor runs on, everything is scheduled straight onto it and
+    send_message must be called from the reactor thread. Otherwise, the client gets its own loop
+    on a private thread.
+    """
+    def __init__(self,
+                 config: Config,
+                 *,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 metrics: Optional[Metrics] = None) -> None:
+        self._on_reactor = loop is not None
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
         self._thread = threading.Thread(target=self._run)
         self._thread.daemon = True  # so ctrl-c cleanly exits
-        self._init_event = asyncio.Event()
 
         self._config = config
 
+        # Only touched from the loop.
+        # (notice, spool record ID)
+        self._pending_log_notices: List[Tuple[LogNotice, Optional[int]]] = []
+        self._log_flush_handle: Optional[asyncio.TimerHandle] = None
+        # Notices flushed while an earlier digest is still queued are added to it.
+        self._queued_log_notices: Optional[List[Tuple[LogNotice, Optional[int]]]] = None
+        self.merged_log_notices = 0
+
+        # Sends wait here until login completes.
+        self._scheduler = SendScheduler(max_in_flight=config.ratelimit.max_in_flight,
+                                        max_queued=config.ratelimit.max_queued,
+                                        loop=self._loop)
+
+        self._global_bucket: Optional[TokenBucket] = None
+        if config.ratelimit.per_second is not None:
+            self._global_bucket = TokenBucket(rate=config.ratelimit.per_second,
+                                              burst=config.ratelimit.burst,
+                                              now=self._loop.time())
+        self._room_buckets: Dict[str, TokenBucket] = {}
+
+        if metrics is None:
+            metrics = Metrics()
+        self._room_send_seconds = metrics.histogram('room_send_seconds',
+                                                    'Time taken by each attempt to send a message')
+        for priority in Priority:
+            metrics.gauge('send_queue_depth',
+                          'Messages waiting to be sent, by priority',
+                          functools.partial(self._queue_depth, priority),
+                          priority=priority.name.lower())
+
+        # Rooms the bot is known to be in, so sends don't need to join first.
+        self._joined_rooms: Set[str] = set()
+
+        self._spool: Optional[Spool] = None
+        if config.spool.path is not None:
+            # On the reactor, the disk mustn't hold up Synapse.
+            self._spool = Spool(config.spool.path,
+                                compact_at=config.spool.compact_at,
+                                background=self._on_reactor)
+        self._spool_sync_handle: Optional[asyncio.TimerHandle] = None
+
         assert config.user.homeserver is not None
-        self._client = nio.AsyncClient(config.user.homeserver, config.user.user)
+        # nio is slow to import, so it's left until the client is created on the loop, once
+        # started.
+        self._client: Optional['nio.AsyncClient'] = None
 
     def start(self) -> None:
-        self._thread.start()
+        if self._on_reactor:
+            logger.info('Starting on the reactor loop')
+            asyncio.ensure_future(self._initialize(), loop=self._loop)
+        else:
+            self._thread.start()
+
+        self.call_soon(self._replay_spool)
+
+    def spool_append(self, record: Dict[str, Any]) -> Optional[int]:
+        """Saves a record of outbound work, returning its ID if the spool is enabled.
+
+        Records have a 'kind' key, which decides who replays them on startup. Must be called
+        from the loop, as must spool_ack.
+        """
+        if self._spool is None:
+            return None
+
+        record_id = self._spool.append(record)
+        self._schedule_spool_sync()
+        return record_id
+
+    def spool_ack(self, record_id: Optional[int]) -> None:
+        if self._spool is None or record_id is None:
+            return
+
+        self._spool.ack(record_id)
+        self._schedule_spool_sync()
+
+    def spooled(self, kind: str) -> List[Tuple[int, Dict[str, Any]]]:
+        if self._spool is None:
+            return []
+
+        return [(record_id, record) for record_id, record in self._spool.pending()
+                if record['kind'] == kind]
+
+    def _schedule_spool_sync(self) -> None:
+        if not self._config.spool.sync_seconds:
+            self._sync_spool()
+        elif self._spool_sync_handle is None:
+            self._spool_sync_handle = self._loop.call_later(self._config.spool.sync_seconds,
+                                                            self._sync_spool)
+
+    def _sync_spool(self) -> None:
+        self._spool_sync_handle = None
+        if self._spool is not None:
+            self._spool.sync()
+
+    def _replay_spool(self) -> None:
+        messages = self.spooled('message')
+        notices = self.spooled('log_notice')
+        if messages or notices:
+            logger.info(f'Replaying {len(messages)} messages and {len(notices)} log notices')
+
+        for record_id, record in messages:
+            asyncio.ensure_future(self._send_spooled(record['send'], record_id), loop=self._loop)
+        for record_id, record in notices:
+            self._queue_log_notice(LogNotice(**record['notice']), record_id)
 
     async def _initialize(self) -> None:
+        import nio
+
+        if self._client is None:
+            assert self._config.user.homeserver is not None
+            self._client = nio.AsyncClient(self._config.user.homeserver, self._config.user.user)
+
         logger.info('Matrix thread logging in')
         while True:
             result = await self._client.login(self._config.user.password)
@@ -40,21 +210,69 @@ class Matrix:
 
             break
 
+        joined = await self._client.joined_rooms()
+        if isinstance(joined, nio.JoinedRoomsError):
+            logger.warning(f'Failed to get joined rooms: {joined}')
+        else:
+            self._joined_rooms.update(joined.rooms)
+
         logger.info('Matrix thread joining rooms')
-        await self._client.join(self._config.mjolnir.room)
-        if self._config.mjolnir.room != self._config.log.room:
-            await self._client.join(self._config.log.room)
+        await self._join(self._config.mjolnir.room)
+        await self._join(self._config.log.room)
 
         logger.info('Matrix thread initialized')
-        self._init_event.set()
+        self._scheduler.start()
+
+    async def _join(self, room: str) -> None:
+        import nio
+
+        if room in self._joined_rooms:
+            return
 
-    async def _complete_send_message(self, message: str, *, room: str, formatted: str, notice: bool,
-                                     join: bool) -> None:
-        logger.info(f'Waiting to ensure init is complete')
-        await self._init_event.wait()
+        assert self._client is not None
+        response = await self._client.join(room)
+        if isinstance(response, nio.JoinError):
+            logger.warning(f'Failed to join {room}: {response}')
+        else:
+            self._joined_rooms.add(room)
+
+    def forget_room(self, room: str) -> None:
+        """Marks the bot as no longer in the room, e.g. after it was kicked."""
+        self.call_soon(self._joined_rooms.discard, room)
 
-        if join:
-            await self._client.join(room)
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def call_soon(self, callback: Callable[..., None], *args: Any) -> None:
+        """Runs callback on the loop. Safe to call from the reactor thread in either mode."""
+        if self._on_reactor:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def send_stats(self, priority: Priority) -> PriorityStats:
+        return self._scheduler.stats(priority)
+
+    def _queue_depth(self, priority: Priority) -> float:
+        return self.send_stats(priority).queued
+
+    async def send_message_async(self,
+                                 message: str,
+                                 *,
+                                 room: str,
+                                 formatted: str = '',
+                                 notice: bool = False,
+                                 join: bool = True,
+                                 priority: Priority = Priority.ALERT) -> None:
+        """Like send_message, but must be awaited on the loop."""
+        await self._scheduler.submit(
+            priority,
+            lambda: self._send(message, room=room, formatted=formatted, notice=notice, join=join))
+
+    async def _send(self, message: str, *, room: str, formatted: str, notice: bool,
+                    join: bool) -> None:
+        import nio
 
         logger.info(f'Completing send message command')
 
@@ -67,8 +285,76 @@ class Matrix:
             content['format'] = 'org.matrix.custom.html'
             content['formatted_body'] = formatted
 
-        await self._client.room_send(  # type: ignore
-            room_id=room, message_type='m.room.message', content=content)
+        ratelimit = self._config.ratelimit
+        # Every retry backs off further, but only errors other than rate limiting count towards
+        # max_retries.
+        retries = 0
+        failures = 0
+        while True:
+            if join:
+                await self._join(room)
+
+            await self._wait_for_ratelimit(room)
+
+            start = time.perf_counter()
+            assert self._client is not None
+            try:
+                response = await self._client.room_send(  # type: ignore
+                    room_id=room, message_type='m.room.message', content=content)
+            except Exception as ex:
+                response = nio.ErrorResponse(str(ex))
+            self._room_send_seconds.observe(time.perf_counter() - start)
+
+            if not isinstance(response, nio.ErrorResponse):
+                return
+
+            if response.status_code == 'M_FORBIDDEN':
+                # Most likely kicked since joining, so try joining again.
+                self._joined_rooms.discard(room)
+
+            if response.status_code == 'M_LIMIT_EXCEEDED':
+                # Rate limited sends are always retried, so bans don't get lost in a flood.
+                if response.retry_after_ms is not None:
+                    delay = response.retry_after_ms / 1000
+                    delay += random.uniform(0, delay * 0.1)
+                else:
+                    delay = backoff_delay(retries,
+                                          base=ratelimit.backoff_seconds,
+                                          cap=ratelimit.max_backoff_seconds)
+            else:
+                failures += 1
+                if failures > ratelimit.max_retries:
+                    logger.error(f'Giving up on message to {room}: {response}')
+                    raise SendFailed(f'Message to {room} failed: {response}')
+
+                delay = backoff_delay(retries,
+                                      base=ratelimit.backoff_seconds,
+                                      cap=ratelimit.max_backoff_seconds)
+
+            retries += 1
+            logger.warning(f'Message to {room} failed, retrying in {delay:.1f}s: {response}')
+            await asyncio.sleep(delay)
+
+    async def _wait_for_ratelimit(self, room: str) -> None:
+        ratelimit = self._config.ratelimit
+        now = self._loop.time()
+
+        delay = 0.0
+        if self._global_bucket is not None:
+            delay = self._global_bucket.reserve(now)
+
+        if ratelimit.room_per_second is not None:
+            room_bucket = self._room_buckets.get(room)
+            if room_bucket is None:
+                room_bucket = TokenBucket(rate=ratelimit.room_per_second,
+                                          burst=ratelimit.room_burst,
+                                          now=now)
+                self._room_buckets[room] = room_bucket
+
+            delay = max(delay, room_bucket.reserve(now))
+        if delay > 0:
+            logger.info(f'Waiting {delay:.1f}s to stay under the rate limit')
+            await asyncio.sleep(delay)
 
     def send_message(self,
                      message: str,
@@ -76,65 +362,225 @@ class Matrix:
                      room: str,
                      formatted: str = '',
                      notice: bool = False,
-                     join: bool = True) -> 'concurrent.futures.Future[None]':
+                     join: bool = True,
+                     priority: Priority = Priority.ALERT) -> SendFuture:
         logger.info(f'Message send in progress')
-        return asyncio.run_coroutine_threadsafe(
-            self._complete_send_message(message,
-                                        room=room,
-                                        formatted=formatted,
-                                        notice=notice,
-                                        join=join), self._loop)
+        coro = self._send_spooled({
+            'message': message,
+            'room': room,
+            'formatted': formatted,
+            'notice': notice,
+            'join': join,
+            'priority': int(priority),
+        })
+        if self._on_reactor:
+            return asyncio.ensure_future(coro, loop=self._loop)
+        else:
+            return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _send_spooled(self, send: Dict[str, Any], record_id: Optional[int] = None) -> None:
+        if record_id is None:
+            record_id = self.spool_append({'kind': 'message', 'send': send})
+
+        try:
+            await self.send_message_async(send['message'],
+                                          room=send['room'],
+                                          formatted=send['formatted'],
+                                          notice=send['notice'],
+                                          join=send['join'],
+                                          priority=Priority(send['priority']))
+        except SendDropped:
+            pass
+        except SendFailed:
+            # Left in the spool, so it's sent again on restart.
+            return
+
+        self.spool_ack(record_id)
+
+    def send_log_notice(self, notice: LogNotice) -> None:
+        """Sends a notice to the log room, merged with others sent within the digest window."""
+        if not self._config.log.digest_seconds:
+            self.send_message(notice.message,
+                              room=self._config.log.room,
+                              notice=True,
+                              priority=Priority.LOG)
+        else:
+            self.call_soon(self._queue_log_notice, notice)
 
-    def _run(self) -> None:
-        logger.info('Starting main loop')
+    def _queue_log_notice(self, notice: LogNotice, record_id: Optional[int] = None) -> None:
+        if record_id is None:
+            record_id = self.spool_append({
+                'kind': 'log_notice',
+                'notice': dataclasses.asdict(notice)
+            })
 
-        asyncio.ensure_future(self._initialize(), loop=self._loop)
-        self._loop.run_forever()
+        self._pending_log_notices.append((notice, record_id))
+
+        if len(self._pending_log_notices) >= self._config.log.digest_size:
+            self._flush_log_notices()
+        elif self._log_flush_handle is None:
+            self._log_flush_handle = self._loop.call_later(self._config.log.digest_seconds,
+                                                           self._flush_log_notices)
 
+    def _flush_log_notices(self) -> None:
+        if self._log_flush_handle is not None:
+            self._log_flush_handle.cancel()
+            self._log_flush_handle = None
 
-class EventLimiter:
-    class Inserter:
-        def __init__(self, key: str) -> None:
-            self.key = key
-            self.future: 'concurrent.futures.Future[None]'
+        entries = self._pending_log_notices
+        self._pending_log_notices = []
 
-        def insert(self, future: 'concurrent.futures.Future[None]') -> None:
-            assert self
-            self.future = future
+        if self._queued_log_notices is not None:
+            # The previous digest is still waiting to be sent, so just add to it.
+            self._queued_log_notices.extend(entries)
+            return
 
-        def __bool__(self) -> bool:
-            return bool(self.key)
+        self._queued_log_notices = entries
+        self._scheduler.submit(Priority.LOG, lambda: self._send_log_notices(entries))
 
-    def __init__(self) -> None:
-        self._active: Set[str] = set()
+    async def _send_log_notices(self, entries: List[Tuple[LogNotice, Optional[int]]]) -> None:
+        if self._queued_log_notices is entries:
+            self._queued_log_notices = None
 
-    @contextlib.contextmanager
-    def insert(self, key: str) -> 'Iterator[Inserter]':
-        if key in self._active:
-            yield EventLimiter.Inserter('')
+        notices = [notice for notice, _ in entries]
+
+        if len(notices) == 1:
+            text, formatted = notices[0].message, ''
         else:
-            inserter = EventLimiter.Inserter(key)
-            yield inserter
+            text, formatted = format_log_digest(notices)
+            self.merged_log_notices += len(notices)
+            logger.info(f'Merged {len(notices)} log notices into one digest')
+
+        try:
+            await self._send(text,
+                             room=self._config.log.room,
+                             formatted=formatted,
+                             notice=True,
+                             join=True)
+        except SendFailed:
+            # Left in the spool, so they're sent again on restart.
+            return
+
+        for _, record_id in entries:
+            self.spool_ack(record_id)
 
-            inserter.future.add_done_callback(lambda _: self._active.remove(key))
-            self._active.add(key)
+    def _run(self) -> None:
+        logger.info('Starting main loop')
+
+        asyncio.ensure_future(self._initialize(), loop=self._loop)
+        self._loop.run_forever()
 
 
 class Mjolnir:
+    """Queues bans for Mjolnir, sending them in batches at a bounded rate.
+
+    A user queued again within mjolnir.dedup_minutes is ignored. Up to mjolnir.batch_size users
+    are sent per batch, as one ban command each (Mjolnir takes a single user per command), waiting
+    mjolnir.flush_seconds between batches. A batch's commands are all handed to the send scheduler
+    at once, so up to ratelimit.max_in_flight of them are sent together. A ban that still fails
+    after ratelimit.max_retries stays in the spool, and isn't ignored if the user is queued again.
+    """
     def __init__(self, config: Config, matrix: Matrix) -> None:
         self._config = config
         self._matrix = matrix
 
-        self._in_progress_bans = EventLimiter()
+        # Only touched from Matrix's loop.
+        # (user, time queued, spool record ID)
+        self._pending: Deque[Tuple[str, float, Optional[int]]] = collections.deque()
+        # user -> time queued, oldest first.
+        self._recent: 'collections.OrderedDict[str, float]' = collections.OrderedDict()
+        # user -> spool record ID of a ban that failed, reused if they're banned again.
+        self._failed: Dict[str, Optional[int]] = {}
+        self._flushing = False
 
-    def ban(self, user: str) -> None:
-        with self._in_progress_bans.insert(user) as inserter:
-            if not inserter:
-                return
+        # Seconds from the first user in the latest batch being queued to the batch being sent.
+        self.last_flush_latency: Optional[float] = None
+        self.bans_sent = 0
 
-            logger.info(f'Ban on {user} in progress')
+        self._matrix.call_soon(self._replay_spool)
 
-            command = (f'{self._config.mjolnir.prefix} ban {self._config.mjolnir.banlist}'
-                       f' user {user} spam')
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
 
-            inserter.future = self._matrix.send_message(command, room=self._config.mjolnir.room)
+    def ban(self, user: str) -> None:
+        self._matrix.call_soon(self._queue_ban, user)
+
+    def _ban_command(self, user: str) -> str:
+        return (f'{self._config.mjolnir.prefix} ban {self._config.mjolnir.banlist}'
+                f' user {user} spam')
+
+    def _replay_spool(self) -> None:
+        bans = self._matrix.spooled('ban')
+        if bans:
+            logger.info(f'Replaying {len(bans)} bans')
+
+        for record_id, record in bans:
+            self._queue_ban(record['user'], record_id)
+
+    def _queue_ban(self, user: str, record_id: Optional[int] = None) -> None:
+        now = self._matrix.loop.time()
+
+        horizon = self._config.mjolnir.dedup_minutes * 60
+        while self._recent:
+            queued_at = next(iter(self._recent.values()))
+            if now - queued_at < horizon:
+                break
+            self._recent.popitem(last=False)
+
+        if user in self._recent:
+            self._matrix.spool_ack(record_id)
+            return
+
+        if record_id is None:
+            record_id = self._failed.pop(user, None)
+        if record_id is None:
+            record_id = self._matrix.spool_append({'kind': 'ban', 'user': user})
+
+        logger.info(f'Ban on {user} queued')
+        self._recent[user] = now
+        self._pending.append((user, now, record_id))
+
+        if not self._flushing:
+            self._flushing = True
+            asyncio.ensure_future(self._flush(), loop=self._matrix.loop)
+
+    async def _flush(self) -> None:
+        try:
+            while self._pending:
+                batch = [
+                    self._pending.popleft()
+                    for _ in range(min(self._config.mjolnir.batch_size, len(self._pending)))
+                ]
+                users = [user for user, _, _ in batch]
+                commands = [self._ban_command(user) for user in users]
+
+                logger.info(f'Sending {len(users)} bans, {len(self._pending)} still queued')
+                # Sent together, leaving the scheduler and rate limits to pace them.
+                sends = [
+                    self._matrix.send_message_async(command,
+                                                    room=self._config.mjolnir.room,
+                                                    priority=Priority.BAN) for command in commands
+                ]
+                results = await asyncio.gather(*sends, return_exceptions=True)
+
+                sent = 0
+                for (user, _, record_id), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        logger.error(f'Failed to send ban command for {user}', exc_info=result)
+                        # Left in the spool to be sent again on restart, and banning them again
+                        # before then isn't ignored.
+                        self._recent.pop(user, None)
+                        self._failed[user] = record_id
+                        continue
+
+                    self._matrix.spool_ack(record_id)
+                    sent += 1
+
+                self.bans_sent += sent
+                self.last_flush_latency = self._matrix.loop.time() - batch[0][1]
+
+                if self._pending:
+                    await asyncio.sleep(self._config.mjolnir.flush_seconds)
+        finally:
+            self._flushing = False
@@ -0,0 +1,208 @@
+from typing import *
+
+import bisect
+import math
+
+try:
+    from prometheus_client import REGISTRY  # type: ignore
+    from prometheus_client.core import (  # type: ignore
+        CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily)
+except ImportError:
+    REGISTRY = None
+
+PREFIX = 'synapse_anti_ping_'
+
+# Per-event stages take microseconds, sends and GC take milliseconds to seconds.
+EVENT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                 0.025, 0.1)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class CounterMetric:
+    __slots__ = ('value', )
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeMetric:
+    """A value read from a callback when the metrics are collected."""
+    __slots__ = ('_callback', )
+
+    def __init__(self, callback: Callable[[], float]) -> None:
+        self._callback = callback
+
+    @property
+    def value(self) -> float:
+        return self._callback()
+
+
+class HistogramMetric:
+    __slots__ = ('_bounds', '_counts', 'sum', 'count')
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self._bounds = tuple(bounds)
+        # The last count is for values above every bound.
+        self._counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """Returns the cumulative count for each upper bound, ending with infinity."""
+        result = []
+        total = 0
+        for bound, count in zip(self._bounds + (math.inf, ), self._counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+_Metric = Union[CounterMetric, GaugeMetric, HistogramMetric]
+
+
+class _Family(NamedTuple):
+    kind: str
+    doc: str
+    metrics: Dict[Labels, _Metric]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    """A set of metrics, each named family holding one metric per set of label values.
+
+    Metrics are plain attributes updated in place, so recording one is cheap enough for every
+    event. When prometheus_client is importable (as it always is inside Synapse), register() adds
+    them to its default registry, so they show up on Synapse's own metrics endpoint; render()
+    produces the same text format without it.
+    """
+    def __init__(self) -> None:
+        self._families: Dict[str, _Family] = {}
+
+    def _get(self, kind: str, name: str, doc: str, labels: Mapping[str, str],
+             factory: Callable[[], _Metric]) -> _Metric:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = _Family(kind, doc, {})
+        assert family.kind == kind, name
+
+        key = tuple(sorted(labels.items()))
+        metric = family.metrics.get(key)
+        if metric is None:
+            metric = family.metrics[key] = factory()
+        return metric
+
+    def counter(self, name: str, doc: str, **labels: str) -> CounterMetric:
+        return cast(CounterMetric, self._get('counter', name, doc, labels, CounterMetric))
+
+    def counter_from(self, name: str, doc: str, callback: Callable[[], float],
+                     **labels: str) -> GaugeMetric:
+        """A counter whose count is kept elsewhere, read from a callback when collected."""
+        return cast(GaugeMetric,
+                    self._get('counter', name, doc, labels, lambda: GaugeMetric(callback)))
+
+    def gauge(self, name: str, doc: str, callback: Callable[[], float],
+              **labels: str) -> GaugeMetric:
+        return cast(GaugeMetric, self._get('gauge', name, doc, labels,
+                                           lambda: GaugeMetric(callback)))
+
+    def histogram(self,
+                  name: str,
+                  doc: str,
+                  bounds: Sequence[float] = SECONDS_BUCKETS,
+                  **labels: str) -> HistogramMetric:
+        return cast(HistogramMetric,
+                    self._get('histogram', name, doc, labels, lambda: HistogramMetric(bounds)))
+
+    def families(self) -> Iterator[Tuple[str, _Family]]:
+        return iter(self._families.items())
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        for name, family in self._families.items():
+            full_name = PREFIX + name
+            lines.append(f'# HELP {full_name} {family.doc}')
+            lines.append(f'# TYPE {full_name} {family.kind}')
+
+            for labels, metric in family.metrics.items():
+                if isinstance(metric, HistogramMetric):
+                    for bound, count in metric.buckets():
+                        bucket_labels = labels + (('le', _format_value(bound)), )
+                        lines.append(f'{full_name}_bucket{_format_labels(bucket_labels)} {count}')
+                    lines.append(f'{full_name}_sum{_format_labels(labels)} '
+                                 f'{_format_value(metric.sum)}')
+                    lines.append(f'{full_name}_count{_format_labels(labels)} {metric.count}')
+                else:
+                    lines.append(f'{full_name}{_format_labels(labels)} '
+                                 f'{_format_value(metric.value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def register(self) -> bool:
+        """Adds these metrics to prometheus_client's default registry, returning whether it was
+        available. Metrics registered by an earlier instance are replaced."""
+        global _registered
+
+        if REGISTRY is None:
+            return False
+
+        if _registered is not None:
+            REGISTRY.unregister(_registered)
+            _registered = None
+
+        collector = _Collector(self)
+        REGISTRY.register(collector)
+        _registered = collector
+        return True
+
+
+class _Collector:
+    def __init__(self, metrics: Metrics) -> None:
+        self._metrics = metrics
+
+    def collect(self) -> Iterator[Any]:
+        for name, family in self._metrics.families():
+            full_name = PREFIX + name
+            label_names = [label for label, _ in next(iter(family.metrics), ())]
+
+            prometheus_family: Any
+            if family.kind == 'counter':
+                prometheus_family = CounterMetricFamily(full_name, family.doc, labels=label_names)
+            elif family.kind == 'gauge':
+                prometheus_family = GaugeMetricFamily(full_name, family.doc, labels=label_names)
+            else:
+                prometheus_family = HistogramMetricFamily(full_name, family.doc, labels=label_names)
+
+            for labels, metric in family.metrics.items():
+                label_values = [value for _, value in labels]
+                if isinstance(metric, HistogramMetric):
+                    buckets = [(_format_value(bound), count) for bound, count in metric.buckets()]
+                    prometheus_family.add_metric(label_values, buckets, metric.sum)
+                else:
+                    prometheus_family.add_metric(label_values, metric.value)
+
+            yield prometheus_family
+
+
+_registered: Optional[_Collector] = None
@@ -1,25 +1,22 @@
 from typing import *
 
-from dataclasses import dataclass
-from datetime import datetime, timezone
+import abc
+import array
+import bisect
 import enum
 import functools
+import math
 
-from .round_robin_heap import RoundRobinHeap
+from .bounded_heap import BoundedHeap
 
 
-@functools.total_ordering
-@dataclass(order=False)
-class Offence:
-    expiration: datetime
+class Offence(NamedTuple):
+    # A tuple so that heap comparisons stay in C; expiration comes first so it orders by that.
+    expiration_ms: int
     weight: int
 
-    @property
-    def expired(self) -> bool:
-        return datetime.now(tz=timezone.utc) > self.expiration
-
-    def __lt__(self, other: 'Offence') -> bool:
-        return self.expiration < other.expiration
+    def expired(self, now_ms: int) -> bool:
+        return now_ms > self.expiration_ms
 
 
 class OffenceListClassifier(enum.Enum):
@@ -28,38 +25,92 @@ class OffenceListClassifier(enum.Enum):
     BAN = 2
 
 
-class OffenceList:
-    def __init__(self, cap: int) -> None:
-        self._heap: RoundRobinHeap[Offence] = RoundRobinHeap(cap=cap)
+def classify_weight(weight: int, *, spam_limit: int, ban_limit: int) -> OffenceListClassifier:
+    assert spam_limit <= ban_limit
+
+    if weight >= ban_limit:
+        return OffenceListClassifier.BAN
+    elif weight >= spam_limit:
+        return OffenceListClassifier.SPAM
+    else:
+        return OffenceListClassifier.OKAY
+
+
+class BaseOffenceList(abc.ABC):
+    """The offences currently held against a single sender.
+
+    Subclasses decide how the offences are stored, but must keep ``total_weight`` up to date
+    without walking the offences, and must drop the offence closest to expiring once ``cap``
+    offences are being held.
+    """
+
+    __slots__ = ()
 
     @property
+    @abc.abstractmethod
     def total_weight(self) -> int:
-        return sum(offence.weight for offence in self._heap)
+        ...
 
     @property
+    @abc.abstractmethod
     def oldest(self) -> Offence:
-        return self._heap.top
+        ...
 
-    def push(self, offence: Offence) -> None:
-        self._heap.push(offence)
+    @abc.abstractmethod
+    def push(self, offence: Offence, duration_ms: Optional[int] = None) -> None:
+        """Adds an offence; duration_ms is how long it lasts from when it was committed, if
+        known."""
+        ...
 
+    @abc.abstractmethod
     def pop(self) -> Offence:
-        return self._heap.pop()
+        ...
 
-    def clear_expired(self) -> None:
-        while self and self.oldest.expired:
+    def clear_expired(self, now_ms: int) -> None:
+        while self and self.oldest.expired(now_ms):
             self.pop()
 
     def classify(self, *, spam_limit: int, ban_limit: int) -> OffenceListClassifier:
-        assert spam_limit <= ban_limit
+        return classify_weight(self.total_weight, spam_limit=spam_limit, ban_limit=ban_limit)
 
-        weight = self.total_weight
-        if weight >= ban_limit:
-            return OffenceListClassifier.BAN
-        elif weight >= spam_limit:
-            return OffenceListClassifier.SPAM
-        else:
-            return OffenceListClassifier.OKAY
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    def __iter__(self) -> Iterator[Offence]:
+        ...
+
+
+class OffenceList(BaseOffenceList):
+    __slots__ = ('_heap', '_total_weight')
+
+    def __init__(self, cap: int) -> None:
+        self._heap: BoundedHeap[Offence] = BoundedHeap(cap=cap)
+        # Kept in sync with the heap contents so classification doesn't need to walk the heap.
+        self._total_weight = 0
+
+    @property
+    def total_weight(self) -> int:
+        return self._total_weight
+
+    @property
+    def oldest(self) -> Offence:
+        return self._heap.top
+
+    def push(self, offence: Offence, duration_ms: Optional[int] = None) -> None:
+        evicted = self._heap.push(offence)
+        self._total_weight += offence.weight
+        if evicted is not None:
+            self._total_weight -= evicted.weight
+
+    def pop(self) -> Offence:
+        offence = self._heap.pop()
+        self._total_weight -= offence.weight
+        return offence
 
     def __bool__(self) -> bool:
         return bool(self._heap)
@@ -71,6 +122,242 @@ class OffenceList:
         yield from iter(self._heap)
 
 
+_WEIGHT_BITS = 16
+MAX_COMPACT_WEIGHT = (1 << _WEIGHT_BITS) - 1
+
+
+class CompactOffenceList(BaseOffenceList):
+    """An offence list that packs each offence into a single machine integer.
+
+    Every offence is stored as ``(expiration_ms << 16) | weight``, negated so
+    that the offence closest to expiring sits at the end of a sorted ``array``, where it can be
+    popped without moving anything else. The array starts empty and only grows as offences are
+    pushed, up to ``cap``.
+    """
+
+    __slots__ = ('_cap', '_packed', '_total_weight')
+
+    def __init__(self, cap: int) -> None:
+        self._cap = cap
+        self._packed = array.array('q')
+        self._total_weight = 0
+
+    @staticmethod
+    def _pack(offence: Offence) -> int:
+        if not 0 <= offence.weight <= MAX_COMPACT_WEIGHT:
+            raise ValueError(f'Offence weight {offence.weight} cannot be stored compactly')
+
+        return -((offence.expiration_ms << _WEIGHT_BITS) | offence.weight)
+
+    @staticmethod
+    def _unpack(packed: int) -> Offence:
+        packed = -packed
+        return Offence(expiration_ms=packed >> _WEIGHT_BITS, weight=packed & MAX_COMPACT_WEIGHT)
+
+    @property
+    def total_weight(self) -> int:
+        return self._total_weight
+
+    @property
+    def oldest(self) -> Offence:
+        return self._unpack(self._packed[-1])
+
+    def push(self, offence: Offence, duration_ms: Optional[int] = None) -> None:
+        packed = self._pack(offence)
+
+        if len(self._packed) == self._cap:
+            if packed >= self._packed[-1]:
+                # The new offence expires no later than everything else, so it's the one dropped.
+                return
+
+            self._total_weight -= -self._packed.pop() & MAX_COMPACT_WEIGHT
+
+        bisect.insort(self._packed, packed)
+        self._total_weight += offence.weight
+
+    def clear_expired(self, now_ms: int) -> None:
+        # Same as the base implementation, but without unpacking every offence checked.
+        packed = self._packed
+        while packed and -packed[-1] >> _WEIGHT_BITS < now_ms:
+            self._total_weight -= -packed.pop() & MAX_COMPACT_WEIGHT
+
+    def pop(self) -> Offence:
+        if not self._packed:
+            raise IndexError('pop from empty list')
+
+        offence = self._unpack(self._packed.pop())
+        self._total_weight -= offence.weight
+        return offence
+
+    def __bool__(self) -> bool:
+        return bool(self._packed)
+
+    def __len__(self) -> int:
+        return len(self._packed)
+
+    def __iter__(self) -> Iterator[Offence]:
+        for packed in reversed(self._packed):
+            yield self._unpack(packed)
+
+
+class DecayingScore(BaseOffenceList):
+    """A sender's offences folded into exponentially decaying scores, one per rule duration, so it
+    takes the same memory and time to update however many offences there are, and none are ever
+    dropped.
+
+    Each score decays with a half-life of ln 2 times its rule's duration, which gives the same
+    total as the offence lists for a sender offending at a steady rate. An offence pushed with its
+    duration joins that rule's score, its weight already decayed by how long ago it was committed
+    (expiration minus duration). Pushed offences are only folded in by the next clear_expired
+    call, since that's where the current time comes from.
+
+    Each score shows up as an offence expiring one duration after its last update, so snapshots
+    and expiry indexes work unchanged. Offences pushed without a duration, like those restored
+    from a snapshot, join the shortest lasting score that would still hold them, decayed to
+    match, or get a score of their own lasting however long they have left. Scores are dropped
+    once they've decayed below 1.
+    """
+
+    __slots__ = ('_scores', '_updated_ms', '_pending')
+
+    def __init__(self, cap: int) -> None:
+        # cap is unused, as nothing is ever dropped.
+        # Pairs of duration in milliseconds and score, one per rule; kept in an array so there
+        # aren't objects for each of them.
+        self._scores: Optional['array.array[float]'] = None
+        self._updated_ms = 0
+        # Pushed but not yet folded in, with their durations.
+        self._pending: Optional[List[Tuple[Offence, Optional[int]]]] = None
+
+    @property
+    def score(self) -> float:
+        """The total score as of the last clear_expired call."""
+        return sum(self._scores[1::2]) if self._scores else 0.0
+
+    @property
+    def total_weight(self) -> int:
+        pending = sum(offence.weight for offence, _ in self._pending) if self._pending else 0
+        return int(self.score) + pending
+
+    def _as_offence(self, i: int) -> Offence:
+        assert self._scores is not None
+        return Offence(expiration_ms=self._updated_ms + int(self._scores[i]),
+                       weight=int(self._scores[i + 1]))
+
+    def _shortest(self) -> int:
+        assert self._scores
+        return min(range(0, len(self._scores), 2), key=self._scores.__getitem__)
+
+    @property
+    def oldest(self) -> Offence:
+        if self._scores:
+            # They were all last updated together, so the shortest lasting expires first.
+            return self._as_offence(self._shortest())
+        elif self._pending:
+            return min(offence for offence, _ in self._pending)
+        else:
+            raise IndexError('empty score')
+
+    def push(self, offence: Offence, duration_ms: Optional[int] = None) -> None:
+        if self._pending is None:
+            self._pending = [(offence, duration_ms)]
+        else:
+            self._pending.append((offence, duration_ms))
+
+    def pop(self) -> Offence:
+        if self._scores:
+            i = self._shortest()
+            offence = self._as_offence(i)
+            del self._scores[i:i + 2]
+            if not self._scores:
+                self._scores = None
+        elif self._pending:
+            entry = min(self._pending, key=lambda entry: entry[0])
+            self._pending.remove(entry)
+            offence = entry[0]
+        else:
+            raise IndexError('empty score')
+        return offence
+
+    def clear_expired(self, now_ms: int) -> None:
+        scores = self._scores
+        if scores is not None and now_ms > self._updated_ms:
+            elapsed_ms = now_ms - self._updated_ms
+            i = 0
+            while i < len(scores):
+                # Halving every duration * ln 2.
+                score = scores[i + 1] * math.exp(-elapsed_ms / scores[i])
+                if score < 1:
+                    del scores[i:i + 2]
+                else:
+                    scores[i + 1] = score
+                    i += 2
+
+            if not scores:
+                scores = self._scores = None
+        self._updated_ms = max(self._updated_ms, now_ms)
+
+        pending = self._pending
+        if pending is not None:
+            if len(pending) > 1:
+                # Those with durations first, so the rest can join their scores.
+                pending.sort(key=lambda entry: entry[1] is None)
+            for offence, duration_ms in pending:
+                left_ms = offence.expiration_ms - now_ms
+                if left_ms <= 0 or not offence.weight:
+                    continue
+
+                if duration_ms is None:
+                    duration_ms = self._lasting(left_ms)
+                weight = offence.weight * math.exp(-max(0, duration_ms - left_ms) / duration_ms)
+                if scores is None:
+                    scores = self._scores = array.array('d', (duration_ms, weight))
+                else:
+                    self._add(scores, duration_ms, weight)
+            self._pending = None
+
+    def _lasting(self, left_ms: int) -> int:
+        """The shortest score duration of at least left_ms, or left_ms if there isn't one."""
+        lasting = None
+        if self._scores:
+            for i in range(0, len(self._scores), 2):
+                if left_ms <= self._scores[i] and (lasting is None or self._scores[i] < lasting):
+                    lasting = int(self._scores[i])
+        return left_ms if lasting is None else lasting
+
+    @staticmethod
+    def _add(scores: 'array.array[float]', duration_ms: int, weight: float) -> None:
+        # There's one score per rule, so this only looks through a handful.
+        for i in range(0, len(scores), 2):
+            if scores[i] == duration_ms:
+                scores[i + 1] += weight
+                return
+
+        scores.extend((duration_ms, weight))
+
+    def __bool__(self) -> bool:
+        return bool(self._scores or self._pending)
+
+    def __len__(self) -> int:
+        return ((len(self._scores) // 2 if self._scores else 0) +
+                (len(self._pending) if self._pending else 0))
+
+    def __iter__(self) -> Iterator[Offence]:
+        if self._scores:
+            for i in range(0, len(self._scores), 2):
+                yield self._as_offence(i)
+        if self._pending:
+            for offence, _ in self._pending:
+                yield offence
+
+
+OFFENCE_LIST_TYPES: Dict[str, Callable[[int], BaseOffenceList]] = {
+    'heap': OffenceList,
+    'compact': CompactOffenceList,
+    'decay': DecayingScore,
+}
+
+
 @functools.total_ordering
 class OffenderState(enum.Enum):
     OKAY = 0
@@ -81,7 +368,24 @@ class OffenderState(enum.Enum):
         return cast(int, self.value) < cast(int, other.value)
 
 
-@dataclass
 class Offender:
-    offences: OffenceList
-    state: OffenderState = OffenderState.OKAY
+    # Not a dataclass so that __slots__ can be used; there is one of these per tracked sender.
+    __slots__ = ('offences', 'state')
+
+    def __init__(self,
+                 offences: BaseOffenceList,
+                 state: OffenderState = OffenderState.OKAY) -> None:
+        self.offences = offences
+        self.state = state
+
+
+class OffenderTable(Dict[str, Offender]):
+    """Like a defaultdict, but the factory is given the missing sender."""
+    def __init__(self, factory: Callable[[str], Offender]) -> None:
+        super().__init__()
+        self._factory = factory
+
+    def __missing__(self, sender: str) -> Offender:
+        offender = self._factory(sender)
+        self[sender] = offender
+        return offender
@@ -0,0 +1,75 @@
+from typing import *
+
+from .utils import compile_pattern_alternatives
+
+_GLOB_CHARS = frozenset('*?[')
+
+
+class _Trie:
+    """Finds whether any stored string is a prefix of a given string."""
+
+    # Marks the end of a stored string; can't collide with a key, which is always one character.
+    _END = ''
+
+    def __init__(self) -> None:
+        self._root: Dict[str, Any] = {}
+
+    def add(self, s: str) -> None:
+        node = self._root
+        for c in s:
+            node = node.setdefault(c, {})
+        node[self._END] = True
+
+    def match_prefix(self, s: str) -> bool:
+        node = self._root
+        for c in s:
+            if self._END in node:
+                return True
+
+            child = node.get(c)
+            if child is None:
+                return False
+            node = child
+
+        return self._END in node
+
+    def __bool__(self) -> bool:
+        return bool(self._root)
+
+
+class PatternMatcher:
+    """Matches strings against a list of fnmatch-style patterns.
+
+    Gives the same results as compile_pattern_alternatives, but literal patterns are looked up in
+    a set and 'prefix*' / '*suffix' patterns in tries, so lookups don't slow down as those
+    patterns are added. Only patterns with other wildcards are combined into a regex.
+    """
+    def __init__(self, patterns: List[str]) -> None:
+        self._literals: Set[str] = set()
+        self._prefixes = _Trie()
+        self._reversed_suffixes = _Trie()
+
+        complex_patterns: List[str] = []
+        for pattern in patterns:
+            if not _GLOB_CHARS.intersection(pattern):
+                self._literals.add(pattern)
+                continue
+
+            if pattern.endswith('*') and not _GLOB_CHARS.intersection(pattern[:-1]):
+                self._prefixes.add(pattern[:-1])
+            elif pattern.startswith('*') and not _GLOB_CHARS.intersection(pattern[1:]):
+                self._reversed_suffixes.add(pattern[:0:-1])
+            else:
+                complex_patterns.append(pattern)
+
+        self._regex = compile_pattern_alternatives(complex_patterns) if complex_patterns else None
+
+    def matches(self, s: str) -> bool:
+        if s in self._literals:
+            return True
+        if self._prefixes and self._prefixes.match_prefix(s):
+            return True
+        if self._reversed_suffixes and self._reversed_suffixes.match_prefix(s[::-1]):
+            return True
+
+        return self._regex is not None and self._regex.match(s) is not None
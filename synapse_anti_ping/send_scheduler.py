@@ -0,0 +1,138 @@
+from typing import *
+
+from dataclasses import dataclass
+
+import asyncio
+import collections
+import enum
+import logging
+
+logger = logging.getLogger('synapse_anti_ping.send_scheduler')
+
+
+class SendDropped(Exception):
+    pass
+
+
+class Priority(enum.IntEnum):
+    # Lower values are sent first.
+    BAN = 0
+    LOG = 1
+    ALERT = 2
+
+
+@dataclass
+class PriorityStats:
+    queued: int = 0
+    sent: int = 0
+    dropped: int = 0
+    # Time spent queued, summed over every item that was sent.
+    total_wait_seconds: float = 0
+    max_wait_seconds: float = 0
+
+    @property
+    def mean_wait_seconds(self) -> float:
+        return self.total_wait_seconds / self.sent if self.sent else 0
+
+
+class _Item(NamedTuple):
+    send: Callable[[], Awaitable[None]]
+    future: 'asyncio.Future[None]'
+    queued_at: float
+
+
+class SendScheduler:
+    """Runs sends in priority order, with at most ``max_in_flight`` running at once.
+
+    Nothing runs until start() is called. Once ``max_queued`` sends are waiting, alerts are
+    dropped: a ban or log notice evicts the newest queued alert, and a new alert is dropped if
+    there's nothing to evict. Bans and log notices themselves are always queued, since they're
+    already batched and merged before getting here. Dropped sends fail with SendDropped.
+    """
+    def __init__(self, *, max_in_flight: int, max_queued: int,
+                 loop: asyncio.AbstractEventLoop) -> None:
+        self._max_in_flight = max_in_flight
+        self._max_queued = max_queued
+        self._loop = loop
+
+        self._queues: Dict[Priority,
+                           Deque[_Item]] = {priority: collections.deque()
+                                            for priority in Priority}
+        self._stats = {priority: PriorityStats() for priority in Priority}
+        self._queued = 0
+        self._in_flight = 0
+        self._started = False
+
+    def stats(self, priority: Priority) -> PriorityStats:
+        stats = self._stats[priority]
+        stats.queued = len(self._queues[priority])
+        return stats
+
+    def start(self) -> None:
+        self._started = True
+        self._dispatch()
+
+    def submit(self, priority: Priority, send: Callable[[],
+                                                        Awaitable[None]]) -> 'asyncio.Future[None]':
+        """Queues send, returning a future that completes once it has run.
+
+        Must be called from the loop.
+        """
+        future: 'asyncio.Future[None]' = self._loop.create_future()
+
+        if self._queued >= self._max_queued and not self._evict_alert(priority):
+            if priority == Priority.ALERT:
+                self._stats[priority].dropped += 1
+                logger.warning('Send queue is full, dropping alert')
+                future.set_exception(SendDropped())
+                return future
+
+        self._queues[priority].append(_Item(send, future, self._loop.time()))
+        self._queued += 1
+        self._dispatch()
+
+        return future
+
+    def _evict_alert(self, priority: Priority) -> bool:
+        queue = self._queues[Priority.ALERT]
+        if priority == Priority.ALERT or not queue:
+            return False
+
+        item = queue.pop()
+        self._queued -= 1
+        self._stats[Priority.ALERT].dropped += 1
+        logger.warning('Send queue is full, dropping a queued alert')
+        item.future.set_exception(SendDropped())
+        return True
+
+    def _dispatch(self) -> None:
+        if not self._started:
+            return
+
+        while self._in_flight < self._max_in_flight and self._queued:
+            priority, queue = next(
+                (priority, queue) for priority, queue in self._queues.items() if queue)
+            item = queue.popleft()
+            self._queued -= 1
+
+            wait = self._loop.time() - item.queued_at
+            stats = self._stats[priority]
+            stats.sent += 1
+            stats.total_wait_seconds += wait
+            stats.max_wait_seconds = max(stats.max_wait_seconds, wait)
+
+            self._in_flight += 1
+            asyncio.ensure_future(self._run(item), loop=self._loop)
+
+    async def _run(self, item: _Item) -> None:
+        try:
+            await item.send()
+        except Exception as ex:
+            if not item.future.done():
+                item.future.set_exception(ex)
+        else:
+            if not item.future.done():
+                item.future.set_result(None)
+        finally:
+            self._in_flight -= 1
+            self._dispatch()
@@ -0,0 +1,80 @@
+from typing import *
+
+import array
+
+
+class WindowedCountMinSketch:
+    """Approximate totals per key over roughly the last ``window_ms``, in fixed memory.
+
+    Counts go into ``depth`` rows of ``width`` counters, one counter per row picked by hashing the
+    key, and a key's estimate is the smallest of its counters, so it can only be too high, never
+    too low. Adding only raises the counters that are at that minimum (conservative update),
+    which keeps estimates much closer for keys sharing counters with heavy ones.
+
+    Time is split into windows of ``window_ms``. Once a window ends its counts are kept for one
+    more, and estimates add them in proportion to how much of the sliding window they still
+    cover.
+    """
+    def __init__(self, *, width: int, depth: int, window_ms: int) -> None:
+        if width <= 0 or depth <= 0:
+            raise ValueError(f'Sketch width and depth must be positive, not {width}x{depth}')
+        if window_ms <= 0:
+            raise ValueError(f'Sketch window must be positive, not {window_ms}')
+
+        self._width = width
+        self._depth = depth
+        self._window_ms = window_ms
+
+        self._window = 0
+        self._current = self._new_counters()
+        self._previous = self._new_counters()
+
+    def _new_counters(self) -> 'array.array[int]':
+        return array.array('I', bytes(4 * self._width * self._depth))
+
+    @property
+    def memory_bytes(self) -> int:
+        return 2 * 4 * self._width * self._depth
+
+    def _advance(self, now_ms: int) -> float:
+        """Rotates the windows up to now, returning how much of the previous window still
+        counts."""
+        window, offset = divmod(now_ms, self._window_ms)
+        if window > self._window:
+            if window == self._window + 1:
+                self._previous = self._current
+            else:
+                self._previous = self._new_counters()
+            self._current = self._new_counters()
+            self._window = window
+
+        if window < self._window:
+            # The clock went backwards, so count everything still held.
+            return 1
+        return 1 - offset / self._window_ms
+
+    def _indexes(self, key: str) -> List[int]:
+        # Double hashing: one hash gives every row's counter.
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        width = self._width
+        return [row * width + (h1 + row * h2) % width for row in range(self._depth)]
+
+    def add(self, key: str, amount: int, now_ms: int) -> float:
+        """Adds amount to the key's total, returning its new estimate."""
+        previous_share = self._advance(now_ms)
+        indexes = self._indexes(key)
+        current = self._current
+
+        target = min(current[i] for i in indexes) + amount
+        for i in indexes:
+            if current[i] < target:
+                current[i] = min(target, 0xFFFFFFFF)
+
+        return target + previous_share * min(self._previous[i] for i in indexes)
+
+    def estimate(self, key: str, now_ms: int) -> float:
+        previous_share = self._advance(now_ms)
+        indexes = self._indexes(key)
+        return (min(self._current[i] for i in indexes) + previous_share * min(self._previous[i]
+                                                                              for i in indexes))
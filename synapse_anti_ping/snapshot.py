@@ -0,0 +1,228 @@
+from typing import *
+
+import array
+import mmap
+import os
+import struct
+import sys
+
+from .offender import Offence, OffenderState
+
+# The file is a header followed by columns, each aligned for its element size:
+#
+#   expirations:     int64 per offence
+#   weights:         int64 per offence
+#   starts:          int64 per offender, plus one; offender i's offences are
+#                    [starts[i], starts[i+1])
+#   max_expirations: int64 per offender, so expired offenders are skipped without reading offences
+#   states:          uint8 per offender
+#   names:           the user IDs, UTF-8 encoded and separated by newlines
+#
+# Everything is little-endian.
+_MAGIC = b'APSNAP01'
+# magic, offenders, offences, length of names
+_HEADER = struct.Struct('<8sQQQ')
+_INT64 = 8
+
+# (user, state, offences)
+SnapshotEntry = Tuple[str, OffenderState, Iterable[Offence]]
+
+
+def _int64_array(values: Iterable[int] = ()) -> 'array.array[int]':
+    return array.array('q', values)
+
+
+class SnapshotWriter:
+    """Gathers a snapshot's columns an entry at a time, so that can be spread out, then writes them.
+
+    Expired offences are left out, along with any offenders that have none left.
+    """
+    def __init__(self, *, now_ms: int) -> None:
+        self.now_ms = now_ms
+        self._expirations = _int64_array()
+        self._weights = _int64_array()
+        self._starts = _int64_array([0])
+        self._max_expirations = _int64_array()
+        self._states = bytearray()
+        self._names: List[str] = []
+
+    def add(self, name: str, state: OffenderState, offences: Iterable[Offence]) -> None:
+        latest = None
+        for offence in offences:
+            if offence.expired(self.now_ms):
+                continue
+
+            self._expirations.append(offence.expiration_ms)
+            self._weights.append(offence.weight)
+            if latest is None or offence.expiration_ms > latest:
+                latest = offence.expiration_ms
+
+        if latest is None:
+            return
+
+        self._starts.append(len(self._expirations))
+        self._max_expirations.append(latest)
+        self._states.append(state.value)
+        self._names.append(name)
+
+    def write(self, path: str) -> int:
+        """Writes what was added to path atomically, returning how many offenders were written.
+
+        Only reads what add gathered, so it can run in a thread once nothing else is added.
+        """
+        names_data = '\n'.join(self._names).encode('utf-8')
+
+        columns = [self._expirations, self._weights, self._starts, self._max_expirations]
+        if sys.byteorder != 'little':
+            columns = [_int64_array(column) for column in columns]
+            for column in columns:
+                column.byteswap()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(_HEADER.pack(_MAGIC, len(self._names), len(self._expirations),
+                                  len(names_data)))
+            for column in columns:
+                column.tofile(fp)
+            fp.write(self._states)
+            fp.write(names_data)
+
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(tmp_path, path)
+        return len(self._names)
+
+
+def write_snapshot(path: str, entries: Iterable[SnapshotEntry], *, now_ms: int) -> int:
+    """Writes the entries to path atomically, returning how many were written."""
+    writer = SnapshotWriter(now_ms=now_ms)
+    for name, state, offences in entries:
+        writer.add(name, state, offences)
+    return writer.write(path)
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+class Snapshot:
+    """A memory-mapped snapshot, read one offender at a time.
+
+    Loading only builds an index of offenders with unexpired offences (and in ``only``, if given),
+    so it's quick even for millions of offenders; each one's offences are read from the mapping
+    when it's popped. The mapping stays open until close is called.
+    """
+    def __init__(self, path: str, *, now_ms: int, only: Optional[AbstractSet[str]] = None) -> None:
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < _HEADER.size:
+                raise SnapshotFormatError(f'{path} is too short to be a snapshot')
+
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, offenders, offences, names_size = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC:
+            self._mmap.close()
+            raise SnapshotFormatError(f'{path} is not a snapshot')
+
+        offset = _HEADER.size
+        expected_size = (offset + _INT64 * (offences * 2 + offenders * 2 + 1) + offenders +
+                         names_size)
+        if size != expected_size:
+            self._mmap.close()
+            raise SnapshotFormatError(f'{path} should be {expected_size} bytes, not {size}')
+
+        view = memoryview(self._mmap)  # type: ignore
+        # Every view of the mapping has to be released before it can be closed.
+        self._views = [view]
+
+        def column(count: int) -> Sequence[int]:
+            nonlocal offset
+            with view[offset:offset + count * _INT64] as data:
+                offset += count * _INT64
+
+                if sys.byteorder == 'little':
+                    values = data.cast('q')
+                    self._views.append(values)
+                    return values
+                else:
+                    array_values = _int64_array()
+                    array_values.frombytes(data)
+                    array_values.byteswap()
+                    return array_values
+
+        self._expirations = column(offences)
+        self._weights = column(offences)
+        self._starts = column(offenders + 1)
+        max_expirations = column(offenders)
+
+        self._states = view[offset:offset + offenders]
+        self._views.append(self._states)
+        offset += offenders
+
+        with view[offset:offset + names_size] as names_view:
+            names = str(names_view, 'utf-8').split('\n') if offenders else []
+
+        self._index = {
+            name: i
+            for i, (name, latest) in enumerate(zip(names, max_expirations))
+            if latest >= now_ms and (only is None or name in only)
+        }
+
+    def close(self) -> None:
+        """Unmaps the file; nothing can be read afterwards."""
+        self._index.clear()
+        for view in reversed(self._views):
+            view.release()
+        self._views.clear()
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def _read(self, i: int) -> Tuple[OffenderState, List[Offence]]:
+        start, end = self._starts[i], self._starts[i + 1]
+        offences = [
+            Offence(expiration_ms=expiration, weight=weight)
+            for expiration, weight in zip(self._expirations[start:end], self._weights[start:end])
+        ]
+
+        return OffenderState(self._states[i]), offences
+
+    def get(self, name: str) -> Optional[Tuple[OffenderState, List[Offence]]]:
+        """Returns the state and offences of the given offender, if present, leaving it in place."""
+        i = self._index.get(name)
+        if i is None:
+            return None
+
+        return self._read(i)
+
+    def names(self) -> Set[str]:
+        """Returns a copy of the offenders that haven't been popped yet."""
+        return set(self._index)
+
+    def retain(self, other: 'Snapshot') -> None:
+        """Drops every offender that isn't also in the other snapshot, e.g. popped from it."""
+        for name in self._index.keys() - other._index.keys():
+            del self._index[name]
+
+    def pop(self, name: str) -> Optional[Tuple[OffenderState, List[Offence]]]:
+        """Removes and returns the state and offences of the given offender, if present.
+
+        Offences may have expired since loading, so callers should still clear expired ones.
+        """
+        i = self._index.pop(name, None)
+        if i is None:
+            return None
+
+        return self._read(i)
+
+    def entries(self) -> Iterator[SnapshotEntry]:
+        """Yields every offender that hasn't been popped yet."""
+        for name, i in self._index.items():
+            state, offences = self._read(i)
+            yield name, state, offences
@@ -1,3 +1,6 @@
+from typing import *
+
+
 class ServerConfig:
     server_name: str
     public_baseurl: str
@@ -9,3 +12,17 @@ class SynapseHomeServer:
 
 class SpamCheckerApi:
     hs: SynapseHomeServer
+
+
+class EventBase:
+    def get_dict(self) -> Dict[str, Any]:
+        ...
+
+
+class ModuleApi:
+    server_name: str
+    public_baseurl: str
+
+    def register_spam_checker_callbacks(
+            self, *, check_event_for_spam: Callable[[EventBase], Awaitable[bool]]) -> None:
+        ...
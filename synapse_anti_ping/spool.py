@@ -0,0 +1,163 @@
+from typing import *
+from typing import IO
+
+import concurrent.futures
+import json
+import logging
+import os
+
+logger = logging.getLogger('synapse_anti_ping.spool')
+
+
+class Spool:
+    """An append-only file of records that haven't been acknowledged yet.
+
+    Every append and ack is written as one JSON line; nothing is durable until sync() is called,
+    so callers can batch fsyncs. Once ``compact_at`` records have been acknowledged, the file is
+    rewritten with only the pending ones. Records left over from a previous run are loaded in the
+    order they were appended, and a line cut off by a crash is discarded.
+
+    With ``background`` set, fsyncs and the end of each compaction (syncing the new file and
+    moving it into place) run in order on a thread of the spool's own, so that callers on an event
+    loop aren't held up by the disk. Lines are still written from the caller's thread.
+    """
+    def __init__(self, path: str, *, compact_at: int = 1000, background: bool = False) -> None:
+        self._path = path
+        self._compact_at = compact_at
+
+        # One thread, so its work runs in the order it was submitted.
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if background:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='antiping-spool')
+
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._next_id = 0
+        self._acked = 0
+        self._dirty = False
+
+        damaged = self._load()
+
+        self._file = open(self._path, 'a', encoding='utf-8')
+        if damaged:
+            self.compact()
+
+    def _load(self) -> bool:
+        try:
+            with open(self._path, encoding='utf-8') as fp:
+                lines = fp.readlines()
+        except FileNotFoundError:
+            return False
+
+        damaged = False
+        for i, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                if i == len(lines) - 1:
+                    logger.warning(f'Discarding incomplete last line of {self._path}')
+                else:
+                    logger.error(f'Discarding corrupt line {i + 1} of {self._path}')
+                damaged = True
+                continue
+
+            if 'ack' in entry:
+                self._pending.pop(entry['ack'], None)
+                self._acked += 1
+            else:
+                self._pending[entry['id']] = entry['record']
+                self._next_id = max(self._next_id, entry['id'] + 1)
+
+        if self._pending:
+            logger.info(f'Loaded {len(self._pending)} pending records from {self._path}')
+
+        return damaged
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        return list(self._pending.items())
+
+    def append(self, record: Dict[str, Any]) -> int:
+        record_id = self._next_id
+        self._next_id += 1
+
+        self._pending[record_id] = record
+        self._write({'id': record_id, 'record': record})
+        return record_id
+
+    def ack(self, record_id: int) -> None:
+        if self._pending.pop(record_id, None) is None:
+            return
+
+        self._acked += 1
+        if self._acked >= self._compact_at and self._acked > len(self._pending):
+            self.compact()
+        else:
+            self._write({'ack': record_id})
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._dirty = True
+
+    def _run(self, work: Callable[..., None], *args: Any) -> None:
+        if self._executor is None:
+            work(*args)
+        else:
+            self._executor.submit(work, *args).add_done_callback(self._log_failure)
+
+    def _log_failure(self, future: 'concurrent.futures.Future[None]') -> None:
+        ex = future.exception()
+        if ex is not None:
+            logger.error(f'Failed to write {self._path}', exc_info=ex)
+
+    def sync(self) -> None:
+        if not self._dirty:
+            return
+
+        self._file.flush()
+        self._dirty = False
+        self._run(os.fsync, self._file.fileno())
+
+    def compact(self) -> None:
+        """Rewrites the file with only the pending records.
+
+        Appends carry on into the new file straight away; it only replaces the old one once it's
+        synced, so a crash before then leaves the old file in place.
+        """
+        tmp_path = self._path + '.tmp'
+        new_file = open(tmp_path, 'w', encoding='utf-8')
+        for record_id, record in self._pending.items():
+            new_file.write(
+                json.dumps({
+                    'id': record_id,
+                    'record': record
+                }, separators=(',', ':')) + '\n')
+        new_file.flush()
+
+        old_file, self._file = self._file, new_file
+        self._acked = 0
+        self._dirty = False
+        self._run(self._replace, old_file, new_file.fileno(), tmp_path)
+
+    def _replace(self, old_file: IO[str], fd: int, tmp_path: str) -> None:
+        os.fsync(fd)
+        old_file.close()
+        os.replace(tmp_path, self._path)
+        self._sync_dir()
+
+    def _sync_dir(self) -> None:
+        fd = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        """Syncs and closes the file, waiting for any work still running in the background."""
+        self.sync()
+        self._run(self._file.close)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
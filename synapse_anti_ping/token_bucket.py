@@ -0,0 +1,34 @@
+from typing import *
+
+
+class TokenBucket:
+    """Allows ``rate`` actions per second on average, with bursts of up to ``burst`` at once.
+
+    Times are in seconds from any monotonic clock, e.g. the event loop's.
+    """
+    def __init__(self, *, rate: float, burst: int, now: float) -> None:
+        if rate <= 0:
+            raise ValueError(f'Rate must be positive, not {rate}')
+        if burst < 1:
+            raise ValueError(f'Burst must be at least 1, not {burst}')
+
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self._tokens = min(float(self._burst),
+                               self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+    def reserve(self, now: float) -> float:
+        """Takes a token, returning how many seconds to wait before using it.
+
+        Tokens can be reserved ahead of time, so callers that wait the returned delay are spaced
+        out at the bucket's rate instead of all retrying at once.
+        """
+        self._refill(now)
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
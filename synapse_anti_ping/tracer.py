@@ -0,0 +1,82 @@
+from typing import *
+
+from dataclasses import dataclass
+
+import html
+
+from .round_robin_list import RoundRobinList
+
+
+@dataclass(frozen=True)
+class SlowEvent:
+    event_id: Optional[str]
+    room: str
+    msgtype: Optional[str]
+    # Characters in the body and formatted body together.
+    body_size: int
+    # None if mentions weren't counted.
+    mentions: Optional[int]
+    # e.g. 'spam', or 'ignored' for unmoderated rooms and exempt senders
+    outcome: str
+    filter_seconds: float
+    mentions_seconds: float
+    classify_seconds: float
+    total_seconds: float
+
+
+class SlowEventTracer:
+    """Keeps the most recent events that took longer than a threshold to check."""
+    def __init__(self, *, threshold_seconds: float, cap: int) -> None:
+        self.threshold_seconds = threshold_seconds
+        self.events: RoundRobinList[SlowEvent] = RoundRobinList(cap=cap)
+        # Including ones that have since been pushed out.
+        self.recorded = 0
+
+    @property
+    def cap(self) -> int:
+        return self.events.cap
+
+    def record(self, event: SlowEvent) -> None:
+        self.events.append(event)
+        self.recorded += 1
+
+
+def _ms(seconds: float) -> str:
+    return f'{seconds * 1000:.2f}'
+
+
+def format_slow_events(tracer: SlowEventTracer) -> Tuple[str, str]:
+    """Returns the plain text and HTML bodies of a message listing the traced events, slowest
+    first."""
+    events = sorted(tracer.events, key=lambda event: event.total_seconds, reverse=True)
+    header = (f'{len(events)} of {tracer.recorded} events slower than '
+              f'{_ms(tracer.threshold_seconds)}ms (filter / mentions / classify / total ms):')
+
+    lines = [header]
+    rows = []
+    for event in events:
+        mentions = '-' if event.mentions is None else str(event.mentions)
+        timings = [
+            _ms(event.filter_seconds),
+            _ms(event.mentions_seconds),
+            _ms(event.classify_seconds),
+            _ms(event.total_seconds)
+        ]
+        cells = [
+            event.event_id or '?', event.room, event.msgtype or '?',
+            str(event.body_size), mentions, event.outcome
+        ] + timings
+
+        lines.append(f'{event.event_id} in {event.room}: {event.msgtype}, {event.body_size} chars, '
+                     f'{mentions} mentions, {event.outcome}, {" / ".join(timings)}')
+        rows.append('<tr>' + ''.join(f'<td>{html.escape(cell)}</td>' for cell in cells) + '</tr>')
+
+    columns = [
+        'Event', 'Room', 'Type', 'Size', 'Mentions', 'Outcome', 'Filter', 'Mentions', 'Classify',
+        'Total'
+    ]
+    formatted = (f'<p>{html.escape(header)}</p><table><tr>' + ''.join(f'<th>{column}</th>'
+                                                                      for column in columns) +
+                 '</tr>' + ''.join(rows) + '</table>')
+
+    return '\n'.join(lines), formatted
@@ -0,0 +1,773 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+from typing import *
+
+import asyncio
+import concurrent.futures
+import subprocess
+import time
+import types
+
+import pytest
+
+import nio
+from twisted.internet import defer, task
+
+from synapse_anti_ping.antispam import AntiSpam, AntiSpamModule
+from synapse_anti_ping.backend import MemoryBackend, SqliteBackend
+from synapse_anti_ping.clock import VirtualClock
+from synapse_anti_ping.config import Config
+from synapse_anti_ping.matrix import LogNotice, Matrix, Mjolnir, SendFailed
+from synapse_anti_ping.offender import OffenderState
+from synapse_anti_ping.snapshot import Snapshot
+
+CONFIG = {
+    'mjolnir': {
+        'room': '!mjolnir:example.com',
+        'banlist': 'bans'
+    },
+    'log': {
+        'room': '!log:example.com'
+    },
+    'user': {
+        'user': 'antiping',
+        'password': 'password',
+    },
+}
+
+
+class FakeMatrix:
+    def __init__(self) -> None:
+        self.messages: List[str] = []
+        self.forgotten_rooms: List[str] = []
+
+    def send_message(self, message: str, **kwargs: Any) -> 'concurrent.futures.Future[None]':
+        self.messages.append(message)
+        future: 'concurrent.futures.Future[None]' = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def send_log_notice(self, notice: LogNotice) -> None:
+        self.messages.append(notice.message)
+
+    def call_soon(self, callback: Callable[..., None], *args: Any) -> None:
+        pass
+
+    def forget_room(self, room: str) -> None:
+        self.forgotten_rooms.append(room)
+
+
+class FakeModuleApi:
+    server_name = 'example.com'
+    public_baseurl = 'https://example.com/'
+
+    def __init__(self) -> None:
+        self.callbacks: Dict[str, Any] = {}
+
+    def register_spam_checker_callbacks(self, **callbacks: Any) -> None:
+        self.callbacks.update(callbacks)
+
+
+class FakeSpamCheckerApi:
+    """What older Synapse versions give legacy spam checkers."""
+    def __init__(self) -> None:
+        self.hs = types.SimpleNamespace(config=types.SimpleNamespace(
+            server_name='example.com', public_baseurl='https://example.com/'))
+
+
+class FakeEvent:
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self._data = data
+
+    def get_dict(self) -> Dict[str, Any]:
+        return self._data
+
+
+def text_event(ts: int) -> Dict[str, Any]:
+    return {
+        'type': 'm.room.message',
+        'room_id': '!room:example.com',
+        'sender': '@spammer:example.com',
+        'origin_server_ts': ts,
+        'content': {
+            'msgtype': 'm.text',
+            'body': 'spam'
+        },
+    }
+
+
+def test_module_api_callbacks() -> None:
+    api = FakeModuleApi()
+    matrix = FakeMatrix()
+    antispam = AntiSpamModule(Config.from_data(CONFIG), cast(Any, api), matrix=cast(Matrix, matrix))
+    antispam.gc_task.stop()
+
+    assert antispam.config.user.homeserver == api.public_baseurl
+    assert antispam.full_user == '@antiping:example.com'
+
+    callback = api.callbacks['check_event_for_spam']
+    now_ms = antispam.clock.now_ms()
+    results = [
+        asyncio.get_event_loop().run_until_complete(callback(FakeEvent(text_event(now_ms))))
+        for _ in range(20)
+    ]
+    assert not results[0]
+    assert results[-1]
+
+    kick = {
+        'type': 'm.room.member',
+        'room_id': '!room:example.com',
+        'sender': '@mod:example.com',
+        'state_key': '@antiping:example.com',
+        'content': {
+            'membership': 'leave'
+        },
+    }
+    assert not antispam.check_event_for_spam(kick)
+    assert matrix.forgotten_rooms == ['!room:example.com']
+
+
+@pytest.mark.parametrize('api_type', [FakeSpamCheckerApi, FakeModuleApi])
+def test_legacy_spam_checker(api_type: Callable[[], Any]) -> None:
+    # Synapse 1.37 onwards gives legacy spam checkers a ModuleApi, but still calls
+    # check_event_for_spam itself, so nothing may be registered.
+    api = api_type()
+    antispam = AntiSpam(Config.from_data(CONFIG), api, matrix=cast(Matrix, FakeMatrix()))
+    antispam.gc_task.stop()
+
+    assert antispam.full_user == '@antiping:example.com'
+    assert antispam.config.user.homeserver == 'https://example.com/'
+    assert not getattr(api, 'callbacks', {})
+
+    # Each message counts once, so the default text weight of 2 reaches the spam limit of 20 on
+    # the tenth message.
+    now_ms = antispam.clock.now_ms()
+    results = [antispam.check_event_for_spam(text_event(now_ms)) for _ in range(10)]
+    assert results == [False] * 9 + [True]
+
+
+def fake_matrix(config: Config) -> Tuple[Matrix, 'FakeClient']:
+    config.user.homeserver = 'https://example.com/'
+
+    matrix = Matrix(config, loop=asyncio.get_event_loop())
+    client = FakeClient()
+    matrix._client = client
+    matrix.start()
+
+    return matrix, client
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.calls: List[str] = []
+        self.contents: List[Dict[str, Any]] = []
+        # Returned by room_send before it starts succeeding.
+        self.errors: List[nio.ErrorResponse] = []
+
+    async def login(self, password: str) -> None:
+        self.calls.append('login')
+
+    async def joined_rooms(self) -> nio.JoinedRoomsResponse:
+        self.calls.append('joined_rooms')
+        return nio.JoinedRoomsResponse(rooms=['!log:example.com'])
+
+    async def join(self, room: str) -> nio.JoinResponse:
+        self.calls.append(f'join {room}')
+        return nio.JoinResponse(room_id=room)
+
+    async def room_send(self, *, room_id: str, message_type: str, content: Dict[str, Any]) -> Any:
+        self.calls.append(f'send {room_id} {content["body"]}')
+        if self.errors:
+            return self.errors.pop(0)
+
+        self.contents.append(content)
+        return None
+
+
+def test_matrix_on_reactor_loop() -> None:
+    config = Config.from_data(CONFIG)
+    config.user.homeserver = 'https://example.com/'
+
+    loop = asyncio.get_event_loop()
+    matrix = Matrix(config, loop=loop)
+    client = FakeClient()
+    matrix._client = client
+
+    matrix.start()
+    future = matrix.send_message('hello', room='!room:example.com', join=False)
+    assert isinstance(future, asyncio.Future)
+
+    loop.run_until_complete(future)
+    assert not matrix._thread.is_alive()
+    assert client.calls == [
+        'login', 'joined_rooms', 'join !mjolnir:example.com', 'send !room:example.com hello'
+    ]
+
+
+def test_log_digest() -> None:
+    config = Config.from_data({
+        **CONFIG, 'log': {
+            'room': '!log:example.com',
+            'digest_seconds': 0.1,
+            'digest_size': 3
+        }
+    })
+    matrix, client = fake_matrix(config)
+
+    # Fills the digest, so it's sent right away.
+    for i in range(3):
+        matrix.send_log_notice(LogNotice(f'@user{i}:example.com', 'was banned for spam', '!a:b'))
+    # Sent on its own once the window expires.
+    matrix.send_log_notice(LogNotice('@user<3>:example.com', 'was submitting spam', '!a:b'))
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.3))
+
+    assert matrix.merged_log_notices == 3
+    assert [content['body'].splitlines()[0] for content in client.contents] == [
+        '3 notices merged:',
+        '@user<3>:example.com was submitting spam in !a:b',
+    ]
+    assert client.contents[0]['formatted_body'].count('<tr>') == 4
+    assert 'formatted_body' not in client.contents[1]
+
+
+def test_ban_queue() -> None:
+    config = Config.from_data({
+        **CONFIG, 'mjolnir': {
+            'room': '!mjolnir:example.com',
+            'banlist': 'bans',
+            'batch_size': 2,
+            'flush_seconds': 0.05,
+        }
+    })
+    matrix, client = fake_matrix(config)
+    mjolnir = Mjolnir(config, matrix)
+
+    for user in ('@a:x', '@b:x', '@a:x', '@c:x', '@b:x'):
+        mjolnir.ban(user)
+    assert mjolnir.queue_depth == 3
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.2))
+
+    # Mjolnir only takes one user per ban command, anything after it is the reason.
+    assert [content['body'] for content in client.contents] == [
+        '!mjolnir ban bans user @a:x spam',
+        '!mjolnir ban bans user @b:x spam',
+        '!mjolnir ban bans user @c:x spam',
+    ]
+    assert mjolnir.queue_depth == 0
+    assert mjolnir.bans_sent == 3
+    assert mjolnir.last_flush_latency is not None and mjolnir.last_flush_latency >= 0.05
+
+    # Still within the dedup horizon.
+    mjolnir.ban('@a:x')
+    assert mjolnir.queue_depth == 0
+
+
+def test_ban_batch_sent_together() -> None:
+    config = Config.from_data({
+        **CONFIG, 'ratelimit': {
+            'per_second': 1000,
+            'room_per_second': 1000,
+            'max_in_flight': 4,
+        }
+    })
+    matrix, client = fake_matrix(config)
+    mjolnir = Mjolnir(config, matrix)
+
+    in_flight = 0
+    most_in_flight = 0
+    room_send = client.room_send
+
+    async def slow_room_send(**kwargs: Any) -> Any:
+        nonlocal in_flight, most_in_flight
+        in_flight += 1
+        most_in_flight = max(most_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return await room_send(**kwargs)
+
+    client.room_send = slow_room_send  # type: ignore
+    for i in range(8):
+        mjolnir.ban(f'@{i}:x')
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.1))
+
+    assert mjolnir.bans_sent == 8
+    assert most_in_flight == 4
+
+
+def test_ban_queue_single_target() -> None:
+    config = Config.from_data({
+        **CONFIG, 'mjolnir': {
+            'room': '!mjolnir:example.com',
+            'banlist': 'bans',
+            'dedup_minutes': 0,
+        }
+    })
+    matrix, client = fake_matrix(config)
+    mjolnir = Mjolnir(config, matrix)
+
+    for user in ('@a:x', '@b:x', '@a:x'):
+        mjolnir.ban(user)
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.05))
+
+    assert [content['body'] for content in client.contents] == [
+        '!mjolnir ban bans user @a:x spam',
+        '!mjolnir ban bans user @b:x spam',
+        '!mjolnir ban bans user @a:x spam',
+    ]
+
+
+def test_send_retries() -> None:
+    config = Config.from_data({
+        **CONFIG, 'ratelimit': {
+            'per_second': 100,
+            'burst': 2,
+            'backoff_seconds': 0.01,
+            'max_retries': 1,
+        }
+    })
+    matrix, client = fake_matrix(config)
+    loop = asyncio.get_event_loop()
+
+    client.errors = [
+        nio.RoomSendError('slow down', 'M_LIMIT_EXCEEDED', retry_after_ms=100),
+        nio.RoomSendError('slow down', 'M_LIMIT_EXCEEDED'),
+        nio.RoomSendError('oops', 'M_UNKNOWN'),
+    ]
+    start = time.monotonic()
+    loop.run_until_complete(matrix.send_message_async('ban', room='!a:b', join=False))
+    # Rate limit errors don't count as retries, and retry_after_ms is honoured.
+    assert time.monotonic() - start >= 0.1
+    assert [content['body'] for content in client.contents] == ['ban']
+
+    client.errors = [nio.RoomSendError('oops', 'M_UNKNOWN')] * 2
+    with pytest.raises(SendFailed):
+        loop.run_until_complete(matrix.send_message_async('lost', room='!a:b', join=False))
+    assert [content['body'] for content in client.contents] == ['ban']
+
+    # The burst was used up above, so these are spaced out at the global rate.
+    start = time.monotonic()
+    for _ in range(5):
+        loop.run_until_complete(matrix.send_message_async('hi', room='!c:d', join=False))
+    assert time.monotonic() - start >= 0.04
+
+
+def test_no_ratelimit_by_default() -> None:
+    matrix, client = fake_matrix(Config.from_data(CONFIG))
+    loop = asyncio.get_event_loop()
+
+    # Well past Synapse's default burst, which would take minutes to send if rate limited.
+    sends = [matrix.send_message_async('ban', room='!a:b', join=False) for _ in range(30)]
+    loop.run_until_complete(asyncio.wait_for(asyncio.gather(*sends), timeout=1))
+    assert len(client.contents) == 30
+
+
+def test_failed_ban_stays_spooled(tmp_path: Any) -> None:
+    config = Config.from_data({
+        **CONFIG,
+        'ratelimit': {
+            'backoff_seconds': 0,
+            'max_retries': 1,
+        },
+        'spool': {
+            'path': str(tmp_path / 'spool')
+        },
+    })
+    matrix, client = fake_matrix(config)
+    mjolnir = Mjolnir(config, matrix)
+    loop = asyncio.get_event_loop()
+
+    client.errors = [nio.RoomSendError('oops', 'M_UNKNOWN')] * 2
+    mjolnir.ban('@a:x')
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert client.contents == []
+    assert mjolnir.bans_sent == 0
+    assert [record['user'] for _, record in matrix.spooled('ban')] == ['@a:x']
+
+    # Not ignored as a duplicate, since the first one never went through.
+    mjolnir.ban('@a:x')
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert [content['body'] for content in client.contents] == ['!mjolnir ban bans user @a:x spam']
+    assert mjolnir.bans_sent == 1
+    assert matrix.spooled('ban') == []
+
+
+def test_joined_rooms() -> None:
+    matrix, client = fake_matrix(Config.from_data({**CONFIG, 'ratelimit': {'backoff_seconds': 0}}))
+    loop = asyncio.get_event_loop()
+
+    for _ in range(2):
+        loop.run_until_complete(matrix.send_message_async('hi', room='!a:b'))
+    assert client.calls.count('join !a:b') == 1
+
+    matrix.forget_room('!a:b')
+    loop.run_until_complete(matrix.send_message_async('hi', room='!a:b'))
+    assert client.calls.count('join !a:b') == 2
+
+    # A send rejected because the bot isn't in the room anymore rejoins before retrying.
+    client.errors = [nio.RoomSendError('not in room', 'M_FORBIDDEN')]
+    loop.run_until_complete(matrix.send_message_async('hi', room='!a:b'))
+    assert client.calls.count('join !a:b') == 3
+    assert len(client.contents) == 4
+
+
+def test_log_digest_merges_while_queued() -> None:
+    config = Config.from_data({**CONFIG, 'log': {'room': '!log:example.com', 'digest_size': 2}})
+    config.user.homeserver = 'https://example.com/'
+
+    matrix = Matrix(config, loop=asyncio.get_event_loop())
+    client = FakeClient()
+    matrix._client = client
+
+    # Not logged in yet, so the first digest is still queued when the second is flushed.
+    for i in range(4):
+        matrix.send_log_notice(LogNotice(f'@user{i}:example.com', 'was banned for spam', '!a:b'))
+
+    matrix.start()
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.05))
+
+    assert len(client.contents) == 1
+    assert client.contents[0]['body'].startswith('4 notices merged:')
+
+
+def test_spool_replays_bans(tmp_path: Any) -> None:
+    config = Config.from_data({**CONFIG, 'spool': {'path': str(tmp_path / 'spool')}})
+    config.user.homeserver = 'https://example.com/'
+    loop = asyncio.get_event_loop()
+    existing = asyncio.all_tasks(loop)
+
+    # Never logs in, like a restart while still retrying login.
+    matrix = Matrix(config, loop=loop)
+    mjolnir = Mjolnir(config, matrix)
+    mjolnir.ban('@a:x')
+    mjolnir.ban('@b:x')
+    matrix.send_message('alert', room='!room:x')
+    loop.run_until_complete(asyncio.sleep(0.3))
+
+    # The sends still waiting for login go away with the process.
+    waiting = asyncio.all_tasks(loop) - existing
+    assert waiting
+    for waiting_task in waiting:
+        waiting_task.cancel()
+    loop.run_until_complete(asyncio.gather(*waiting, return_exceptions=True))
+    matrix._spool.close()
+
+    matrix, client = fake_matrix(config)
+    mjolnir = Mjolnir(config, matrix)
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    assert sorted(content['body'] for content in client.contents) == [
+        '!mjolnir ban bans user @a:x spam',
+        '!mjolnir ban bans user @b:x spam',
+        'alert',
+    ]
+    assert matrix.spooled('ban') == []
+    assert matrix.spooled('message') == []
+
+
+def test_snapshot_restart(tmp_path: Any) -> None:
+    config = Config.from_data({**CONFIG, 'snapshot': {'path': str(tmp_path / 'snapshot')}})
+    clock = VirtualClock(1_000_000)
+
+    def make_antispam() -> AntiSpam:
+        antispam = AntiSpam(config,
+                            cast(Any, FakeModuleApi()),
+                            clock=clock,
+                            matrix=cast(Matrix, FakeMatrix()))
+        antispam.gc_task.stop()
+        antispam.snapshot_task.stop()
+        # Without the reactor running, saving has to finish straight away.
+        antispam._cooperate = task.Cooperator(scheduler=lambda work: work()).cooperate
+        antispam._defer_to_thread = defer.maybeDeferred
+        return antispam
+
+    antispam = make_antispam()
+    backend = cast(MemoryBackend, antispam.backend)
+    # Enough to get an alert, but not a ban.
+    for _ in range(11):
+        antispam.check_event_for_spam(text_event(clock.now_ms()))
+    offences = list(backend.offenders['@spammer:example.com'].offences)
+    assert backend.offenders['@spammer:example.com'].state == OffenderState.ALERTED
+    antispam.save_snapshot()
+
+    clock.advance(1000)
+    restarted = make_antispam()
+    backend = cast(MemoryBackend, restarted.backend)
+    assert backend.snapshot is not None and len(backend.snapshot) == 1
+    assert not backend.offenders
+
+    # The sender picks up where it left off, so the next few messages get it banned.
+    for _ in range(4):
+        assert restarted.check_event_for_spam(text_event(clock.now_ms()))
+    offender = backend.offenders['@spammer:example.com']
+    assert offender.state == OffenderState.BANNED
+    assert set(offences) <= set(offender.offences)
+
+    # Senders that haven't been seen since loading are kept in the next snapshot, and are then
+    # read from it instead of the old one.
+    third = make_antispam()
+    backend = cast(MemoryBackend, third.backend)
+    loaded = backend.snapshot
+    assert third.save_snapshot().called
+    assert '@spammer:example.com' in Snapshot(config.snapshot.path, now_ms=clock.now_ms())
+    assert backend.snapshot is not None and backend.snapshot is not loaded
+    assert '@spammer:example.com' in backend.snapshot
+
+    # Once they've expired, they're dropped at the next save.
+    clock.advance(24 * 60 * 60 * 1000)
+    third.save_snapshot()
+    assert backend.snapshot is None
+
+
+def test_shared_sqlite_backend(tmp_path: Any) -> None:
+    config = Config.from_data({
+        **CONFIG, 'backend': {
+            'type': 'sqlite',
+            'path': str(tmp_path / 'offenders.db')
+        }
+    })
+    clock = VirtualClock(1_000_000)
+
+    workers = []
+    for _ in range(2):
+        matrix = FakeMatrix()
+        antispam = AntiSpam(config,
+                            cast(Any, FakeModuleApi()),
+                            clock=clock,
+                            matrix=cast(Matrix, matrix))
+        antispam.gc_task.stop()
+        assert isinstance(antispam.backend, SqliteBackend)
+        workers.append((antispam, matrix))
+
+    # Spread over both workers, the messages still add up to an alert, sent by only one of them.
+    flagged = [
+        workers[i % 2][0].check_event_for_spam(text_event(clock.now_ms())) for i in range(11)
+    ]
+    assert flagged == [False] * 9 + [True] * 2
+    assert [len(matrix.messages) for _, matrix in workers] == [0, 2]
+
+    clock.advance(60 * 1000)
+    antispam, _ = workers[0]
+    antispam._gc_callback()
+    assert antispam.last_gc is not None and antispam.last_gc.removed == 1
+    # The other worker's counts catch up on its next push or GC, which has nothing left to do.
+    antispam, _ = workers[1]
+    antispam._gc_callback()
+    assert antispam.last_gc is not None and antispam.last_gc.swept == 0
+    assert len(antispam.backend) == 0
+
+    for antispam, _ in workers:
+        antispam.backend.close()
+
+
+def test_sqlite_backend_ignores_storage(tmp_path: Any, caplog: Any) -> None:
+    config = Config.from_data({
+        **CONFIG,
+        'offences': {
+            'storage': 'decay'
+        },
+        'backend': {
+            'type': 'sqlite',
+            'path': str(tmp_path / 'offenders.db')
+        },
+    })
+    antispam = AntiSpam(config, cast(Any, FakeModuleApi()), matrix=cast(Matrix, FakeMatrix()))
+    antispam.gc_task.stop()
+    antispam.backend.close()
+
+    assert 'Ignoring offences.storage: decay' in caplog.text
+
+
+def test_sqlite_backend_requires_path() -> None:
+    config = Config.from_data({**CONFIG, 'backend': {'type': 'sqlite'}})
+    with pytest.raises(ValueError):
+        AntiSpam(config, cast(Any, FakeModuleApi()), matrix=cast(Matrix, FakeMatrix()))
+
+
+def test_max_offenders() -> None:
+    clock = VirtualClock(1_000_000)
+    config = Config.from_data({**CONFIG, 'backend': {'max_offenders': 2}})
+    antispam = AntiSpam(config,
+                        cast(Any, FakeModuleApi()),
+                        clock=clock,
+                        matrix=cast(Matrix, FakeMatrix()))
+    antispam.gc_task.stop()
+
+    for i in range(5):
+        antispam.check_event_for_spam({
+            **text_event(clock.now_ms()), 'sender': f'@user{i}:example.com'
+        })
+
+    assert len(antispam.backend) == 2
+    lines = antispam.metrics.render().splitlines()
+    assert 'synapse_anti_ping_offenders_evicted_total{state="okay"} 3.0' in lines
+    assert 'synapse_anti_ping_offenders_evicted_total{state="banned"} 0.0' in lines
+
+
+def test_metrics() -> None:
+    clock = VirtualClock(1_000_000)
+    antispam = AntiSpam(Config.from_data(CONFIG),
+                        cast(Any, FakeModuleApi()),
+                        clock=clock,
+                        matrix=cast(Matrix, FakeMatrix()))
+    antispam.gc_task.stop()
+
+    for _ in range(16):
+        antispam.check_event_for_spam(text_event(clock.now_ms()))
+    antispam.check_event_for_spam({**text_event(clock.now_ms()), 'room_id': '!room:elsewhere'})
+
+    clock.advance(60 * 1000)
+    antispam._gc_callback()
+
+    lines = antispam.metrics.render().splitlines()
+    for line in [
+            'synapse_anti_ping_messages_total{outcome="okay"} 9.0',
+            'synapse_anti_ping_messages_total{outcome="spam"} 5.0',
+            'synapse_anti_ping_messages_total{outcome="ban"} 2.0',
+            'synapse_anti_ping_messages_total{outcome="ignored"} 1.0',
+            'synapse_anti_ping_check_seconds_count{stage="total"} 17',
+            'synapse_anti_ping_check_seconds_count{stage="classify"} 16',
+            'synapse_anti_ping_offenders 0.0',
+            'synapse_anti_ping_offences 0.0',
+            'synapse_anti_ping_gc_swept_total 1.0',
+            'synapse_anti_ping_gc_removed_total 1.0',
+    ]:
+        assert line in lines
+
+    config = Config.from_data(CONFIG)
+    config.user.homeserver = 'https://example.com/'
+    matrix = Matrix(config, loop=asyncio.get_event_loop(), metrics=antispam.metrics)
+    matrix._client = FakeClient()
+
+    loop = asyncio.get_event_loop()
+    # Sends wait in the queue until the client has started.
+    future = matrix.send_message('hi', room='!a:b')
+    loop.run_until_complete(asyncio.sleep(0.01))
+    lines = antispam.metrics.render().splitlines()
+    assert 'synapse_anti_ping_send_queue_depth{priority="alert"} 1.0' in lines
+
+    matrix.start()
+    loop.run_until_complete(asyncio.wrap_future(future))
+    lines = antispam.metrics.render().splitlines()
+    assert 'synapse_anti_ping_send_queue_depth{priority="alert"} 0.0' in lines
+    assert 'synapse_anti_ping_room_send_seconds_count 1' in lines
+
+
+def test_slow_event_command() -> None:
+    matrix = FakeMatrix()
+    antispam = AntiSpam(Config.from_data(CONFIG),
+                        cast(Any, FakeModuleApi()),
+                        matrix=cast(Matrix, matrix))
+    antispam.gc_task.stop()
+
+    command = {
+        **text_event(antispam.clock.now_ms()),
+        'room_id': '!mjolnir:example.com',
+        'sender': '@mod:example.com',
+        'content': {
+            'msgtype': 'm.text',
+            'body': '!antiping slow',
+        },
+    }
+    antispam.check_event_for_spam(command)
+    assert matrix.messages[-1].startswith('Slow event tracing is disabled')
+
+    config = Config.from_data({**CONFIG, 'tracing': {'slow_event_ms': 0, 'buffer_size': 2}})
+    antispam.reload_config(config)
+    for i in range(3):
+        antispam.check_event_for_spam({**text_event(antispam.clock.now_ms()), 'event_id': f'${i}'})
+    assert antispam.tracer is not None
+    assert [event.event_id for event in antispam.tracer.events] == ['$1', '$2']
+    assert antispam.tracer.events[-1].outcome == 'okay'
+    assert antispam.tracer.events[-1].body_size == len('spam')
+
+    del matrix.messages[:]
+    antispam.check_event_for_spam(command)
+    # The command itself is traced as ignored.
+    assert matrix.messages[0].startswith('2 of 3 events slower than 0.00ms')
+    assert antispam.tracer.events[-1].outcome == 'ignored'
+
+    # Reloading with the same buffer size keeps what's been traced.
+    antispam.reload_config(
+        Config.from_data({
+            **CONFIG, 'tracing': {
+                'slow_event_ms': 1000,
+                'buffer_size': 2
+            }
+        }))
+    assert antispam.tracer.recorded == 4
+
+
+def test_reload_swaps_decisions() -> None:
+    antispam = AntiSpam(Config.from_data(CONFIG),
+                        cast(Any, FakeModuleApi()),
+                        matrix=cast(Matrix, FakeMatrix()))
+    antispam.gc_task.stop()
+
+    decisions = antispam.decisions
+    assert not antispam.check_event_for_spam(text_event(antispam.clock.now_ms()))
+
+    text_spam = {'enabled': True, 'weight': 20, 'expires_minutes': 1}
+    antispam.reload_config(Config.from_data({**CONFIG, 'offences': {'text_spam': text_spam}}))
+    assert antispam.decisions is not decisions
+    assert antispam.check_event_for_spam(text_event(antispam.clock.now_ms()))
+
+
+def test_reload_keeps_startup_settings(caplog: Any) -> None:
+    data = {**CONFIG, 'offences': {'storage': 'compact'}}
+    antispam = AntiSpam(Config.from_data(data),
+                        cast(Any, FakeModuleApi()),
+                        matrix=cast(Matrix, FakeMatrix()))
+    antispam.gc_task.stop()
+    decisions = antispam.decisions
+
+    # Weights that compact storage can't hold are rejected, keeping the old config.
+    text_spam = {'enabled': True, 'weight': 70000, 'expires_minutes': 1}
+    with pytest.raises(ValueError):
+        antispam.reload_config(
+            Config.from_data({
+                **data, 'offences': {
+                    'storage': 'compact',
+                    'text_spam': text_spam
+                }
+            }))
+    assert antispam.decisions is decisions
+    assert not antispam.check_event_for_spam(text_event(antispam.clock.now_ms()))
+
+    # Settings only read at startup stay as they were.
+    antispam.reload_config(
+        Config.from_data({
+            **data, 'offences': {
+                'storage': 'heap',
+                'history_size': 5
+            },
+            'backend': {
+                'max_offenders': 10
+            }
+        }))
+    assert antispam.config.offences.storage == 'compact'
+    assert antispam.config.backend.max_offenders is None
+    assert antispam.decisions.history_size == 5
+    assert 'Ignoring the change to offences.storage' in caplog.text
+    assert 'Ignoring the change to backend' in caplog.text
+
+    # Putting back the startup settings doesn't touch the defaults other configs are built from.
+    antispam.reload_config(Config.from_data(CONFIG))
+    assert antispam.config.offences.storage == 'compact'
+    assert Config.from_data(CONFIG).offences.storage == 'heap'
+
+
+def test_import_is_lazy() -> None:
+    script = ('import sys, synapse_anti_ping; '
+              'print(sorted({"nio", "twisted.internet.reactor"} & set(sys.modules)))')
+    output = subprocess.run([sys.executable, '-c', script],
+                            cwd=os.path.dirname(__file__) + '/..',
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    assert output.strip() == '[]'
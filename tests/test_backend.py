@@ -0,0 +1,261 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import concurrent.futures
+import sqlite3
+
+import pytest
+
+from synapse_anti_ping import backend as backend_module
+from synapse_anti_ping.backend import MemoryBackend, SqliteBackend
+from synapse_anti_ping.config import Limits
+from synapse_anti_ping.offender import (DecayingScore, Offence, OffenceList, OffenceListClassifier,
+                                        OffenderState)
+from synapse_anti_ping.sketch import WindowedCountMinSketch
+from synapse_anti_ping.snapshot import Snapshot, SnapshotWriter, write_snapshot
+
+NOW_MS = 1_600_000_000_000
+LIMITS = Limits(spam=6, ban=10)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        yield MemoryBackend(OffenceList)
+    else:
+        backend = SqliteBackend(str(tmp_path / 'offenders.db'))
+        yield backend
+        backend.close()
+
+
+def push(backend, sender, expiration_ms, weight, *, now_ms=NOW_MS, history_size=20):
+    return backend.push_and_classify(sender,
+                                     Offence(expiration_ms=expiration_ms, weight=weight),
+                                     now_ms=now_ms,
+                                     limits=LIMITS,
+                                     history_size=history_size)
+
+
+def test_backend_push_and_classify(backend):
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                3) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                3) == (OffenceListClassifier.SPAM, OffenderState.OKAY)
+    # The state only moves up once.
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                1) == (OffenceListClassifier.SPAM, OffenderState.ALERTED)
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                3) == (OffenceListClassifier.BAN, OffenderState.ALERTED)
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                3) == (OffenceListClassifier.BAN, OffenderState.BANNED)
+
+    assert push(backend, '@b:x', NOW_MS + 1000,
+                1) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert len(backend) == 2
+    assert backend.offence_count() == 6
+
+
+def test_backend_expiry(backend):
+    push(backend, '@a:x', NOW_MS + 1000, 6)
+
+    # Expired offences are cleared before classifying.
+    assert push(backend, '@a:x', NOW_MS + 5000, 1,
+                now_ms=NOW_MS + 2000) == (OffenceListClassifier.OKAY, OffenderState.ALERTED)
+
+    # An offence that's already expired leaves nothing behind.
+    assert push(backend, '@b:x', NOW_MS - 1, 1) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert len(backend) == 1
+
+
+def test_backend_history_size(backend):
+    for i in range(5):
+        push(backend, '@a:x', NOW_MS + 1000 * (i + 1), 2, history_size=3)
+
+    # Only the three offences expiring last are kept.
+    assert push(backend, '@a:x', NOW_MS + 500, 2,
+                history_size=3) == (OffenceListClassifier.SPAM, OffenderState.ALERTED)
+    assert push(backend, '@a:x', NOW_MS + 10_000, 6,
+                history_size=3) == (OffenceListClassifier.BAN, OffenderState.ALERTED)
+
+
+def test_backend_gc(backend):
+    push(backend, '@a:x', NOW_MS + 1000, 6)
+    push(backend, '@a:x', NOW_MS + 10_000, 1)
+    push(backend, '@b:x', NOW_MS + 1000, 1)
+    push(backend, '@c:x', NOW_MS + 10_000, 1)
+
+    assert backend.gc(now_ms=NOW_MS + 5000, limits=LIMITS) == (2, 1)
+    assert len(backend) == 2
+    assert backend.offence_count() == 2
+
+    # @a:x has calmed down, so it can be alerted again.
+    assert push(backend, '@a:x', NOW_MS + 10_000, 5,
+                now_ms=NOW_MS + 5000) == (OffenceListClassifier.SPAM, OffenderState.OKAY)
+
+    assert backend.gc(now_ms=NOW_MS + 20_000, limits=LIMITS) == (2, 2)
+    assert len(backend) == 0
+    assert backend.offence_count() == 0
+
+
+def test_sqlite_backend_shared(tmp_path):
+    path = str(tmp_path / 'offenders.db')
+    first, second = SqliteBackend(path), SqliteBackend(path)
+
+    assert push(first, '@a:x', NOW_MS + 1000, 6) == (OffenceListClassifier.SPAM, OffenderState.OKAY)
+    assert push(second, '@a:x', NOW_MS + 1000,
+                1) == (OffenceListClassifier.SPAM, OffenderState.ALERTED)
+    assert len(first) == len(second) == 1
+
+    first.close()
+    second.close()
+
+
+def test_sqlite_backend_counts(tmp_path):
+    path = str(tmp_path / 'offenders.db')
+    first, second = SqliteBackend(path), SqliteBackend(path)
+
+    def assert_counts(backend):
+        offenders, offences = backend._db.execute(
+            'SELECT COUNT(DISTINCT sender), COUNT(*) FROM offences').fetchone()
+        assert (len(backend), backend.offence_count()) == (offenders, offences)
+
+    # Counts are kept across every worker's writes: new senders, full histories, expired
+    # offences, offences that have already expired and GC.
+    push(first, '@a:x', NOW_MS + 1000, 1)
+    push(second, '@b:x', NOW_MS + 1000, 1)
+    for i in range(4):
+        push(first, '@a:x', NOW_MS + 2000 + i, 1, history_size=3)
+    push(second, '@b:x', NOW_MS + 5000, 1, now_ms=NOW_MS + 1500)
+    push(first, '@c:x', NOW_MS - 1, 1)
+    assert (len(first), first.offence_count()) == (2, 4)
+    assert_counts(first)
+    # The others' counts are as of their own last write, and readable from any thread.
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        assert executor.submit(len, second).result() == 2
+        assert executor.submit(second.offence_count).result() == 4
+
+    assert second.gc(now_ms=NOW_MS + 2002, limits=LIMITS) == (1, 0)
+    assert first.gc(now_ms=NOW_MS + 10000, limits=LIMITS) == (2, 2)
+    assert_counts(first)
+    first.close()
+    second.close()
+
+    # A database from before counts were kept has them filled in when opened.
+    db = sqlite3.connect(path)
+    db.execute('INSERT INTO offences VALUES (?, ?, ?)', ('@d:x', NOW_MS + 1000, 1))
+    db.execute('DROP TABLE counts')
+    db.commit()
+    db.close()
+    third = SqliteBackend(path)
+    assert (len(third), third.offence_count()) == (1, 1)
+    third.close()
+
+
+def test_memory_backend_collect(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend_module, 'COLLECT_BATCH', 1)
+    path = str(tmp_path / 'snapshot')
+    write_snapshot(path, [('@a:x', OffenderState.ALERTED, [Offence(NOW_MS + 1000, 5)]),
+                          ('@b:x', OffenderState.OKAY, [Offence(NOW_MS + 1000, 1)])],
+                   now_ms=NOW_MS)
+    backend = MemoryBackend(OffenceList, snapshot=Snapshot(path, now_ms=NOW_MS))
+    push(backend, '@c:x', NOW_MS + 1000, 1)
+
+    writer = SnapshotWriter(now_ms=NOW_MS)
+    batches = backend.collect(writer)
+    # One batch per offender waiting in the snapshot...
+    next(batches)
+    next(batches)
+    # ...and they can change between batches: @a:x moves out of the snapshot, @c:x expires.
+    pending = backend.snapshot.names()
+    push(backend, '@a:x', NOW_MS + 2000, 1)
+    backend.gc(now_ms=NOW_MS + 1000, limits=LIMITS)
+    assert len(list(batches)) == 2
+    writer.write(path)
+
+    reloaded = Snapshot(path, now_ms=NOW_MS, only=pending)
+    assert len(reloaded) == 2
+    backend.replace_snapshot(reloaded)
+    assert backend.snapshot is reloaded
+    # @a:x was added twice, and is read back as it is now.
+    assert list(reloaded.entries()) == [('@b:x', OffenderState.OKAY, [Offence(NOW_MS + 1000, 1)])]
+    assert Snapshot(path, now_ms=NOW_MS).get('@a:x') == (OffenderState.ALERTED, [
+        Offence(NOW_MS + 1000, 5), Offence(NOW_MS + 2000, 1)
+    ])
+
+
+def test_memory_backend_admission():
+    sketch = WindowedCountMinSketch(width=1024, depth=4, window_ms=60_000)
+    backend = MemoryBackend(OffenceList, admission=sketch, promote_at=0.5)
+
+    # Below half the spam limit, senders are only counted by the sketch.
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                2) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert len(backend) == 0 and backend.promoted == 0
+
+    # Once promoted, the weight so far is carried over.
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                2) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert len(backend) == 1 and backend.promoted == 1
+    assert sorted(offence.weight for offence in backend.offenders['@a:x'].offences) == [2, 2]
+    assert backend.offence_count() == 2
+
+    assert push(backend, '@a:x', NOW_MS + 1000,
+                2) == (OffenceListClassifier.SPAM, OffenderState.OKAY)
+
+    # A heavy enough offence is tracked straight away.
+    assert push(backend, '@b:x', NOW_MS + 1000,
+                5) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert len(backend) == 2
+
+
+def test_memory_backend_max_offenders():
+    backend = MemoryBackend(OffenceList, max_offenders=3)
+
+    push(backend, '@spammer:x', NOW_MS + 1000, 6)
+    push(backend, '@heavy:x', NOW_MS + 1000, 5)
+    push(backend, '@light:x', NOW_MS + 1000, 1)
+    assert len(backend) == 3
+
+    # The flagged spammer is kept even though it's been idle longest, and the lighter of the two
+    # idle OKAY offenders goes first.
+    push(backend, '@new:x', NOW_MS + 1000, 2)
+    assert sorted(backend.offenders) == ['@heavy:x', '@new:x', '@spammer:x']
+    assert backend.offence_count() == 3
+    assert backend.evicted[OffenderState.OKAY] == 1
+
+    # With nobody OKAY left to evict, alerted offenders go next.
+    backend = MemoryBackend(OffenceList, max_offenders=1)
+    push(backend, '@spammer:x', NOW_MS + 1000, 6)
+    push(backend, '@other:x', NOW_MS + 1000, 6)
+    assert list(backend.offenders) == ['@other:x']
+    assert backend.evicted[OffenderState.ALERTED] == 1
+
+    # Offenders removed by GC are forgotten by the eviction order too.
+    assert backend.gc(now_ms=NOW_MS + 2000, limits=LIMITS) == (1, 1)
+    push(backend, '@a:x', NOW_MS + 3000, 1, now_ms=NOW_MS + 2000)
+    assert list(backend.offenders) == ['@a:x']
+    assert backend.evicted[OffenderState.ALERTED] == 1
+
+    with pytest.raises(ValueError):
+        MemoryBackend(OffenceList, max_offenders=0)
+
+
+def test_memory_backend_decaying_score():
+    backend = MemoryBackend(DecayingScore)
+
+    for _ in range(2):
+        assert push(backend, '@a:x', NOW_MS + 10000,
+                    2) == (OffenceListClassifier.OKAY, OffenderState.OKAY)
+    assert push(backend, '@a:x', NOW_MS + 10000,
+                2) == (OffenceListClassifier.SPAM, OffenderState.OKAY)
+    # However many offences there were, one score is held.
+    assert backend.offence_count() == 1
+
+    # GC revisits the score as it decays, and drops it once nothing is left.
+    removed = 0
+    now_ms = NOW_MS
+    while len(backend):
+        now_ms += 10000
+        removed += backend.gc(now_ms=now_ms, limits=LIMITS)[1]
+    assert removed == 1
+    assert backend.offence_count() == 0
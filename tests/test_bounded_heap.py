@@ -0,0 +1,56 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import heapq
+
+from synapse_anti_ping.bounded_heap import BoundedHeap
+
+
+def test_bounded_heap():
+    h = BoundedHeap(cap=3)
+    assert not h
+    assert len(h) == 0
+    assert not h.full
+
+    assert h.push(5) is None
+    assert h.push(1) is None
+    assert h.push(3) is None
+    assert h.full
+    assert h.top == 1
+    assert sorted(h) == [1, 3, 5]
+
+    assert h.push(4) == 1
+    assert len(h) == 3
+    assert sorted(h) == [3, 4, 5]
+
+    assert h.push(2) == 2
+    assert sorted(h) == [3, 4, 5]
+
+    assert h.pop() == 3
+    assert h.pop() == 4
+    assert not h.full
+    assert h.push(0) is None
+    assert h.pop() == 0
+    assert h.pop() == 5
+    assert not h
+
+    try:
+        h.pop()
+    except IndexError:
+        pass
+    else:
+        assert False
+
+
+def test_bounded_heap_keeps_largest():
+    h = BoundedHeap(cap=4)
+    items = [9, 2, 7, 7, 1, 8, 3, 10, 0, 6]
+    for item in items:
+        h.push(item)
+
+    assert sorted(h) == sorted(items)[-4:]
+    assert [h.pop() for _ in range(len(h))] == sorted(items)[-4:]
+
+
+def test_bounded_heap_leaves_heapq_alone():
+    assert heapq.heappush.__module__ == '_heapq'
@@ -0,0 +1,75 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import marshmallow
+import pytest
+
+from synapse_anti_ping.config import Config
+from synapse_anti_ping.decisions import DecisionTable
+
+CONFIG = {
+    'mjolnir': {
+        'room': '!mjolnir:example.com',
+        'banlist': 'bans'
+    },
+    'log': {
+        'room': '!log:example.com'
+    },
+    'user': {
+        'user': 'antiping',
+        'password': 'password',
+    },
+}
+
+
+def make_table(**offences):
+    return DecisionTable(Config.from_data({**CONFIG, 'offences': offences}))
+
+
+def weight_for(table, msgtype, mentions):
+    rule = table.rule_for(msgtype, mentions)
+    return None if rule is None else rule.weight
+
+
+def test_decision_table_defaults():
+    table = make_table()
+    assert table.mention_limit == 4
+
+    assert weight_for(table, 'm.text', None) == 2
+    assert weight_for(table, 'm.text', 0) == 2
+    assert weight_for(table, 'm.text', 1) == 4
+    assert weight_for(table, 'm.text', 3) == 4
+    assert weight_for(table, 'm.text', 4) == 10
+    assert weight_for(table, 'm.image', None) == 4
+    assert weight_for(table, 'm.notice', None) == 2
+
+    assert table.rule_for('m.text', None).duration_ms == 24_000
+
+
+@pytest.mark.parametrize('mentions_enabled,mass_enabled,limit,weights', [
+    (True, False, 1, [2, 4]),
+    (False, True, 4, [2, 2, 2, 2, 10]),
+    (False, False, 0, [2]),
+])
+def test_decision_table_mentions(mentions_enabled, mass_enabled, limit, weights):
+    mentions = {'enabled': mentions_enabled, 'weight': 4, 'expires_minutes': 1}
+    mass_mentions = {'enabled': mass_enabled, 'weight': 10, 'expires_minutes': 1}
+    table = make_table(mentions=mentions, mass_mentions=mass_mentions)
+
+    assert table.mention_limit == limit
+    assert [weight_for(table, 'm.text', count) for count in range(limit + 1)] == weights
+
+
+def test_decision_table_disabled():
+    text_spam = {'enabled': False, 'weight': 2, 'expires_minutes': 1}
+    media_spam = {'enabled': False, 'weight': 4, 'expires_minutes': 1}
+    table = make_table(text_spam=text_spam, media_spam=media_spam)
+
+    assert table.rule_for('m.text', None) is None
+    assert table.rule_for('m.video', None) is None
+    assert weight_for(table, 'm.text', 1) == 4
+
+
+def test_mention_scan_length_must_be_positive():
+    with pytest.raises(marshmallow.ValidationError):
+        Config.from_data({**CONFIG, 'offences': {'mention_scan_length': -1}})
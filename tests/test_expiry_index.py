@@ -0,0 +1,44 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+from synapse_anti_ping.expiry_index import ExpiryIndex
+
+
+def test_expiry_index():
+    index = ExpiryIndex(resolution_ms=10)
+    assert len(index) == 0
+    assert index.pop_expired(1000) == []
+
+    index.schedule('a', 105)
+    index.schedule('b', 107)
+    index.schedule('c', 250)
+    assert len(index) == 3
+    assert 'a' in index
+
+    # Bucket [100, 110) isn't done until 110.
+    assert index.pop_expired(108) == []
+    assert sorted(index.pop_expired(110)) == ['a', 'b']
+    assert 'a' not in index
+    assert len(index) == 1
+
+    assert index.pop_expired(200) == []
+    assert index.pop_expired(260) == ['c']
+    assert len(index) == 0
+
+
+def test_expiry_index_reschedule():
+    index = ExpiryIndex(resolution_ms=10)
+
+    index.schedule('a', 105)
+    index.schedule('a', 305)
+    index.schedule('b', 105)
+    index.remove('b')
+    index.remove('missing')
+    assert len(index) == 1
+
+    assert index.pop_expired(200) == []
+
+    # Re-creating a bucket that was emptied earlier doesn't report keys twice.
+    index.schedule('b', 301)
+    assert sorted(index.pop_expired(400)) == ['a', 'b']
+    assert index.pop_expired(400) == []
@@ -0,0 +1,37 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+from synapse_anti_ping.lru_cache import LruCache
+
+
+def test_lru_cache():
+    cache = LruCache(cap=2)
+    assert cache.get('a') is None
+    assert cache.misses == 1
+    assert cache.hit_rate == 0
+
+    cache.put('a', True)
+    cache.put('b', False)
+    assert cache.get('a') is True
+    assert cache.get('b') is False
+    assert cache.hits == 2
+    assert len(cache) == 2
+
+    # 'a' is least recently used now.
+    cache.put('c', True)
+    assert len(cache) == 2
+    assert 'a' not in cache
+    assert cache.get('b') is False
+    assert cache.get('c') is True
+
+    # Reading 'b' makes 'c' the least recently used.
+    cache.get('b')
+    cache.put('d', True)
+    assert 'c' not in cache
+    assert 'b' in cache
+
+    assert cache.hit_rate == cache.hits / (cache.hits + cache.misses)
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.hits == cache.misses == 0
@@ -1,7 +1,9 @@
 import os, sys
 sys.path.append(os.path.dirname(__file__) + '/..')
 
-from synapse_anti_ping.mentions import get_mention_count
+import random
+
+from synapse_anti_ping.mentions import get_mention_count, get_mention_count_with_html_parser
 
 
 def test_mentions():
@@ -9,3 +11,79 @@ def test_mentions():
     assert get_mention_count('<a href>', limit=1) == 0
     assert get_mention_count('<a href="https://matrix.to/#/@user:instance.chat">', limit=1) == 1
     assert get_mention_count('<a href="https://matrix.to/#/@user:instance.chat">', limit=0) == 0
+
+
+def test_mentions_limit():
+    body = '<a href="https://matrix.to/#/@user:instance.chat">user</a> ' * 10
+    assert get_mention_count(body, limit=4) == 4
+    assert get_mention_count(body, limit=20) == 10
+
+
+def test_mentions_max_length():
+    mention = '<a href="https://matrix.to/#/@user:instance.chat">user</a>'
+    body = mention * 2 + 'x' * 100 + mention
+    assert get_mention_count(body, limit=10) == 3
+    assert get_mention_count(body, limit=10, max_length=len(mention) * 2) == 2
+    # Cutting a tag short means it isn't counted.
+    assert get_mention_count(body, limit=10, max_length=len(mention) + 10) == 1
+
+
+_FRAGMENTS = [
+    # Mentions, spelled in the different ways HTMLParser accepts.
+    '<a href="https://matrix.to/#/@user:instance.chat">user</a>',
+    "<a href='https://matrix.to/#/@user:instance.chat'>user</a>",
+    '<a href=https://matrix.to/#/@user:instance.chat>user</a>',
+    '<A HREF="https://matrix.to/#/@user:instance.chat">user</A>',
+    '<a\nclass="x"\thref = "https://matrix.to/#/@user:instance.chat" >user</a>',
+    '<a href="https://matrix.to/&#35;/&#64;user:instance.chat">user</a>',
+    '<a href="https://matrix.to/#/%40user:instance.chat">user</a>',
+    '<a href="//matrix.to/#/@user:instance.chat"/>',
+    '<a title="x" href="https://example.com" href="https://matrix.to/#/@user:x">user</a>',
+    '<a href="https://matrix.to/#/@user:x" href="https://example.com">user</a>',
+    '<a href="http://[::1/#/@user">broken</a>',
+    # Links that aren't mentions.
+    '<a href="https://matrix.to/#/#room:instance.chat">room</a>',
+    '<a href="https://matrix.to/#/!room:instance.chat">room</a>',
+    '<a href="https://example.com/#/@user:instance.chat">other</a>',
+    '<a href="matrix.to/#/@user:instance.chat">relative</a>',
+    '<a name="https://matrix.to/#/@user:instance.chat">name</a>',
+    '<abbr href="https://matrix.to/#/@user:instance.chat">abbr</abbr>',
+    '<a href>empty</a>',
+    '<a>bare</a>',
+    # Markup that can hide an anchor from HTMLParser.
+    '<!-- <a href="https://matrix.to/#/@user:instance.chat"> -->',
+    '<!-- unclosed -- >',
+    '<span title="<a href=\'https://matrix.to/#/@user:instance.chat\'>">span</span>',
+    '<script><a href="https://matrix.to/#/@user:instance.chat"></script>',
+    '<STYLE type="text/css"><a href="https://matrix.to/#/@user:x"></ style >',
+    '<script/>',
+    '</a href="https://matrix.to/#/@user:instance.chat">',
+    '</>',
+    '<?pi <a href="https://matrix.to/#/@user:instance.chat"> ?>',
+    '<!DOCTYPE html>',
+    '<!bogus <a href="https://matrix.to/#/@user:x">>',
+    '<![CDATA[ <a href="https://matrix.to/#/@user:x"> ]]>',
+    # Ordinary formatting and text.
+    '<p>hello <b>world</b></p>',
+    '<br/>',
+    '<img src="mxc://instance.chat/abc" alt="@user"/>',
+    '<blockquote>\n<p>quoted</p>\n</blockquote>',
+    '1 < 2 and 3 > 2',
+    '&lt;a href=&quot;https://matrix.to/#/@user:x&quot;&gt;',
+    'plain text @user:instance.chat',
+    '<',
+    '< a href="https://matrix.to/#/@user:instance.chat">',
+    '<a href="https://matrix.to/#/@user:instance.chat"',
+    '<a href="https://matrix.to/#/@user:x" x',
+    '<b title="unclosed>',
+]
+
+
+def test_mentions_match_html_parser():
+    rng = random.Random(0)
+
+    for _ in range(5000):
+        body = ''.join(rng.choice(_FRAGMENTS) for _ in range(rng.randrange(1, 8)))
+        for limit in (1, 2, 5, 100):
+            expected = get_mention_count_with_html_parser(body, limit=limit)
+            assert get_mention_count(body, limit=limit) == expected, (body, limit)
@@ -0,0 +1,42 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+from synapse_anti_ping.metrics import Metrics
+
+
+def test_histogram_buckets():
+    metrics = Metrics()
+    histogram = metrics.histogram('seconds', 'Seconds', [0.1, 1])
+
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+
+    assert histogram.buckets() == [(0.1, 2), (1, 3), (float('inf'), 4)]
+    assert histogram.count == 4
+    assert histogram.sum == 5.65
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.counter('things_total', 'Things', kind='a').inc()
+    metrics.counter('things_total', 'Things', kind='b').inc(2)
+    # The same labels give back the same metric.
+    metrics.counter('things_total', 'Things', kind='a').inc()
+    metrics.gauge('size', 'Size', lambda: 7)
+    metrics.histogram('seconds', 'Seconds', [1]).observe(0.5)
+
+    assert metrics.render().splitlines() == [
+        '# HELP synapse_anti_ping_things_total Things',
+        '# TYPE synapse_anti_ping_things_total counter',
+        'synapse_anti_ping_things_total{kind="a"} 2.0',
+        'synapse_anti_ping_things_total{kind="b"} 2.0',
+        '# HELP synapse_anti_ping_size Size',
+        '# TYPE synapse_anti_ping_size gauge',
+        'synapse_anti_ping_size 7.0',
+        '# HELP synapse_anti_ping_seconds Seconds',
+        '# TYPE synapse_anti_ping_seconds histogram',
+        'synapse_anti_ping_seconds_bucket{le="1.0"} 1',
+        'synapse_anti_ping_seconds_bucket{le="+Inf"} 1',
+        'synapse_anti_ping_seconds_sum 0.5',
+        'synapse_anti_ping_seconds_count 1',
+    ]
@@ -0,0 +1,197 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import math
+import random
+
+import pytest
+
+from synapse_anti_ping.offender import (Offence, OffenceList, CompactOffenceList, DecayingScore,
+                                        OffenceListClassifier)
+
+NOW_MS = 1_600_000_000_000
+
+
+@pytest.mark.parametrize('offence_list_type', [OffenceList, CompactOffenceList])
+def test_offence_list_total_weight(offence_list_type):
+    rng = random.Random(0)
+
+    offences = offence_list_type(5)
+    assert offences.total_weight == 0
+
+    for _ in range(100):
+        if offences and rng.random() < 0.3:
+            offences.pop()
+        else:
+            offences.push(
+                Offence(expiration_ms=NOW_MS + rng.randrange(-30000, 30000),
+                        weight=rng.randrange(1, 10)))
+
+        assert offences.total_weight == sum(offence.weight for offence in offences)
+        assert len(offences) <= 5
+
+    offences.clear_expired(NOW_MS)
+    assert offences.total_weight == sum(offence.weight for offence in offences)
+    assert all(not offence.expired(NOW_MS) for offence in offences)
+
+
+@pytest.mark.parametrize('offence_list_type', [OffenceList, CompactOffenceList])
+def test_offence_list_clear_expired(offence_list_type):
+    offences = offence_list_type(5)
+    offences.push(Offence(expiration_ms=NOW_MS - 1, weight=1))
+    offences.push(Offence(expiration_ms=NOW_MS, weight=2))
+    offences.push(Offence(expiration_ms=NOW_MS + 1, weight=4))
+
+    offences.clear_expired(NOW_MS)
+    assert len(offences) == 2
+    assert offences.total_weight == 6
+    assert offences.oldest == Offence(expiration_ms=NOW_MS, weight=2)
+
+    offences.clear_expired(NOW_MS + 2)
+    assert not offences
+    assert offences.total_weight == 0
+
+
+@pytest.mark.parametrize('offence_list_type', [OffenceList, CompactOffenceList])
+def test_offence_list_classify(offence_list_type):
+    expiration_ms = NOW_MS + 60000
+
+    offences = offence_list_type(3)
+    offences.push(Offence(expiration_ms=expiration_ms, weight=10))
+    assert offences.classify(spam_limit=20, ban_limit=30) == OffenceListClassifier.OKAY
+
+    offences.push(Offence(expiration_ms=expiration_ms, weight=10))
+    assert offences.classify(spam_limit=20, ban_limit=30) == OffenceListClassifier.SPAM
+
+    offences.push(Offence(expiration_ms=expiration_ms, weight=10))
+    assert offences.classify(spam_limit=20, ban_limit=30) == OffenceListClassifier.BAN
+
+    # Evicting the oldest offence keeps the total at the cap's worth of weight.
+    offences.push(Offence(expiration_ms=expiration_ms + 60000, weight=5))
+    assert offences.total_weight == 25
+    assert offences.classify(spam_limit=20, ban_limit=30) == OffenceListClassifier.SPAM
+
+
+def test_compact_offence_list_matches_heap():
+    rng = random.Random(1)
+
+    heap = OffenceList(4)
+    compact = CompactOffenceList(4)
+
+    # Distinct expirations, since the two lists may break ties differently.
+    for delta in rng.sample(range(100000), 200):
+        if heap and rng.random() < 0.3:
+            assert heap.pop() == compact.pop()
+        else:
+            offence = Offence(expiration_ms=NOW_MS + delta, weight=rng.randrange(1, 10))
+            heap.push(offence)
+            compact.push(offence)
+
+        if heap:
+            assert heap.oldest == compact.oldest
+        assert heap.total_weight == compact.total_weight
+        assert sorted(heap) == sorted(compact)
+
+
+def test_compact_offence_list_rejects_large_weights():
+    offences = CompactOffenceList(4)
+    with pytest.raises(ValueError):
+        offences.push(Offence(expiration_ms=NOW_MS, weight=1 << 16))
+
+
+def test_decaying_score():
+    # Offences lasting 10s decay with this half-life.
+    half_life_ms = 10000 * math.log(2)
+
+    score = DecayingScore(3)
+    score.push(Offence(expiration_ms=NOW_MS + 10000, weight=4))
+    # Pushed offences count straight away, but only decay once folded in.
+    assert score.total_weight == 4
+    score.clear_expired(NOW_MS)
+    assert score.score == 4
+    assert score.oldest == Offence(expiration_ms=NOW_MS + 10000, weight=4)
+
+    later_ms = NOW_MS + int(half_life_ms)
+    score.clear_expired(later_ms)
+    assert score.score == pytest.approx(2, rel=1e-3)
+
+    # Nothing is dropped past the cap, and longer lived offences decay at their own rate without
+    # slowing down the shorter lived ones.
+    for _ in range(4):
+        score.push(Offence(expiration_ms=later_ms + 20000, weight=10))
+    score.clear_expired(later_ms)
+    assert score.total_weight == 42
+    assert len(score) == 2
+    assert score.classify(spam_limit=20, ban_limit=30) == OffenceListClassifier.BAN
+
+    score.clear_expired(later_ms + int(half_life_ms))
+    assert score.score == pytest.approx(1 + 40 * 0.5**0.5, rel=1e-3)
+
+    # It goes away once below 1.
+    score.clear_expired(later_ms + 10 * 60 * 1000)
+    assert not score
+    assert score.total_weight == 0
+
+    # Expired offences are ignored.
+    score.push(Offence(expiration_ms=NOW_MS, weight=10))
+    score.clear_expired(NOW_MS + 1)
+    assert not score
+
+
+def test_decaying_score_round_trip():
+    score = DecayingScore(3)
+    score.push(Offence(expiration_ms=NOW_MS + 10000, weight=8))
+    score.push(Offence(expiration_ms=NOW_MS + 60000, weight=8))
+    score.clear_expired(NOW_MS)
+
+    # What's saved to a snapshot is enough to restore the score and how fast it decays.
+    restored = DecayingScore(3)
+    for offence in score:
+        restored.push(offence)
+    restored.clear_expired(NOW_MS)
+
+    for delta_ms in (0, 10000, 30000):
+        score.clear_expired(NOW_MS + delta_ms)
+        restored.clear_expired(NOW_MS + delta_ms)
+        assert restored.score == pytest.approx(score.score, rel=1e-3)
+
+
+def test_decaying_score_jittered():
+    # Events reach the check a varying time after they were sent, but each rule keeps one score,
+    # ending up the same as if every event had been checked the moment it was sent.
+    rng = random.Random(0)
+    rules = [(10000, 2), (60000, 1)]
+    jittered, prompt = DecayingScore(3), DecayingScore(3)
+
+    for i in range(200):
+        sent_ms = NOW_MS + i * 1000
+        for duration_ms, weight in rules:
+            offence = Offence(expiration_ms=sent_ms + duration_ms, weight=weight)
+            jittered.push(offence, duration_ms)
+            prompt.push(offence, duration_ms)
+        jittered.clear_expired(sent_ms + rng.randrange(0, 500))
+        prompt.clear_expired(sent_ms)
+        assert len(jittered) == len(rules)
+
+    later_ms = NOW_MS + 200 * 1000
+    jittered.clear_expired(later_ms)
+    prompt.clear_expired(later_ms)
+    assert jittered.score == pytest.approx(prompt.score, rel=1e-9)
+
+
+def test_decaying_score_restored_joins_rule():
+    score = DecayingScore(3)
+    score.push(Offence(expiration_ms=NOW_MS + 10000, weight=8), 10000)
+    score.clear_expired(NOW_MS)
+
+    # Restored a few seconds later, alongside a new offence from the same rule.
+    later_ms = NOW_MS + 3000
+    restored = DecayingScore(3)
+    for offence in score:
+        restored.push(offence)
+    restored.push(Offence(expiration_ms=later_ms + 10000, weight=8), 10000)
+    restored.clear_expired(later_ms)
+
+    score.clear_expired(later_ms)
+    assert len(restored) == 1
+    assert restored.score == pytest.approx(score.score + 8, rel=1e-3)
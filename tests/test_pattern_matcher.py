@@ -0,0 +1,51 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import random
+
+from synapse_anti_ping.pattern_matcher import PatternMatcher
+from synapse_anti_ping.utils import compile_pattern_alternatives
+
+
+def test_pattern_matcher():
+    matcher = PatternMatcher(
+        ['@mjolnir:x.org', '@bridge_*', '*:bridge.x.org', '@mod?:x.org', '@[ab]*:y.org'])
+
+    assert matcher.matches('@mjolnir:x.org')
+    assert not matcher.matches('@mjolnir:x.org2')
+    assert matcher.matches('@bridge_')
+    assert matcher.matches('@bridge_123:x.org')
+    assert matcher.matches('@user:bridge.x.org')
+    assert matcher.matches('@mod1:x.org')
+    assert not matcher.matches('@mod12:x.org')
+    assert matcher.matches('@alice:y.org')
+    assert not matcher.matches('@carol:y.org')
+    assert not matcher.matches('@user:x.org')
+
+    assert not PatternMatcher([]).matches('@user:x.org')
+    assert PatternMatcher(['*']).matches('@user:x.org')
+
+
+def test_pattern_matcher_matches_regex():
+    rng = random.Random(0)
+    alphabet = 'ab:.@\n'
+
+    def random_string(max_length):
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randrange(max_length)))
+
+    for _ in range(300):
+        patterns = []
+        for _ in range(rng.randrange(1, 6)):
+            core = random_string(4)
+            patterns.append(
+                rng.choice([
+                    core, f'{core}*', f'*{core}', f'*{core}*', f'{core}?', f'[ab]{core}',
+                    f'{core}*{core}'
+                ]))
+
+        matcher = PatternMatcher(patterns)
+        regex = compile_pattern_alternatives(patterns)
+
+        for _ in range(50):
+            s = random_string(8)
+            assert matcher.matches(s) == (regex.match(s) is not None), (patterns, s)
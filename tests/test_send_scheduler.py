@@ -0,0 +1,90 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import asyncio
+
+from synapse_anti_ping.send_scheduler import Priority, SendDropped, SendScheduler
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_priority_order():
+    loop = asyncio.get_event_loop()
+    scheduler = SendScheduler(max_in_flight=1, max_queued=10, loop=loop)
+    sent = []
+
+    def send(name):
+        async def _send():
+            sent.append(name)
+
+        return _send
+
+    futures = [
+        scheduler.submit(Priority.ALERT, send('alert')),
+        scheduler.submit(Priority.LOG, send('log')),
+        scheduler.submit(Priority.BAN, send('ban 1')),
+        scheduler.submit(Priority.BAN, send('ban 2')),
+    ]
+    assert scheduler.stats(Priority.BAN).queued == 2
+
+    # Nothing is sent before starting.
+    run(asyncio.sleep(0.01))
+    assert sent == []
+
+    scheduler.start()
+    run(asyncio.gather(*futures))
+    assert sent == ['ban 1', 'ban 2', 'log', 'alert']
+
+    stats = scheduler.stats(Priority.BAN)
+    assert stats.queued == 0
+    assert stats.sent == 2
+    assert stats.max_wait_seconds >= 0.01
+    assert stats.mean_wait_seconds > 0
+
+
+def test_max_in_flight():
+    loop = asyncio.get_event_loop()
+    scheduler = SendScheduler(max_in_flight=2, max_queued=10, loop=loop)
+    scheduler.start()
+
+    in_flight = 0
+    peak = 0
+
+    async def send():
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    run(asyncio.gather(*[scheduler.submit(Priority.ALERT, send) for _ in range(6)]))
+    assert peak == 2
+
+
+def test_drop_alerts_when_full():
+    loop = asyncio.get_event_loop()
+    scheduler = SendScheduler(max_in_flight=1, max_queued=2, loop=loop)
+
+    async def send():
+        pass
+
+    first = scheduler.submit(Priority.ALERT, send)
+    second = scheduler.submit(Priority.ALERT, send)
+
+    # Full of alerts, so a new one is dropped...
+    assert isinstance(scheduler.submit(Priority.ALERT, send).exception(), SendDropped)
+    # ...but a ban evicts the newest alert.
+    ban = scheduler.submit(Priority.BAN, send)
+    assert isinstance(second.exception(), SendDropped)
+    log = scheduler.submit(Priority.LOG, send)
+    assert isinstance(first.exception(), SendDropped)
+    # With no alerts left to evict, log notices are queued past the limit.
+    log_2 = scheduler.submit(Priority.LOG, send)
+
+    assert scheduler.stats(Priority.ALERT).dropped == 3
+
+    scheduler.start()
+    run(asyncio.gather(ban, log, log_2))
+    assert scheduler.stats(Priority.LOG).sent == 2
@@ -0,0 +1,58 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import collections
+import random
+
+import pytest
+
+from synapse_anti_ping.sketch import WindowedCountMinSketch
+
+NOW_MS = 1_600_000_000_000
+
+
+def test_sketch_never_underestimates():
+    rng = random.Random(0)
+    # Small enough that plenty of keys share counters.
+    sketch = WindowedCountMinSketch(width=64, depth=3, window_ms=60_000)
+    totals = collections.Counter()
+
+    for _ in range(2000):
+        key = f'@user{rng.randrange(500)}:x'
+        amount = rng.randrange(1, 5)
+        totals[key] += amount
+        assert sketch.add(key, amount, NOW_MS) >= totals[key]
+
+    for key, total in totals.items():
+        assert sketch.estimate(key, NOW_MS) >= total
+
+
+def test_sketch_exact_without_collisions():
+    sketch = WindowedCountMinSketch(width=1 << 16, depth=4, window_ms=60_000)
+    for i in range(100):
+        sketch.add(f'@user{i}:x', i, NOW_MS)
+
+    assert [sketch.estimate(f'@user{i}:x', NOW_MS) for i in range(100)] == list(range(100))
+
+
+def test_sketch_window():
+    window_start = NOW_MS - NOW_MS % 60_000
+    sketch = WindowedCountMinSketch(width=1024, depth=2, window_ms=60_000)
+    sketch.add('@a:x', 10, window_start + 30_000)
+
+    # A quarter of the way into the next window, three quarters of the last one still count.
+    assert sketch.estimate('@a:x', window_start + 75_000) == 7.5
+    assert sketch.add('@a:x', 2, window_start + 75_000) == 9.5
+    # Two windows later, it's all gone.
+    assert sketch.estimate('@a:x', window_start + 180_000) == 0
+
+    sketch.add('@a:x', 4, window_start + 180_000)
+    # Going back in time counts everything still held.
+    assert sketch.estimate('@a:x', window_start) == 4
+
+
+def test_sketch_invalid():
+    with pytest.raises(ValueError):
+        WindowedCountMinSketch(width=0, depth=1, window_ms=1)
+    with pytest.raises(ValueError):
+        WindowedCountMinSketch(width=1, depth=1, window_ms=0)
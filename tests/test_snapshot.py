@@ -0,0 +1,79 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import pytest
+
+from synapse_anti_ping.offender import Offence, OffenderState
+from synapse_anti_ping.snapshot import Snapshot, SnapshotFormatError, write_snapshot
+
+NOW_MS = 1_000_000
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'snapshot')
+
+    entries = [
+        ('@a:x', OffenderState.OKAY, [Offence(NOW_MS + 10, 2),
+                                      Offence(NOW_MS - 10, 4)]),
+        ('@b:x', OffenderState.BANNED, [Offence(NOW_MS + 20, 10)]),
+        # Fully expired, so not written at all.
+        ('@c:x', OffenderState.ALERTED, [Offence(NOW_MS - 1, 4)]),
+        ('@d:x', OffenderState.ALERTED, [Offence(NOW_MS + 5, 4),
+                                         Offence(NOW_MS + 30, 1)]),
+    ]
+    assert write_snapshot(path, entries, now_ms=NOW_MS) == 3
+
+    # @d's offences haven't all expired by now, but @a's have.
+    snapshot = Snapshot(path, now_ms=NOW_MS + 15)
+    assert len(snapshot) == 2
+    assert '@a:x' not in snapshot
+    assert snapshot.pop('@a:x') is None
+
+    assert snapshot.pop('@b:x') == (OffenderState.BANNED, [Offence(NOW_MS + 20, 10)])
+    assert snapshot.pop('@b:x') is None
+    assert list(snapshot.entries()) == [
+        ('@d:x', OffenderState.ALERTED, [Offence(NOW_MS + 5, 4),
+                                         Offence(NOW_MS + 30, 1)]),
+    ]
+
+
+def test_snapshot_empty(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    assert write_snapshot(path, [], now_ms=NOW_MS) == 0
+    assert len(Snapshot(path, now_ms=NOW_MS)) == 0
+
+
+def test_snapshot_invalid(tmp_path):
+    path = str(tmp_path / 'snapshot')
+
+    with open(path, 'wb') as fp:
+        fp.write(b'not a snapshot, but long enough to have a header')
+    with pytest.raises(SnapshotFormatError):
+        Snapshot(path, now_ms=NOW_MS)
+
+    write_snapshot(path, [('@a:x', OffenderState.OKAY, [Offence(NOW_MS, 1)])], now_ms=NOW_MS)
+    with open(path, 'r+b') as fp:
+        fp.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(SnapshotFormatError):
+        Snapshot(path, now_ms=NOW_MS)
+
+
+def test_snapshot_reload(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    entries = [(f'@{name}:x', OffenderState.OKAY, [Offence(NOW_MS + 10, 1)]) for name in 'abc']
+    write_snapshot(path, entries, now_ms=NOW_MS)
+
+    old = Snapshot(path, now_ms=NOW_MS)
+    reloaded = Snapshot(path, now_ms=NOW_MS, only={'@a:x', '@b:x'})
+    assert reloaded.names() == {'@a:x', '@b:x'}
+    assert reloaded.get('@a:x') == (OffenderState.OKAY, [Offence(NOW_MS + 10, 1)])
+    assert '@a:x' in reloaded
+
+    old.pop('@a:x')
+    reloaded.retain(old)
+    assert reloaded.names() == {'@b:x'}
+
+    # Closing unmaps the file, even though its columns were read through views of it.
+    old.close()
+    reloaded.close()
+    assert len(reloaded) == 0
@@ -0,0 +1,75 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import pytest
+
+from synapse_anti_ping.spool import Spool
+
+
+def test_spool_replay(tmp_path):
+    path = str(tmp_path / 'spool')
+
+    spool = Spool(path)
+    a = spool.append({'kind': 'ban', 'user': '@a:x'})
+    b = spool.append({'kind': 'ban', 'user': '@b:x'})
+    c = spool.append({'kind': 'ban', 'user': '@c:x'})
+    spool.ack(b)
+    assert spool.dirty
+    spool.close()
+
+    spool = Spool(path)
+    assert spool.pending() == [(a, {
+        'kind': 'ban',
+        'user': '@a:x'
+    }), (c, {
+        'kind': 'ban',
+        'user': '@c:x'
+    })]
+    # IDs aren't reused.
+    assert spool.append({'kind': 'ban', 'user': '@d:x'}) > c
+    spool.close()
+
+
+def test_spool_incomplete_line(tmp_path):
+    path = str(tmp_path / 'spool')
+
+    spool = Spool(path)
+    spool.append({'kind': 'ban', 'user': '@a:x'})
+    spool.close()
+
+    with open(path, 'a') as fp:
+        fp.write('{"id":1,"rec')
+
+    spool = Spool(path)
+    assert [record['user'] for _, record in spool.pending()] == ['@a:x']
+    spool.append({'kind': 'ban', 'user': '@b:x'})
+    spool.close()
+
+    # The cut off line was dropped, so later appends are still readable.
+    spool = Spool(path)
+    assert [record['user'] for _, record in spool.pending()] == ['@a:x', '@b:x']
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_spool_compaction(tmp_path, background):
+    path = str(tmp_path / 'spool')
+
+    spool = Spool(path, compact_at=10, background=background)
+    kept = spool.append({'kind': 'ban', 'user': '@kept:x'})
+    for i in range(10):
+        spool.ack(spool.append({'kind': 'ban', 'user': f'@{i}:x'}))
+    # Written to the compacted file, before it has necessarily replaced the old one.
+    added = spool.append({'kind': 'ban', 'user': '@added:x'})
+    spool.sync()
+    spool.close()
+
+    with open(path) as fp:
+        assert len(fp.readlines()) == 2
+    assert not os.path.exists(path + '.tmp')
+    assert Spool(path).pending() == [(kept, {
+        'kind': 'ban',
+        'user': '@kept:x'
+    }), (added, {
+        'kind': 'ban',
+        'user': '@added:x'
+    })]
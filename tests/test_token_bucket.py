@@ -0,0 +1,30 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+import pytest
+
+from synapse_anti_ping.token_bucket import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+
+    # The burst is available right away.
+    assert [bucket.reserve(0) for _ in range(3)] == [0, 0, 0]
+    # Then reservations are spaced out at the rate.
+    assert bucket.reserve(0) == pytest.approx(0.5)
+    assert bucket.reserve(0) == pytest.approx(1.0)
+
+    # Both reservations have been used up by now.
+    assert bucket.reserve(1.0) == pytest.approx(0.5)
+
+    # Refills never exceed the burst.
+    assert [bucket.reserve(100) for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve(100) > 0
+
+
+def test_token_bucket_invalid():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0, burst=1, now=0)
+    with pytest.raises(ValueError):
+        TokenBucket(rate=1, burst=0, now=0)
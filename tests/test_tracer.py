@@ -0,0 +1,34 @@
+import os, sys
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+from synapse_anti_ping.tracer import SlowEvent, SlowEventTracer, format_slow_events
+
+
+def slow_event(event_id, total_seconds):
+    return SlowEvent(event_id=event_id,
+                     room='!room:x',
+                     msgtype='m.text',
+                     body_size=10,
+                     mentions=None,
+                     outcome='okay',
+                     filter_seconds=0,
+                     mentions_seconds=0,
+                     classify_seconds=total_seconds,
+                     total_seconds=total_seconds)
+
+
+def test_slow_event_tracer():
+    tracer = SlowEventTracer(threshold_seconds=0.001, cap=2)
+    for i, total_seconds in enumerate([0.002, 0.005, 0.003]):
+        tracer.record(slow_event(f'$event{i}', total_seconds))
+
+    assert [event.event_id for event in tracer.events] == ['$event1', '$event2']
+    assert tracer.recorded == 3
+
+    text, formatted = format_slow_events(tracer)
+    assert text.splitlines() == [
+        '2 of 3 events slower than 1.00ms (filter / mentions / classify / total ms):',
+        '$event1 in !room:x: m.text, 10 chars, - mentions, okay, 0.00 / 0.00 / 5.00 / 5.00',
+        '$event2 in !room:x: m.text, 10 chars, - mentions, okay, 0.00 / 0.00 / 3.00 / 3.00',
+    ]
+    assert formatted.count('<tr>') == 3